@@ -0,0 +1,51 @@
+'''Compares the lmfit and fast fit engines of neufit for equivalence
+    and speed on synthetic neutral occurrence data
+
+Usage: python benchmarks/fit_engines.py [n_otus ...]
+'''
+import sys
+import time
+import numpy as np
+from nevo.neutral_fit_utils import beta_cdf, fit_m, fit_m_lmfit
+
+
+def synthetic_occurrence(n_otus, n_samples = 200, N = 10000, m = 0.05, 
+                         seed = 0):
+    '''Mean abundances and occurrences drawn around the neutral curve'''
+    rng = np.random.default_rng(seed)
+    p = np.sort(rng.dirichlet(np.full(n_otus, 0.3)))
+    p = np.clip(p, 1e-9, None)
+    occurrence = rng.binomial(n_samples, beta_cdf(p, N, m))/n_samples
+    return p, occurrence, N
+
+
+def lmfit_engine(p, occurrence, N):
+    beta_fit = fit_m_lmfit(p, occurrence, N)
+    return beta_fit.best_values['m'], beta_fit.stderr
+
+
+def fast_engine(p, occurrence, N):
+    beta_fit = fit_m(p, occurrence, N)
+    return beta_fit.best_values['m'], beta_fit.stderr
+
+
+def best_time(func, *args, repeat = 5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), out
+
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000, 100000]
+    print('n_otus\tlmfit_s\tfast_s\tm_lmfit\tm_fast\tstderr_lmfit\tstderr_fast')
+    for n_otus in sizes:
+        data = synthetic_occurrence(n_otus)
+        t_lm, (m_lm, se_lm) = best_time(lmfit_engine, *data)
+        t_fast, (m_fast, se_fast) = best_time(fast_engine, *data)
+        print('\t'.join([str(n_otus), '{:.4f}'.format(t_lm), 
+                         '{:.4f}'.format(t_fast), '{:.6g}'.format(m_lm), 
+                         '{:.6g}'.format(m_fast), '{:.4g}'.format(se_lm),
+                         '{:.4g}'.format(se_fast)]))
@@ -0,0 +1,177 @@
+'''Times and memory-profiles every stage of neufit on simulated neutral
+    tables across a grid of sizes, and records the results as a
+    machine-readable baseline (JSON)
+
+Every grid point simulates a table (simulate_neutral_table), writes it in
+each input format, then runs neufit, the plots and the outliers on every
+format with a StageProfiler. Points run one at a time in a fresh worker
+process so their peak RSS is their own. Dense TSV is skipped above
+--max-dense-cells.
+
+Usage: python benchmarks/neufit_scaling.py [--grid small|medium|full]
+           [--formats tsv sparse biom] [--output baseline.json]
+           [--compare baseline.json]
+'''
+import os
+import sys
+import json
+import argparse
+import platform
+import tempfile
+import contextlib
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy
+import pandas as pd
+import nevo
+from nevo.neutral_fit import neufit, _plot_and_outliers
+from nevo.neutral_fit_profile import StageProfiler, profiling, stage
+from nevo.neutral_fit_simulate import (simulate_neutral_table,
+                                       write_simulated_table)
+
+
+grids = {'small': [(1000, 100), (10000, 100), (10000, 1000)],
+         'medium': [(n_otus, n_samples) for n_otus in (10**3, 10**4, 10**5)
+                    for n_samples in (10**2, 10**3)],
+         'full': [(n_otus, n_samples) for n_otus in (10**3, 10**4, 10**5,
+                                                      10**6)
+                  for n_samples in (10**2, 10**3, 10**4)]}
+
+default_output = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'baselines', 'neufit_scaling.json')
+
+
+def machine():
+    '''Machine and library versions a baseline was recorded with'''
+    return {'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__,
+            'pandas': pd.__version__, 'nevo': nevo.__version__}
+
+
+def run_point(n_otus, n_samples, formats, m, depth, n_bootstrap, engine,
+              seed, max_dense_cells):
+    '''Simulates, writes and fits one grid point, returns its record'''
+    profiler = StageProfiler()
+    record = {'n_otus': n_otus, 'n_samples': n_samples, 'depth': depth,
+              'm': m, 'formats': {}}
+    with tempfile.TemporaryDirectory() as workdir, \
+            open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull), profiling(profiler):
+        with stage('generate'):
+            #Uneven depths, so neufit rarefies to about depth
+            depths = np.random.default_rng(seed).integers(depth, 2*depth,
+                                                          n_samples)
+            table = simulate_neutral_table(n_otus, n_samples, m, depth,
+                                           depth=depths, seed=seed)
+        record['nnz'] = int(table[0].nnz)
+        prefix = os.path.join(workdir, 'sim')
+        fns = write_simulated_table(*table, prefix, formats=(),
+                                    taxonomy=True)
+        for fmt in formats:
+            if fmt == 'tsv' and n_otus*n_samples > max_dense_cells:
+                record['formats'][fmt] = {'skipped': 'dense table larger '
+                                          'than --max-dense-cells'}
+                continue
+            with stage('write_' + fmt):
+                fns.update(write_simulated_table(*table, prefix,
+                                                 formats=(fmt,),
+                                                 taxonomy=False))
+            record['formats'][fmt] = {'file_bytes':
+                                      os.path.getsize(fns[fmt])}
+        del table
+
+        for fmt in formats:
+            if fmt not in fns:
+                continue
+            with stage(fmt):
+                result = neufit('sim_' + fmt, 'benchmark', fns[fmt],
+                                fns['taxonomy'], engine=engine,
+                                n_bootstrap=n_bootstrap, n_jobs=1, seed=seed)
+                result.write(workdir)
+                _plot_and_outliers(*result, 'benchmark', True, True, True,
+                                   False)
+            record['formats'][fmt].update({
+                'm_fit': result.beta_fit.best_values['m'],
+                'r_square': result.r_square,
+                'n_otus_fitted': len(result.occurr_freqs)})
+    record.update(profiler.record())
+    return record
+
+
+def compare(runs, baseline, tolerance):
+    '''Stage timings of runs relative to a baseline, as a pandas df with
+        one row per grid point and stage; ratio > tolerance is flagged'''
+    reference = {(r['n_otus'], r['n_samples'], s['stage']): s['seconds']
+                 for r in baseline['runs'] for s in r.get('stages', [])}
+    rows = []
+    for r in runs:
+        for s in r.get('stages', []):
+            key = (r['n_otus'], r['n_samples'], s['stage'])
+            if key in reference and reference[key] > 0:
+                rows.append(key + (reference[key], s['seconds'],
+                                   s['seconds']/reference[key]))
+    table = pd.DataFrame(rows, columns=['n_otus', 'n_samples', 'stage',
+                                        'baseline_s', 'seconds', 'ratio'])
+    table['regression'] = table['ratio'] > tolerance
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--grid', choices=sorted(grids), default='small')
+    parser.add_argument('--formats', nargs='+', default=['tsv', 'sparse',
+                                                         'biom'])
+    parser.add_argument('--m', type=float, default=0.05)
+    parser.add_argument('--depth', type=int, default=10000,
+                        help='N of the model; samples get depth to 2*depth '
+                             'reads and are rarefied')
+    parser.add_argument('--n-bootstrap', type=int, default=20)
+    parser.add_argument('--engine', default='fast')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-dense-cells', type=float, default=1e8)
+    parser.add_argument('--output', default=default_output)
+    parser.add_argument('--compare', default=None,
+                        help='Baseline JSON to compare the stage timings to')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='Slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    runs = []
+    with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as pool:
+        for n_otus, n_samples in grids[args.grid]:
+            future = pool.submit(run_point, n_otus, n_samples, args.formats,
+                                 args.m, args.depth, args.n_bootstrap,
+                                 args.engine, args.seed,
+                                 args.max_dense_cells)
+            try:
+                run = future.result()
+            except Exception as e: #e.g. out of memory at the largest sizes
+                run = {'n_otus': n_otus, 'n_samples': n_samples,
+                       'error': repr(e)}
+            runs.append(run)
+            print('{:>8} OTUs x {:>6} samples: {}'.format(
+                n_otus, n_samples, run.get('error') or
+                '{:.2f}s, peak {:.0f} MB'.format(run['total_seconds'],
+                                                 run['peak_rss_mb'])))
+
+    baseline = {'benchmark': 'neufit_scaling',
+                'created': datetime.now().isoformat(timespec='seconds'),
+                'machine': machine(),
+                'parameters': {k: v for k, v in vars(args).items()
+                               if k not in ('output', 'compare')},
+                'runs': runs}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(baseline, f, indent=1)
+    print('baseline written to ' + args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            table = compare(runs, json.load(f), args.tolerance)
+        print(table.to_string(index=False))
+        if table['regression'].any():
+            sys.exit(1)
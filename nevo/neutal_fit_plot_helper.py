@@ -1,7 +1,17 @@
-from matplotlib import pyplot
-from nevo.neutral_fit_plot import neufit_plot
+from concurrent.futures import ProcessPoolExecutor
+from nevo.neutral_fit_plot import neufit_plot, new_axes
 
-def custom_color_plot(occurr_freqs, n_reads, n_samples, r_square, beta_fit, file_header):
+default_highlights = {
+    'Phylum': {'p__Proteobacteria': ('green', 'Proteobacteria'),
+               'p__Bacteroidetes': ('purple', 'Bacteroidetes')},
+    'Genus': {'g__Streptococcus': ('orange', 'Streptococcus')},
+    'Species': {'s__pylori': ('blue', 'H.pylori')},
+}
+#Custom colors of custom_color_plot: rank -> value -> (color, label)
+
+def custom_color_plot(occurr_freqs, n_reads, n_samples, r_square, beta_fit, 
+                      file_header, highlights = None, redraw = True, 
+                      ax = None):
     '''Adds species/phylum specific coloring to the neutral evolution plot
     
     Written by: Caitlin Guccione, 08-25-2021
@@ -23,22 +33,32 @@ def custom_color_plot(occurr_freqs, n_reads, n_samples, r_square, beta_fit, file
         R^2 value of the fit of data to neutral curve.
     beta_fit: lmfit.model.ModelResult object
         Holds the stats on the preformance of the model.
+    highlights: dict, optional
+        Which bacteria to color, as {rank: {value: (color, label)}}, e.g.
+        {'Genus': {'g__Streptococcus': ('orange', 'Streptococcus')}}. A 
+        value can also be a tuple of values sharing one color and label.
+        Default is default_highlights.
+    redraw: bool, optional
+        If 'False', the colors are drawn on top of the neutral evolution
+        plot already drawn by neufit_plot on ax instead of drawing it 
+        again.
+    ax: matplotlib Axes, optional
+        Axes to draw on, by default a new one from new_axes.
     
     Returns
     -------
-    png
-        A plot showing the the input data and how well it fits the neutral
-        model with specific speices or phylums labled in different colors
     fn: str, path
         A filepath where the plot is stored. 
+    ax: matplotlib Axes
+        A plot showing the the input data and how well it fits the neutral
+        model with specific speices or phylums labled in different colors
     
     Notes
     -----
-    If you want to add another custom color:
-        1. Create a new section with bacteria and Mean Abundance 
-        and Occurance lists
-        2. Add to the for loop at bottom of section as well
-        3. Add custum bacteria to plot
+    Every highlight group is one isin mask over its taxonomy column and 
+    one plot layer, so the cost does not grow with a loop over the OTUs.
+    Groups are drawn in the order of highlights, later groups on top. 
+    Ranks missing from occurr_freqs are skipped.
     
     TODO
     ----
@@ -46,74 +66,112 @@ def custom_color_plot(occurr_freqs, n_reads, n_samples, r_square, beta_fit, file
     way to describe the plot
     - Confirm the filename outputed is acutally used in code
     '''
+    if highlights is None:
+        highlights = default_highlights
     
     #Create orginal black plot
-    neufit_plot(occurr_freqs, n_reads, n_samples, r_square,
-                beta_fit, file_header)
+    if ax is None:
+        ax = new_axes()
+    if redraw == True:
+        neufit_plot(occurr_freqs, n_reads, n_samples, r_square,
+                    beta_fit, file_header, ax=ax)
     
-    #If you want to add a new custom color, follow the steps below on 
-    #what to add where (more info above as well)
+    mean_abundance = occurr_freqs['mean_abundance'].to_numpy()
+    occurrence = occurr_freqs['occurrence'].to_numpy()
     
-    # --------- STEP 1 ---------
-    # Create mean abundance and occurance list for bacteria 
-
-    #Phylori
-    MA_S_pylori = [] #Mean_Abundance, Species , phylori
-    O_S_pylori = [] #Occurrance
-
-    #Proteobacteria
-    MA_P_Proteobacteria = []
-    O_P_Proteobacteria = []
-
-    #Streptococcus
-    MA_G_Streptococcus = []
-    O_G_Streptococcus = []
-
-    #Bacteroidetes
-    MA_P_Bacteroidetes = []
-    O_P_Bacteroidetes = []
-
-    # --------- STEP 2 ---------
-    # Add to customized lists when hitting bacteria in neutral list 
-
-    #for i, j in neutral.iterrows():
-    for i,j in occurr_freqs.iterrows():
-        if j['Species'] == 's__pylori':
-            MA_S_pylori.append(j['mean_abundance'])
-            O_S_pylori.append(j['occurrence'])
-        if j['Phylum'] == 'p__Proteobacteria':
-            MA_P_Proteobacteria.append(j['mean_abundance'])
-            O_P_Proteobacteria.append(j['occurrence'])
-        if j['Genus'] == 'g__Streptococcus':
-            MA_G_Streptococcus.append(j['mean_abundance'])
-            O_G_Streptococcus.append(j['occurrence'])
-        if j['Phylum'] == 'p__Bacteroidetes':
-            MA_P_Bacteroidetes.append(j['mean_abundance'])
-            O_P_Bacteroidetes.append(j['occurrence'])
-
-    # --------- STEP 3 ---------
     # Override coloring of dots in current plot with new colors
-
-    pyplot.plot(MA_P_Proteobacteria, O_P_Proteobacteria, 'o', 
-                markersize=6, fillstyle='full', color='green', 
-                label="Proteobacteria")
-    pyplot.plot(MA_G_Streptococcus, O_G_Streptococcus, 'o', 
-                markersize=6, fillstyle='full', color='orange', 
-                label="Streptococcus")
-    pyplot.plot(MA_P_Bacteroidetes, O_P_Bacteroidetes, 'o', 
-                markersize=6, fillstyle='full', color='purple', 
-                label="Bacteroidetes")
-    pyplot.plot(MA_S_pylori, O_S_pylori, 'o', markersize=6, 
-                fillstyle='full', color='blue', label='H.pylori')
+    for rank, groups in highlights.items():
+        if rank not in occurr_freqs.columns:
+            continue
+        for value, (color, label) in groups.items():
+            values = [value] if isinstance(value, str) else list(value)
+            mask = occurr_freqs[rank].isin(values).to_numpy()
+            ax.plot(mean_abundance[mask], occurrence[mask], 'o', 
+                    markersize=6, fillstyle='full', color=color, 
+                    label=label)
         
     plot_fn = file_header + '_NeutralFitPlot_withNonNeutralColors.png'
     
-    return(plot_fn)
+    return(plot_fn, ax)
 
-def save_plot(fn):
+def save_plot(fn, ax, close = True):
     '''Saves the plot given filename input
     
     Written by: Caitlin Guccione, 08-25-2021
+    
+    Parameters
+    ----------
+    fn: str, path
+        Where to save the png.
+    ax: matplotlib Axes
+        The plot, as returned by neufit_plot or custom_color_plot.
+    close: bool, optional
+        If 'True', clears the figure after saving so its memory is freed
+        right away; set 'False' to keep drawing on it.
+    '''
+    if ax.get_legend_handles_labels()[1]:
+        ax.legend(loc="center left")
+    ax.figure.savefig(fn)
+    if close == True:
+        ax.figure.clf()
+
+def render_plot(occurr_freqs, n_reads, n_samples, r_square, beta_fit, 
+                file_header, norm_graph = True, colored_graph = True, 
+                highlights = None):
+    '''Draws and saves the neutral evolution plots of one neufit run
+    
+    Returns
+    -------
+    list of str
+        Filepaths of the saved plots.
+    '''
+    fns = []
+    ax = new_axes()
+    if norm_graph == True:
+        fn, ax = neufit_plot(occurr_freqs, n_reads, n_samples, r_square, 
+                             beta_fit, file_header, ax=ax)
+        save_plot(fn, ax, close = not colored_graph)
+        fns.append(fn)
+    if colored_graph == True:
+        #Colors are drawn on top of the plain graph if it is already drawn
+        fn, ax = custom_color_plot(occurr_freqs, n_reads, n_samples, 
+                                   r_square, beta_fit, file_header, 
+                                   highlights, redraw = not norm_graph, 
+                                   ax=ax)
+        save_plot(fn, ax)
+        fns.append(fn)
+    return(fns)
+
+def _render_plot_args(args):
+    return(render_plot(*args))
+
+def render_plots(runs, norm_graph = True, colored_graph = True, 
+                 highlights = None, n_jobs = None):
+    '''Draws and saves the plots of many neufit runs on a process pool
+    
+    Parameters
+    ----------
+    runs: list
+        neufit outputs, NeufitResults or (occurr_freqs, n_reads, 
+        n_samples, r_square, beta_fit, file_header) tuples, one per cohort
+        or replicate run; results are written (NeufitResult.write) first
+        so their output directory exists.
+    norm_graph, colored_graph: bool, optional
+        Which plots to save, as in nevo_pipeline.
+    highlights: dict, optional
+        Custom colors, see custom_color_plot.
+    n_jobs: int, optional
+        Number of worker processes; default uses all cores, 1 renders in
+        this process.
+    
+    Returns
+    -------
+    list
+        Filepaths of the saved plots of every run.
     '''
-    pyplot.legend(loc="center left")
-    pyplot.savefig(fn)
\ No newline at end of file
+    tasks = [tuple(run)[:6] + (norm_graph, colored_graph, highlights) 
+             for run in runs]
+    if n_jobs == 1 or len(tasks) <= 1:
+        return([_render_plot_args(t) for t in tasks])
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return(list(pool.map(_render_plot_args, tasks)))
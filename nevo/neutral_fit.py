@@ -1,19 +1,65 @@
 import os
+import io
+import json
+import warnings
 import scipy
 import numpy as np
 import pandas as pd
 from datetime import datetime
-from lmfit import Parameters, Model, fit_report 
 from scipy.stats import beta 
 from statsmodels.stats.proportion import proportion_confint 
-from nevo.neutral_fit_utils import beta_cdf, subsample
+from nevo.neutral_fit_utils import (beta_cdf, rarefy, 
+                                    occurrence_stats, fit_m, fit_m_lmfit, 
+                                    fit_m_ml, 
+                                    fit_m_batch,
+                                    NeutralFitResult, neutral_curve,
+                                    neutral_fit_report)
+from nevo.neutral_fit_bootstrap import bootstrap_m, bootstrap_report
 from nevo.neutral_fit_plot import neufit_plot
-from nevo.utils import biom2data_tax, biom_addMetaTax_customTCGAehn, non_neutral_outliers
-from nevo.neutal_fit_plot_helper import custom_color_plot, save_plot
+from nevo.utils import (biom2table_tax, write_data_tax, 
+                        biom_split_customTCGAehn, write_cohorts_customTCGAehn,
+                        non_neutral_outliers, load_abundances,
+                        tcgaEhnWGSgreg_meta, tcgaEhnWGSgreg_taxa,
+                        write_fit_table, scan_table)
+from nevo.neutral_fit_profile import profiling, stage
+from nevo.neutral_fit_incremental import StatisticsStore
+from nevo.neutal_fit_plot_helper import (custom_color_plot, render_plot, 
+                                         render_plots)
+
+try:
+    from IPython.display import display
+except ImportError: #Outside notebooks without IPython
+    display = print
+
+neufit_output_path = '/home/cguccion/NeutralEvolutionModeling/ipynb/neufit_output' 
+#location of all graphs and command line outputs from running Neufit
+
+hutchKrakenAlex_biom = '/home/cguccion/rawData/01_11_2021_Hutch340_BE_Samples_LudmilAlexandrov/biom'
+tcgaEhnWGSgreg_ = '/home/cguccion/rawData/April2021_Greg_TCGA_WGS/raw_from_Greg'
+#Location of raw data
+
+tcga_biom_filenames = {
+    'normal': '116640_feature-table-TCGA-WGS-STN-ESCA-HNSC.biom',
+    'cancer': '116639_feature-table-TCGA-WGS-PT-ESCA-HNSC.biom',
+}
+#Which biom file for the TCGA_WGS run
+
+tcga_ehn_names = {
+    'e': 'esophagus_',
+    'hn': 'headNeck_',
+    'e_scc': 'esophagus_squamousCellCarcinoma_',
+    'e_eac': 'esophagus_adenocarcinoma_',
+}
+#Output filename prefix of every TCGA_WGS cohort (custom_filename)
+
+fit_engines = ('lmfit', 'fast', 'ml')
+#Engines neufit can fit m with, see _fit_neutral
 
 def nevo_pipeline(output_filename, dataset_type, custom_filename, 
                   norm_graph = True, colored_graph = True, non_neutral = True, 
-                  non_save = False, full_non_neutral = True):
+                  non_save = False, full_non_neutral = True, 
+                  save_tsv = False, seed = None, cache = None, 
+                  save_format = None, profile = False, output_path = None):
     
     '''Calls all functions needed to create neutral model 
     
@@ -40,10 +86,8 @@ def nevo_pipeline(output_filename, dataset_type, custom_filename,
         If 'False', does NOT print or save the most non-neutral microbes into 
         a .csv file
     non_save: bool, optional
-        If 'True', will only prints and does NOT save: 
-        the neutral evolution graph without any custom bacteria coloring, 
-        the neutral evolution graph with custom bacteria coloring, and 
-        the most non-neutral microbes csv file.
+        If 'True', will only prints and does NOT save anything: no .txt 
+        report, no graphs and no csv files are written.
         This was intened for testing purposes. 
     full_non_neutral: bool, optional
         If 'True', will create an additonal csv file about which points are 
@@ -52,6 +96,31 @@ def nevo_pipeline(output_filename, dataset_type, custom_filename,
         Class, Order, Family, Genus, Species, predicted_occurence, 
         lower_conf_int, and upper_conf_int. This data can be used for custom
         coloring of the neutral evolution graph. 
+    save_tsv: bool, optional
+        If 'True', also writes the _data.csv and _taxonomy.csv files 
+        Neufit used to be run from. By default the biom table is handed 
+        to Neufit in memory and nothing is written.
+    seed: int, optional
+        Seed for the rarefaction, see neufit.
+    cache: StageCache, optional
+        On-disk cache of the biom conversion, rarefied statistics and 
+        fit (see neutral_fit_cache), so re-running only for new plots or
+        outliers skips them. Statistics and fit are only cached with a 
+        seed.
+    save_format: str, optional
+        Also writes occurr_freqs and the fit parameters as a binary 
+        'parquet', 'feather' or 'hdf5' file, see neufit.
+    profile: bool or StageProfiler, optional
+        If set, times every stage (biom conversion, neufit's stages, 
+        plots, outliers) and samples its memory; the record is written 
+        as [name]_profile.json next to the .txt report and returned.
+    output_path: str, path, optional
+        Root directory of the outputs, default neufit_output_path.
+    
+    Returns
+    -------
+    dict or None
+        The profile record if profile is set.
 
     TODO
     ----
@@ -61,85 +130,245 @@ def nevo_pipeline(output_filename, dataset_type, custom_filename,
     handles the current issue 
     - Remove everything from '#Convert data from biom to csv files for Neufit'
     and below because it is too specific
-    - Determine how to not create Neufit text file that ends up getting 
-    deleted
     - Change full_no_neutral to not be parameter?
     
     '''
     
-    #Convert data from biom to csv files for Neufit
-    if dataset_type == 'hutchKraken':
-        hutchKrakenAlex_biom = '/home/cguccion/rawData/01_11_2021_Hutch340_BE_Samples_LudmilAlexandrov/biom'
-        fnData, fnTaxonomy = biom2data_tax(hutchKrakenAlex_biom, 
-                                           custom_filename, output_filename)
-    elif dataset_type == 'TCGA_WGS':
-        #Determine which biom file for the run
-        if output_filename == 'normal':
-            biomFilename ='116640_feature-table-TCGA-WGS-STN-ESCA-HNSC.biom'
-        elif output_filename == 'cancer':
-            biomFilename ='116639_feature-table-TCGA-WGS-PT-ESCA-HNSC.biom'
-        
-        tcgaEhnWGSgreg_ = '/home/cguccion/rawData/April2021_Greg_TCGA_WGS/raw_from_Greg'
-        #Location of raw data
-        
-        #Turn biome file into _data and _tax files
-        fnD_hn, fnD_e, fnT_hn, fnT_e, fnD_e_scc, fnT_e_scc, fnD_e_eac, fnT_e_eac = biom_addMetaTax_customTCGAehn(tcgaEhnWGSgreg_,
-                                                                                                                 biomFilename,
-                                                                                                                 output_filename)
-        #Choose the correct _data file, esoph or head and neck
-        if custom_filename == 'e':
-            fnData = fnD_e
-            fnTaxonomy = fnT_e
-            output_filename = 'esophagus_' + output_filename
-        elif custom_filename == 'hn':
-            fnData = fnD_hn
-            fnTaxonomy = fnT_hn
-            output_filename = 'headNeck_' + output_filename
-        elif custom_filename == 'e_scc':
-            fnData = fnD_e_scc
-            fnTaxonomy = fnT_e_scc
-            output_filename = 'esophagus_squamousCellCarcinoma_'\
-            + output_filename
-        elif custom_filename == 'e_eac':
-            fnData = fnD_e_eac
-            fnTaxonomy = fnT_e_eac
-            output_filename = 'esophagus_adenocarcinoma_{}'.format(
-                output_filename
-            )
-            print(output_filename)
-        
+    _check_save_format(save_format)
+    with profiling(profile) as profiler:
+        #Load data from biom in memory for Neufit
+        with stage('convert'):
+            if dataset_type == 'hutchKraken':
+                data, taxonomy = _convert_hutchKraken(custom_filename, cache)
+                if save_tsv == True:
+                    with stage('write_tsv'):
+                        write_data_tax(data, taxonomy, output_filename)
+            elif dataset_type == 'TCGA_WGS':
+                #Split biom file into the cohorts, optionally as _data and 
+                #_tax files
+                cohorts, taxonomy = _convert_TCGA_WGS(output_filename, cache)
+                if save_tsv == True:
+                    with stage('write_tsv'):
+                        write_cohorts_customTCGAehn(cohorts, taxonomy, 
+                                                    output_filename)
+                
+                #Choose the correct cohort, esoph or head and neck
+                data = cohorts[custom_filename]
+                output_filename = tcga_ehn_names[custom_filename] + \
+                    output_filename
+            
+        #Run Neufit, its outputs are only written when saving
+        result = neufit(output_filename, dataset_type, data, taxonomy, 
+                        full_non_neutral, seed=seed, cache=cache, 
+                        save_format=save_format, output_path=output_path)
+        if non_save == False:
+            result.write()
         
-    #Run Neufit
-    occurr_freqs, n_reads, n_samples, r_square, beta_fit, file_header = neufit(output_filename, 
-                                                                               dataset_type, fnData,
-                                                                               fnTaxonomy, full_non_neutral)
+        _plot_and_outliers(*result, dataset_type, norm_graph, colored_graph, 
+                           non_neutral, non_save)
     
+    if profiler is not None:
+        _write_profile(profiler, result, write = non_save == False)
+        return(result.profile)
+
+def _plot_and_outliers(occurr_freqs, n_reads, n_samples, r_square, beta_fit,
+                       file_header, dataset_type, norm_graph, colored_graph, 
+                       non_neutral, non_save, plot = True):
+    '''Plotting and non-neutral outliers of one neufit run, see 
+        nevo_pipeline; plot = False skips the plots already rendered by
+        render_plots'''
     #Neufit Plotting and Non-neutral Outline
-    if norm_graph == True: #Neutral evolution graph, no color
-        nc_fn = neufit_plot(occurr_freqs, n_reads, n_samples, r_square, 
-                            beta_fit, file_header)
-        if non_save == False:
-            save_plot(nc_fn)
-    if colored_graph == True:#Neutral evolution graph with colors
-        cc_fn = custom_color_plot(occurr_freqs, n_reads, n_samples, 
-                                  r_square, beta_fit, file_header)
+    with stage('plots'):
         if non_save == False:
-            save_plot(cc_fn)
+            if plot == True:
+                render_plot(occurr_freqs, n_reads, n_samples, r_square, 
+                            beta_fit, file_header, norm_graph, colored_graph)
+        else: #Only show the graphs
+            if norm_graph == True: #Neutral evolution graph, no color
+                nc_fn, nc_ax = neufit_plot(occurr_freqs, n_reads, n_samples, 
+                                           r_square, beta_fit, file_header)
+                display(nc_ax.figure)
+            if colored_graph == True:#Neutral evolution graph with colors
+                cc_fn, cc_ax = custom_color_plot(occurr_freqs, n_reads, 
+                                                 n_samples, r_square, 
+                                                 beta_fit, file_header)
+                display(cc_ax.figure)
     if non_neutral == True:
-        non_neutral_outliers(file_header, occurr_freqs, dataset_type, 
-                             non_save)
-        
-    #Easier to delete the Neufit text file then to not create it
-    #Same is true of extermly non-neutral micorbes csv
-    if non_save == True:
-        neufit_fn= str(file_header) + ".txt"
-        os.remove(neufit_fn)
-        os.remove((str(file_header) + '_FullNonNeutral.csv'))
+        with stage('outliers'):
+            non_neutral_outliers(file_header, occurr_freqs, dataset_type, 
+                                 non_save)
 
+def nevo_pipeline_cohorts(output_filename, dataset_type, custom_filenames, 
+                          norm_graph = True, colored_graph = True, 
+                          non_neutral = True, non_save = False, 
+                          full_non_neutral = True, save_tsv = False, 
+                          seed = None, n_jobs = None, cache = None, 
+                          save_format = None, output_path = None):
+    '''Runs nevo_pipeline for many cohorts, loading the data only once
+    
+    For 'TCGA_WGS' the biom file, metadata and taxonomy are loaded once 
+    and every cohort is a column slice of that one matrix; for 
+    'hutchKraken' every custom_filename is its own biom file and is 
+    loaded once. All cohorts are then fitted together with one batched 
+    fit (neufit_cohorts), their plots are rendered on a process pool 
+    (render_plots) and reported in the same pass.
+    
+    Parameters
+    ----------
+    output_filename: str
+        As in nevo_pipeline ('normal' or 'cancer' for 'TCGA_WGS').
+    dataset_type: str
+        As in nevo_pipeline.
+    custom_filenames: list of str
+        The custom_filename of every cohort to run, e.g. 
+        ['e', 'hn', 'e_scc', 'e_eac'] for 'TCGA_WGS'.
+    norm_graph, colored_graph, non_neutral, non_save, full_non_neutral,
+    save_tsv: bool, optional
+        As in nevo_pipeline, applied to every cohort.
+    seed: int, optional
+        Seed for the rarefaction of every cohort.
+    n_jobs: int, optional
+        Number of processes rendering the plots; default uses all cores.
+    cache: StageCache, optional
+        On-disk cache of the biom conversion and rarefied statistics, see
+        nevo_pipeline.
+    save_format: str, optional
+        Binary output of every cohort, see neufit.
+    output_path: str, path, optional
+        Root directory of the outputs, default neufit_output_path.
+    
+    Returns
+    -------
+    dict
+        Maps the output filename of every cohort to its NeufitResult.
+    '''
+    _check_save_format(save_format)
+    cohorts = {}
+    if dataset_type == 'hutchKraken':
+        taxonomy = {}
+        for custom_filename in custom_filenames:
+            name = output_filename + '_' + custom_filename
+            cohorts[name], taxonomy[name] = _convert_hutchKraken(custom_filename,
+                                                                 cache)
+            if save_tsv == True:
+                write_data_tax(cohorts[name], taxonomy[name], name)
+    elif dataset_type == 'TCGA_WGS':
+        tcga_cohorts, taxonomy = _convert_TCGA_WGS(output_filename, cache)
+        if save_tsv == True:
+            write_cohorts_customTCGAehn(tcga_cohorts, taxonomy, 
+                                        output_filename)
+        for custom_filename in custom_filenames:
+            name = tcga_ehn_names[custom_filename] + output_filename
+            cohorts[name] = tcga_cohorts[custom_filename]
+    else:
+        raise ValueError('Unknown dataset_type: ' + str(dataset_type))
+    
+    results = neufit_cohorts(cohorts, dataset_type, taxonomy, 
+                             full_non_neutral, seed=seed, cache=cache,
+                             save_format=save_format, output_path=output_path)
+    if non_save == False:
+        for result in results.values():
+            result.write()
+        render_plots(list(results.values()), norm_graph, colored_graph, 
+                     n_jobs=n_jobs)
+    for name, result in results.items():
+        _plot_and_outliers(*result, dataset_type, norm_graph, colored_graph,
+                           non_neutral, non_save, plot=False)
+    return(results)
+
+def neufit_cohorts(cohorts, dataset_type, _taxonomy_filename, 
+                   full_non_neutral = False, arg_ignore_level = 0, 
+                   arg_rarefaction_level = 0, seed = None, cache = None, 
+                   save_format = None, output_path = None):
+    '''Runs neufit on many cohorts with a single batched fit of m
+    
+    The statistics of every cohort are computed exactly as in neufit; 
+    m is then fitted for all cohorts at once with fit_m_batch (the 
+    'fast' engine). As with neufit nothing is written; every cohort's 
+    NeufitResult writes its outputs on request.
+    
+    Parameters
+    ----------
+    cohorts: dict
+        Maps the output_filename of every cohort to its abundance table,
+        anything accepted by neufit's _data_filename.
+    dataset_type: str
+        As in neufit.
+    _taxonomy_filename: str, path, pandas df or dict
+        As in neufit, or a dict with one per cohort.
+    full_non_neutral, arg_ignore_level, arg_rarefaction_level, seed, 
+    cache, save_format, output_path: optional
+        As in neufit, applied to every cohort; only the statistics are 
+        cached.
+    
+    Returns
+    -------
+    dict
+        Maps every output_filename to its NeufitResult. Cohorts with 
+        fewer than 2 observed OTUs, which have no fit, are left out 
+        with a warning.
+    '''
+    _check_save_format(save_format)
+    if not isinstance(_taxonomy_filename, dict):
+        _taxonomy_filename = _load_taxonomy(_taxonomy_filename, dataset_type)
+    
+    prepared = {}
+    for name, data in cohorts.items():
+        taxonomy = _taxonomy_filename
+        if isinstance(_taxonomy_filename, dict):
+            taxonomy = _load_taxonomy(_taxonomy_filename[name], dataset_type)
+        stamp = datetime.now()
+        print("Running dataset: " + str(dataset_type) + "Category:" + \
+              str(name) + '\n')
+        report = io.StringIO()
+        (occurr_freqs, n_reads, n_samples, 
+         abundances), key = _cached_statistics(data, taxonomy, dataset_type, 
+                                               arg_ignore_level, 
+                                               arg_rarefaction_level, seed, 
+                                               report, cache)
+        prepared[name] = (occurr_freqs, n_reads, n_samples, stamp, report)
+    
+    # Fit the neutral model of all cohorts at once
+    fits = fit_m_batch({name: (v[0]['mean_abundance'], v[0]['occurrence'], 
+                               v[1]) for name, v in prepared.items()})
+    
+    #Cohorts with fewer than 2 observed OTUs have no fit
+    skipped = list(fits.index[fits['method'] == 'skipped'])
+    if skipped:
+        warnings.warn('Dropped cohorts with fewer than 2 observed OTUs: ' + 
+                      ', '.join(str(name) for name in skipped))
+    
+    results = {}
+    for name, (occurr_freqs, n_reads, n_samples, stamp, 
+               report) in prepared.items():
+        if name in skipped:
+            continue
+        fit = fits.loc[name]
+        m = float(fit['m'])
+        beta_fit = NeutralFitResult(m, n_reads, 
+                                    beta_cdf(occurr_freqs['mean_abundance'], 
+                                             n_reads, m),
+                                    float(fit['stderr']), 
+                                    float(fit['chisqr']), 
+                                    int(fit['n_otus']), int(fit['nfev']), 
+                                    fit['method'])
+        r_square = _report_fit(occurr_freqs, beta_fit)
+        print('=========================================================')
+        _neutral_prediction(occurr_freqs, beta_fit, n_samples)
+        results[name] = NeufitResult(name, dataset_type, occurr_freqs, 
+                                     n_reads, n_samples, r_square, beta_fit, 
+                                     report.getvalue(), stamp, 
+                                     full_non_neutral=full_non_neutral, 
+                                     save_format=save_format, 
+                                     output_path=output_path)
+    return(results)
 
 def neufit(output_filename, dataset_type, _data_filename, _taxonomy_filename, 
            full_non_neutral = False, arg_ignore_level = 0, 
-           arg_rarefaction_level = 0):
+           arg_rarefaction_level = 0, seed = None, engine = 'lmfit',
+           n_bootstrap = 0, bootstrap = 'samples', n_jobs = None, 
+           cache = None, save_format = None, chunksize = None, 
+           output_path = None, profile = False):
     
     '''Fits a neutral community model to species abundances
     
@@ -184,22 +413,79 @@ def neufit(output_filename, dataset_type, _data_filename, _taxonomy_filename,
     dataset_type: str
         Type of data importing. Currently just ('hutchKraken', 'gregTCGA'), 
         in ToDo, make more genearl
-    _data_filename: str, path
-        The path to []_data.csv file; often an OTU abudance table. 
-    _taxonomy_filename: str, path
+    _data_filename: str, path, biom Table, pandas df, tuple or StatisticsStore
+        The path to []_data.csv file; often an OTU abudance table. Can 
+        also be the table itself in memory: a biom Table, a pandas df 
+        (OTUs as rows) or a (matrix, obs_ids, sample_ids) tuple, see 
+        load_abundances. A StatisticsStore is refitted from its stored
+        sums without loading or rarefying anything (arg_ignore_level 
+        must then be 0).
+    _taxonomy_filename: str, path or pandas df
         The path to []_taxonomy.csv; corresponding taxonomic information.
+        Can also be a pandas df indexed by OTU id.
+    full_non_neutral: bool, optional
+        If 'True', NeufitResult.write also writes the non-neutral OTUs as 
+        [name]_FullNonNeutral.csv.
     arg_ignore_level: int, optional
         Ignores OTUs below this abudance threshold; default is to use all 
         OTUs regardless of abudance threshold. Value must be non-negative.
     arg_rarefaction_level: int, optional
         Sets the rarefaction level. Leaving the default of 0 changes 
         this value to the highest possible uniform read depth. 
+    seed: int, optional
+        Seed for the random draws of the rarefaction; default is an 
+        unseeded draw.
+    engine: str, optional
+        'lmfit' (default) fits m with lmfit's leastsq (fit_m_lmfit), 
+        'fast' solves the
+        same one-parameter least-squares problem with a bounded scalar 
+        optimizer (fit_m), without importing lmfit. 'ml' maximizes the 
+        binomial likelihood of the occurrence counts instead (fit_m_ml), 
+        which weights OTUs by their inverse binomial variance and also 
+        gives a profile-likelihood interval of m.
+    n_bootstrap: int, optional
+        If > 0, number of bootstrap replicates used for confidence 
+        intervals on m (see bootstrap_m), refitted with the same engine;
+        the percentile and BCa intervals are part of the .txt report.
+    bootstrap: str, optional
+        What the bootstrap resamples, 'samples' (default) or 'otus'.
+    n_jobs: int, optional
+        Number of worker processes for the bootstrap; default uses all 
+        cores.
+    cache: StageCache, optional
+        On-disk cache (see neutral_fit_cache) of the rarefied statistics
+        and the fit, keyed by the content of the table and taxonomy, 
+        arg_ignore_level, arg_rarefaction_level, seed, engine and the 
+        code version. Only used with a seed, as unseeded rarefaction is 
+        not reproducible.
+    save_format: str, optional
+        If 'parquet', 'feather' (both need pyarrow) or 'hdf5', 
+        NeufitResult.write also writes the full occurr_freqs as 
+        [name]_NeutralFit.[ext] with the fit parameters (m, N, R^2, ...) as file metadata and taxonomy 
+        columns as categoricals; load it with utils.read_fit_table.
+    chunksize: int, optional
+        Streams a _data.csv (or gzip compressed .csv.gz) _data_filename 
+        this many rows at a time (scan_table): depths, OTU sums and 
+        occurrences come from one pass with arg_ignore_level applied 
+        while reading, so without rarefaction the table is never held 
+        in memory. If rarefaction (or the bootstrap) is needed, the 
+        filtered table is read in a second pass.
+    output_path: str, path, optional
+        Root directory NeufitResult.write writes to by default, else 
+        neufit_output_path.
+    profile: bool or StageProfiler, optional
+        If set, times every stage (loading, rarefaction, fit, ...) and 
+        samples its memory, see neutral_fit_profile. The record is 
+        attached as beta_fit.profile and NeufitResult.write writes it as
+        [name]_profile.json next to the .txt report. Off by default, at 
+        no cost.
     
     Returns
     -------
-    file_header: str, path
-        Filepath for all nevo outputs. Includes path, data nickname and 
-        time stamp.
+    NeufitResult
+        The run in memory; nothing is written to disk until its write 
+        (or a write_ method) is called. It unpacks into occurr_freqs, 
+        n_reads, n_samples, r_square, beta_fit, file_header:
     occurr_freqs: pandas df
         Df header: otu_id, mean_abundance, occurrence, Kingdom, Phylum, 
         Class, Order, Family, Genus, Species, predicted_occurrence, 
@@ -210,8 +496,14 @@ def neufit(output_filename, dataset_type, _data_filename, _taxonomy_filename,
         Total number of samples.
     r_square: float
         R^2 value of the fit of data to neutral curve.
-    beta_fit: lmfit.model.ModelResult object
-        Holds the stats on the preformance of the model.
+    beta_fit: NeutralFitResult object
+        Holds the stats on the preformance of the model, with the 
+        best_values and best_fit of lmfit's ModelResult; with 
+        engine='ml' also loglik and m_interval. With n_bootstrap > 0 it 
+        also carries a bootstrap attribute (m_replicates, intervals).
+    file_header: str, path
+        Filepath for all nevo outputs. Includes path, data nickname and 
+        time stamp.
 
     Notes
     -----
@@ -234,6 +526,14 @@ def neufit(output_filename, dataset_type, _data_filename, _taxonomy_filename,
             - Made any necessary edits to allow data to be printed to 
             file instead of terminal
         - Output pandas df that is created to be used in future steps
+        - Replaced subsample() with rarefy(), which draws directly from 
+        the count vectors instead of expanding every read
+        - The lmfit fit uses the analytic Jacobian beta_cdf_jacobian of
+        its own residual (model - data) with lmfit.minimize
+        - The abundance table is kept as a scipy sparse matrix through 
+        filtering, rarefaction and the occurrence statistics
+        - Returns the run in memory (NeufitResult); the report and 
+        output files are written on request only
     
     TODO
     ----
@@ -257,59 +557,437 @@ def neufit(output_filename, dataset_type, _data_filename, _taxonomy_filename,
     (2018). The Neutral Metaorganism. bioRxiv. https://doi.org/10.1101/367243
     '''
     
-    ##Added by Caitlin ~ Push output to file instead of printing to screen
+    if engine not in fit_engines:
+        raise ValueError('engine must be one of ' + ', '.join(fit_engines) + 
+                         ', not ' + str(engine))
+    _check_save_format(save_format)
+    
+    #Time stamp of every output of this run
+    stamp = datetime.now()
+    print("Running dataset: " + str(dataset_type) + "Category:" + \
+          str(output_filename) + '\n')
+    
+    #Log of the statistics, the start of the .txt report
+    file = io.StringIO()
+    
+    with profiling(profile) as profiler, stage('neufit'):
+        (occurr_freqs, n_reads, n_samples, 
+         abundances), key = _cached_statistics(_data_filename, 
+                                               _taxonomy_filename,
+                                               dataset_type, arg_ignore_level,
+                                               arg_rarefaction_level, seed, 
+                                               file, cache, chunksize)
+            
+        # Fit the neutral model
+        with stage('fit'):
+            if key is None:
+                beta_fit = _fit_neutral(occurr_freqs, n_reads, n_samples, 
+                                        engine)
+            else:
+                beta_fit = cache.cached('fit', cache.key('fit', key, engine), 
+                                        lambda: _fit_neutral(occurr_freqs, 
+                                                             n_reads, 
+                                                             n_samples, 
+                                                             engine))
+    
+        # Report fit statistics
+        r_square = _report_fit(occurr_freqs, beta_fit)
+        
+        # Optional bootstrap confidence intervals for m
+        if n_bootstrap > 0:
+            with stage('bootstrap'):
+                if isinstance(_data_filename, StatisticsStore):
+                    abundances = _data_filename.table()
+                elif abundances is None: #Streamed without keeping the table
+                    abundances = scan_table(_data_filename, chunksize, 
+                                            arg_ignore_level, 
+                                            keep_matrix=True)[5]
+                m_replicates, intervals = bootstrap_m(abundances, n_reads, 
+                                                      beta_fit.best_values['m'],
+                                                      n_bootstrap, 
+                                                      resample=bootstrap,
+                                                      seed=seed, n_jobs=n_jobs,
+                                                      engine=engine)
+            beta_fit.bootstrap = (m_replicates, intervals)
+            print(bootstrap_report(m_replicates, intervals, bootstrap))
+        print('=========================================================')
+    
+        with stage('prediction'):
+            _neutral_prediction(occurr_freqs, beta_fit, n_samples)
+    
+    if profiler is not None:
+        beta_fit.profile = profiler.record()
+    
+    return(NeufitResult(output_filename, dataset_type, occurr_freqs, n_reads, 
+                        n_samples, r_square, beta_fit, file.getvalue(), 
+                        stamp, bootstrap=bootstrap, 
+                        full_non_neutral=full_non_neutral, 
+                        save_format=save_format, output_path=output_path))
+
+class NeufitResult:
+    '''Outputs of one neufit run, held in memory
+    
+    Nothing is written to disk when the result is made: the .txt report 
+    and the non-neutral table are built from the fit when first asked 
+    for, and every output file is written by an explicit call (write, or
+    one of the write_ methods) under an output root of choice. Iterating
+    the result gives the tuple neufit used to return, (occurr_freqs, 
+    n_reads, n_samples, r_square, beta_fit, file_header), so unpacking 
+    neufit(...) into those six still works.
+    
+    Parameters
+    ----------
+    output_filename: str
+        Name/nickname of the dataset, as in neufit.
+    dataset_type: str
+        As in neufit.
+    occurr_freqs: pandas df
+        mean_abundance, occurrence, taxonomy and the neutral prediction of
+        every OTU.
+    n_reads, n_samples: int
+        Uniform read depth and number of samples.
+    r_square: float
+        R^2 value of the fit of data to neutral curve.
+    beta_fit: NeutralFitResult object
+        The neutral fit, see neufit.
+    log: str
+        Statistics log of the run, the start of the .txt report.
+    stamp: datetime
+        Time stamp of the run, part of every output filename.
+    bootstrap: str, optional
+        What the bootstrap of beta_fit resampled, for its report.
+    full_non_neutral, save_format, output_path: optional
+        Defaults of write, as given to neufit.
+    
+    Attributes
+    ----------
+    file_header: str or None
+        Filepath prefix of the written outputs, None until written; 
+        before that iterating gives the file_header the outputs would 
+        get under output_path.
+    '''
+    
+    def __init__(self, output_filename, dataset_type, occurr_freqs, n_reads, 
+                 n_samples, r_square, beta_fit, log, stamp, 
+                 bootstrap = 'samples', full_non_neutral = False, 
+                 save_format = None, output_path = None):
+        self.output_filename = output_filename
+        self.dataset_type = dataset_type
+        self.occurr_freqs = occurr_freqs
+        self.n_reads = n_reads
+        self.n_samples = n_samples
+        self.r_square = r_square
+        self.beta_fit = beta_fit
+        self.log = log
+        self.stamp = stamp
+        self.bootstrap = bootstrap
+        self.full_non_neutral = full_non_neutral
+        self.save_format = save_format
+        self.output_path = output_path
+        self.file_header = None
+        self._report = None
+        self._non_neutral = None
+    
+    def __iter__(self):
+        file_header = self.file_header
+        if file_header is None:
+            file_header = self.header()
+        return(iter((self.occurr_freqs, self.n_reads, self.n_samples, 
+                     self.r_square, self.beta_fit, file_header)))
+    
+    @property
+    def report(self):
+        '''Text of the .txt report: statistics log, fit report, R^2 and 
+            the bootstrap intervals'''
+        if self._report is None:
+            report = self.log + neutral_fit_report(self.beta_fit) + \
+                '\n R^2 = ' + '{:1.2f}'.format(self.r_square)
+            if hasattr(self.beta_fit, 'bootstrap'):
+                m_replicates, intervals = self.beta_fit.bootstrap
+                report += '\n' + bootstrap_report(m_replicates, intervals, 
+                                                  self.bootstrap)
+            self._report = report
+        return(self._report)
+    
+    @property
+    def non_neutral(self):
+        '''OTUs outside the confidence interval of the neutral prediction,
+            above then below it (the _FullNonNeutral.csv table)'''
+        if self._non_neutral is None:
+            occurr_freqs = self.occurr_freqs
+            above = occurr_freqs[occurr_freqs['occurrence'] > 
+                                 occurr_freqs['upper_conf_int']]
+            below = occurr_freqs[occurr_freqs['occurrence'] < 
+                                 occurr_freqs['lower_conf_int']]
+            self._non_neutral = pd.concat((above, below))
+        return(self._non_neutral)
+    
+    @property
+    def parameters(self):
+        '''Fit parameters as a plain dict, see fit_parameters'''
+        return(fit_parameters(self.beta_fit, self.r_square, self.n_reads, 
+                              self.n_samples))
+    
+    @property
+    def profile(self):
+        '''Profile record of the run, None if it was not profiled'''
+        return(getattr(self.beta_fit, 'profile', None))
+    
+    def header(self, output_path = None):
+        '''file_header of the outputs under output_path (default the 
+            output_path given to neufit, else neufit_output_path); 
+            nothing is created'''
+        if output_path is None:
+            output_path = self.output_path
+        return(_neufit_file_header(self.output_filename, self.dataset_type, 
+                                   output_path, self.stamp))
+    
+    def _prepare(self, output_path):
+        '''Creates the output directory, returns and keeps the file_header'''
+        file_header = self.header(output_path)
+        os.makedirs(os.path.dirname(file_header), exist_ok=True)
+        self.file_header = file_header
+        return(file_header)
+    
+    def write_report(self, output_path = None):
+        '''Writes the report as [name].txt, returns its filepath'''
+        fn = self._prepare(output_path) + '.txt'
+        with open(fn, 'w') as file:
+            file.write(self.report)
+        return(fn)
     
-    neufit_output_path = '/home/cguccion/NeutralEvolutionModeling/ipynb/neufit_output' 
-    #location of all graphs and command line outputs from running Neufit
+    def write_non_neutral(self, output_path = None):
+        '''Writes the non_neutral table as [name]_FullNonNeutral.csv, 
+            returns its filepath'''
+        fn = self._prepare(output_path) + '_FullNonNeutral.csv'
+        self.non_neutral.to_csv(fn)
+        return(fn)
     
+    def write_fit_table(self, save_format, output_path = None):
+        '''Writes occurr_freqs and the fit parameters as 
+            [name]_NeutralFit.[ext], see neufit's save_format; returns its
+            filepath'''
+        return(_save_fit_table(self.occurr_freqs, self.beta_fit, 
+                               self.r_square, self.n_reads, self.n_samples,
+                               self._prepare(output_path), save_format))
     
+    def write_profile(self, output_path = None):
+        '''Writes the profile record as [name]_profile.json, returns its 
+            filepath'''
+        if self.profile is None:
+            raise ValueError('The run was not profiled')
+        fn = self._prepare(output_path) + '_profile.json'
+        with open(fn, 'w') as f:
+            json.dump(self.profile, f, indent=2)
+        return(fn)
+    
+    def write(self, output_path = None, full_non_neutral = None, 
+              save_format = None):
+        '''Writes the outputs neufit used to write: the .txt report, the 
+            _FullNonNeutral.csv (full_non_neutral), the fit table 
+            (save_format) and the profile (if profiled)
+        
+        Parameters
+        ----------
+        output_path: str, path, optional
+            Root directory of the outputs; default the output_path given 
+            to neufit, else neufit_output_path.
+        full_non_neutral, save_format: optional
+            As in neufit; default the values given to neufit.
+        
+        Returns
+        -------
+        list of str
+            Filepaths written.
+        '''
+        if full_non_neutral is None:
+            full_non_neutral = self.full_non_neutral
+        if save_format is None:
+            save_format = self.save_format
+        _check_save_format(save_format)
+        with stage('write_results'):
+            fns = [self.write_report(output_path)]
+            if full_non_neutral == True:
+                fns.append(self.write_non_neutral(output_path))
+            if save_format is not None:
+                fns.append(self.write_fit_table(save_format, output_path))
+            if self.profile is not None:
+                fns.append(self.write_profile(output_path))
+        return(fns)
+
+def _write_profile(profiler, result, write = True):
+    '''Attaches the profile record of the whole run to beta_fit.profile 
+        and optionally writes it as [name]_profile.json next to the .txt 
+        report (returned)'''
+    result.beta_fit.profile = profiler.record()
+    if write == True:
+        return(result.write_profile())
+
+def _neufit_file_header(output_filename, dataset_type, output_path = None, 
+                        stamp = None):
+    '''file_header of a neufit run (path, data nickname and time stamp), 
+        nothing is created; output_path defaults to neufit_output_path, 
+        stamp to now'''
+    if output_path is None:
+        output_path = neufit_output_path
+    if stamp is None:
+        stamp = datetime.now()
     #Grab and format data/time
-    time = datetime.time(datetime.now())
-    date = datetime.date(datetime.now())
-    h,s = str(time).split(".") #Split string into hours/min and sec
+    time = datetime.time(stamp)
+    date = datetime.date(stamp)
+    h = str(time).split(".")[0] #Hours/min and sec, without microseconds
     
     #Create file_header which holds the path for all future NEvo outpus
-    file_header = str(neufit_output_path) + "/" + str(dataset_type) + \
+    file_header = str(output_path) + "/" + str(dataset_type) + \
         '/' + str(output_filename) + '/' + str(output_filename) + '_' + \
         str(date) + "_" + str(h)
+    return(file_header)
+
+def _load_taxonomy(_taxonomy_filename, dataset_type):
+    '''Taxonomy as a pandas df indexed by OTU id, from a path or df'''
+    if _taxonomy_filename is None or \
+            isinstance(_taxonomy_filename, pd.DataFrame):
+        return(_taxonomy_filename)
+    if dataset_type == 'TCGA_WGS':
+        return(pd.read_table(_taxonomy_filename, header=0, index_col=1, 
+                             sep='\t'))
+    return(pd.read_table(_taxonomy_filename, header=0, index_col=0, sep='\t'))
+
+def _fit_neutral(occurr_freqs, n_reads, n_samples, engine):
+    '''Fits m with lmfit (analytic Jacobian), the fast or the ml engine'''
+    if engine == 'lmfit':
+        return(fit_m_lmfit(occurr_freqs['mean_abundance'], 
+                           occurr_freqs['occurrence'], n_reads))
+    if engine == 'ml':
+        return(fit_m_ml(occurr_freqs['mean_abundance'], 
+                        occurr_freqs['occurrence'], n_reads, n_samples))
+    return(fit_m(occurr_freqs['mean_abundance'], occurr_freqs['occurrence'],
+                 n_reads))
+
+def _convert_hutchKraken(custom_filename, cache):
+    '''biom2table_tax of a hutchKraken biom file, through the cache'''
+    biom_fn = hutchKrakenAlex_biom + '/' + custom_filename
+    if cache is None:
+        return(biom2table_tax(hutchKrakenAlex_biom, custom_filename))
+    def convert():
+        featureTable, pandas_TaxTable = biom2table_tax(hutchKrakenAlex_biom, 
+                                                       custom_filename)
+        return(load_abundances(featureTable), pandas_TaxTable)
+    return(cache.cached('conversion', cache.key('conversion', biom_fn), 
+                        convert))
+
+def _convert_TCGA_WGS(output_filename, cache):
+    '''biom_split_customTCGAehn of a TCGA_WGS biom file, through the 
+        cache'''
+    biomFilename = tcga_biom_filenames[output_filename]
+    if cache is None:
+        return(biom_split_customTCGAehn(tcgaEhnWGSgreg_, biomFilename))
+    key = cache.key('conversion', tcgaEhnWGSgreg_ + '/' + biomFilename, 
+                    tcgaEhnWGSgreg_meta, tcgaEhnWGSgreg_taxa)
+    return(cache.cached('conversion', key, 
+                        lambda: biom_split_customTCGAehn(tcgaEhnWGSgreg_, 
+                                                         biomFilename)))
+
+def _cached_statistics(_data_filename, _taxonomy_filename, dataset_type, 
+                       arg_ignore_level, arg_rarefaction_level, seed, file, 
+                       cache, chunksize = None):
+    '''_neutral_statistics through the cache
     
-    #Creates directory for all NEvo Outputs if it doesn't exist 
-    dir_name = str(neufit_output_path) + "/" + str(dataset_type) + \
-        '/' + str(output_filename)
-    os.makedirs(dir_name, exist_ok=True)
+    Returns
+    -------
+    tuple
+        The outputs of _neutral_statistics.
+    key: str
+        Cache key of the statistics, None if they were not cached (no
+        cache or no seed).
+    '''
+    if cache is None or seed is None or \
+            isinstance(_data_filename, StatisticsStore):
+        return(_neutral_statistics(_data_filename, 
+                                   _load_taxonomy(_taxonomy_filename, 
+                                                  dataset_type),
+                                   dataset_type, arg_ignore_level, 
+                                   arg_rarefaction_level, seed, file, 
+                                   chunksize), None)
     
-    #Create and open file for Neufit Output txt file
-    fn= str(file_header) + ".txt"
-    file = open(fn, 'w')
+    if not isinstance(_data_filename, (str, os.PathLike)):
+        _data_filename = load_abundances(_data_filename)
+        chunksize = None
+    key = cache.key('statistics', _data_filename, _taxonomy_filename, 
+                    dataset_type, arg_ignore_level, arg_rarefaction_level, 
+                    seed)
+    def statistics():
+        log = io.StringIO()
+        stats = _neutral_statistics(_data_filename, 
+                                    _load_taxonomy(_taxonomy_filename, 
+                                                   dataset_type),
+                                    dataset_type, arg_ignore_level, 
+                                    arg_rarefaction_level, seed, log, 
+                                    chunksize)
+        return(stats, log.getvalue())
+    stats, log = cache.cached('statistics', key, statistics)
+    file.write(log)
+    return(stats, key)
+
+def _neutral_statistics(_data_filename, taxonomy, dataset_type, 
+                        arg_ignore_level, arg_rarefaction_level, seed, file, 
+                        chunksize = None):
+    '''Loads, filters and rarefies one abundance table and computes the 
+        occurrence statistics of neufit, logging to file
     
-    #Print statments with important info
-    print("Running dataset: " + str(dataset_type) + "Category:" + \
-          str(output_filename) + '\n')
-    ##
+    Returns
+    -------
+    occurr_freqs: pandas df
+        mean_abundance, occurrence and the taxonomy of every OTU, sorted
+        by mean_abundance.
+    n_reads: int
+        Uniform read depth.
+    n_samples: int
+        Number of samples left after rarefaction.
+    abundances: scipy sparse matrix or None
+        The rarefied table; None if it was streamed (chunksize) and 
+        needed no rarefaction.
+    '''
+    if isinstance(_data_filename, StatisticsStore):
+        return(_store_statistics(_data_filename, taxonomy, dataset_type, 
+                                 arg_ignore_level, arg_rarefaction_level, 
+                                 file))
     
     # Writes dataset info output file, calculates and writes the 
     # number of samples/ reads in the file
-    file.write('Corresponding csv file: ' + _data_filename + '\n')
-    abundances = pd.read_table(_data_filename, header=0, 
-                               index_col=0, sep='\t').astype(int)
-    abundances = abundances[abundances.sum(1) > arg_ignore_level]
-    file.write ('Dataset contains ' + str(abundances.shape[1]) + \
+    if isinstance(_data_filename, (str, os.PathLike)):
+        file.write('Corresponding csv file: ' + str(_data_filename) + '\n')
+    else:
+        file.write('Corresponding table: in memory ' + \
+                   type(_data_filename).__name__ + '\n')
+    streamed = chunksize is not None and \
+        isinstance(_data_filename, (str, os.PathLike)) and \
+        not str(_data_filename).lower().endswith(('.npz', '.biom'))
+    with stage('load'):
+        if streamed:
+            #One pass over the file for the depths and per-OTU sums
+            abundances = None
+            sample_reads, row_sums, row_nonzero, otu_ids, sample_ids, _ = \
+                scan_table(_data_filename, chunksize, arg_ignore_level)
+        else:
+            abundances, otu_ids, sample_ids = load_abundances(_data_filename)
+            keep = np.asarray(abundances.sum(1)).ravel() > arg_ignore_level
+            abundances, otu_ids = abundances[keep], otu_ids[keep]
+            sample_reads = np.asarray(abundances.sum(0)).ravel()
+    file.write ('Dataset contains ' + str(len(sample_ids)) + \
                 ' samples (sample_id, reads): \n')
     
     ##Caitlin
     # The following loop is used instead of 'print abundances.sum(0)' 
     # so that it can be written to a file
-    for index, col in abundances.iteritems():
-        col_sum = 0
-        for i in col:
-            col_sum += i
-        file.write (index + '\t' + str(col_sum) + '\n')
+    for index, col_sum in zip(sample_ids, sample_reads):
+        file.write (str(index) + '\t' + str(col_sum) + '\n')
     file.write ('\n')
     ##
 
     # Determine uniform read depth
-    if arg_rarefaction_level == 0 or arg_rarefaction_level > max(abundances.sum(0)):
-        arg_rarefaction_level = min(abundances.sum(0))
+    if arg_rarefaction_level == 0 or arg_rarefaction_level > max(sample_reads):
+        arg_rarefaction_level = min(sample_reads)
         file.write ('rarefying to highest possible uniform read depth'),
     else:
         file.write ('rarefying to custom rarefaction level'),
@@ -318,24 +996,79 @@ def neufit(output_filename, dataset_type, _data_filename, _taxonomy_filename,
 
     # Optionally subsample the abundance table, unless all samples 
     # already have the required uniform read depth
-    if not all(n_reads == arg_rarefaction_level for n_reads in abundances.sum(0)):
-        abundances = subsample(abundances, arg_rarefaction_level)
-        abundances = abundances[abundances.sum(1) > 0]
+    if not all(sample_reads == arg_rarefaction_level):
+        for sample, reads in zip(sample_ids, sample_reads):
+            if reads < arg_rarefaction_level:
+                print('dropping sample ' + str(sample) + ' with ' + \
+                      str(reads) + ' reads < ' + str(arg_rarefaction_level))
+        if streamed: #Second pass, rarefaction needs the table
+            with stage('load'):
+                _, _, _, otu_ids, _, abundances = scan_table(
+                    _data_filename, chunksize, arg_ignore_level, 
+                    keep_matrix=True)
+        with stage('rarefy'):
+            abundances = rarefy(abundances, arg_rarefaction_level, seed=seed)
+            keep = abundances.getnnz(1) > 0
+            abundances, otu_ids = abundances[keep], otu_ids[keep]
 
     # Dataset shape
-    n_otus, n_samples = abundances.shape
+    if abundances is None:
+        n_otus, n_samples = len(otu_ids), len(sample_ids)
+    else:
+        n_otus, n_samples = abundances.shape
     n_reads = arg_rarefaction_level
 
     file.write ('fitting neutral expectation to dataset with ' + \
                 str(n_samples) + ' samples and ' + str(n_otus) + \
                 ' otus \n \n')
-    # Calculate mean relative abundances and occurrence frequencies
-    mean_relative_abundance = (1.0*abundances.sum(1))/n_reads/n_samples
-    occurrence_frequency = (1.0*np.count_nonzero(abundances, 
-                                                 axis=1))/n_samples
+    # Calculate mean relative abundances and occurrence frequencies,
+    # only this per-OTU table is ever dense
+    with stage('occurrence_stats'):
+        if abundances is None: #Streamed, the per-OTU sums are all we need
+            mean_relative_abundance = (1.0*row_sums)/n_reads/n_samples
+            occurrence_frequency = (1.0*row_nonzero)/n_samples
+        else:
+            mean_relative_abundance, occurrence_frequency = occurrence_stats(
+                abundances, n_reads)
     
-    occurr_freqs = pd.DataFrame(mean_relative_abundance, 
-                                columns=['mean_abundance'])
+    occurr_freqs = _occurrence_table(mean_relative_abundance, 
+                                     occurrence_frequency, otu_ids, 
+                                     taxonomy, dataset_type)
+    return(occurr_freqs, n_reads, n_samples, abundances)
+
+def _store_statistics(store, taxonomy, dataset_type, arg_ignore_level, 
+                      arg_rarefaction_level, file):
+    '''_neutral_statistics of a StatisticsStore: no loading or 
+        rarefaction, the stored sums are the statistics; the rarefied 
+        table is not assembled (None). The store keeps every OTU, so 
+        arg_ignore_level must be 0.'''
+    if arg_ignore_level not in (0, None):
+        raise ValueError('A statistics store keeps every OTU, '
+                         'arg_ignore_level must be 0, not ' + 
+                         str(arg_ignore_level))
+    if arg_rarefaction_level not in (0, store.depth):
+        raise ValueError('The store is rarefied to ' + str(store.depth) + 
+                         ' reads, not ' + str(arg_rarefaction_level))
+    with stage('occurrence_stats'):
+        mean_relative_abundance, occurrence_frequency, otu_ids = \
+            store.statistics()
+    file.write('Corresponding table: statistics store of ' + 
+               str(store.n_samples) + ' samples rarefied to ' + 
+               str(store.depth) + ' reads per sample \n')
+    file.write ('fitting neutral expectation to dataset with ' + \
+                str(store.n_samples) + ' samples and ' + str(len(otu_ids)) + \
+                ' otus \n \n')
+    occurr_freqs = _occurrence_table(mean_relative_abundance, 
+                                     occurrence_frequency, otu_ids, 
+                                     taxonomy, dataset_type)
+    return(occurr_freqs, store.depth, store.n_samples, None)
+
+def _occurrence_table(mean_relative_abundance, occurrence_frequency, otu_ids,
+                      taxonomy, dataset_type):
+    '''occurr_freqs of neufit: mean_abundance, occurrence and the 
+        optional taxonomy of every OTU, sorted by mean_abundance'''
+    occurr_freqs = pd.DataFrame({'mean_abundance': mean_relative_abundance}, 
+                                index=otu_ids)
     if dataset_type == 'TCGA_WGS':#This changes name of first column
         occurr_freqs.index.name = 'gOTU' 
     else:
@@ -344,44 +1077,103 @@ def neufit(output_filename, dataset_type, _data_filename, _taxonomy_filename,
     occurr_freqs = occurr_freqs.sort_values(by=['mean_abundance'])
 
     # Join with taxonomic information (optional)
-    if _taxonomy_filename != None: #Changed <> to !=
-        if dataset_type == 'TCGA_WGS':
-             taxonomy = pd.read_table(_taxonomy_filename, header=0, 
-                                      index_col=1, sep='\t')
-        else:
-            taxonomy = pd.read_table(_taxonomy_filename, header=0, 
-                                     index_col=0, sep='\t')
+    if taxonomy is not None:
         occurr_freqs = occurr_freqs.join(taxonomy)
-        
-    # Fit the neutral model
-    params = Parameters()
-    params.add('N', value=n_reads, vary=False)
-    params.add('m', value=0.5, min=0.0, max=1.0)
-    beta_model = Model(beta_cdf)
-    beta_fit = beta_model.fit(occurr_freqs['occurrence'], params, 
-                              p=occurr_freqs['mean_abundance'])
-
-    # Report fit statistics
+    return(occurr_freqs)
+
+def _report_fit(occurr_freqs, beta_fit):
+    '''Prints the fit report, returns R^2'''
     r_square = 1.0 - np.sum(np.square(occurr_freqs['occurrence'] - beta_fit.best_fit))/np.sum(np.square(occurr_freqs['occurrence'] - np.mean(occurr_freqs['occurrence'])))
-    file.write (fit_report(beta_fit))
-    file.write ('\n R^2 = ' + '{:1.2f}'.format(r_square))
-    print(fit_report(beta_fit))
+    print(neutral_fit_report(beta_fit))
     print('\n R^2 = ' + '{:1.2f}'.format(r_square))
-    print('=========================================================')
+    return(r_square)
 
+def _neutral_prediction(occurr_freqs, beta_fit, n_samples):
+    '''Adds the neutral prediction and its confidence interval to 
+        occurr_freqs and the neutral curve to beta_fit; the non-neutral 
+        OTUs are NeufitResult.non_neutral'''
+    # Neutral curve on an x grid, cached on beta_fit for plots and exports
+    neutral_curve(beta_fit, n_samples, min(occurr_freqs['mean_abundance']))
+    
     # Adding the neutral prediction to results
     occurr_freqs['predicted_occurrence'] = beta_fit.best_fit
     occurr_freqs['lower_conf_int'], occurr_freqs['upper_conf_int'] = proportion_confint(occurr_freqs['predicted_occurrence']*n_samples, n_samples, alpha=0.05, method='wilson')
 
-    # Save non-neutral otus (here simply determined by lying outside the confidence intervals)
-    above = occurr_freqs[occurr_freqs['occurrence'] > occurr_freqs['upper_conf_int']]
-    below = occurr_freqs[occurr_freqs['occurrence'] < occurr_freqs['lower_conf_int']]
-    
-    #Create orginal non neutral output file from Neufit
-    if full_non_neutral == True:
-        pd.concat((above, below)).to_csv(str(file_header) + \
-                                         '_FullNonNeutral.csv')
+fit_table_extensions = {'parquet': 'parquet', 'feather': 'feather', 
+                        'hdf5': 'h5'}
+#File extension of every save_format
+
+def fit_parameters(beta_fit, r_square, n_reads, n_samples):
+    '''Fit parameters of a neufit run as a plain dict
     
-    file.close()
+    Parameters
+    ----------
+    beta_fit: lmfit.model.ModelResult or NeutralFitResult object
+        The neutral fit.
+    r_square: float
+        R^2 value of the fit of data to neutral curve.
+    n_reads: int
+        Total number of reads.
+    n_samples: int
+        Total number of samples.
     
-    return(occurr_freqs, n_reads, n_samples, r_square, beta_fit, file_header)
\ No newline at end of file
+    Returns
+    -------
+    dict
+        m, its stderr, N, r_square, n_reads, n_samples, n_otus, chisqr,
+        redchi, method, with the ml engine loglik and the 
+        profile-likelihood interval m_profile and, with a bootstrap, its 
+        intervals.
+    '''
+    if hasattr(beta_fit, 'params'): #lmfit ModelResult
+        stderr = beta_fit.params['m'].stderr
+    else:
+        stderr = beta_fit.stderr
+    parameters = {'m': float(beta_fit.best_values['m']),
+                  'm_stderr': None if stderr is None else float(stderr),
+                  'N': float(beta_fit.best_values['N']),
+                  'r_square': float(r_square),
+                  'n_reads': int(n_reads),
+                  'n_samples': int(n_samples),
+                  'n_otus': int(beta_fit.ndata),
+                  'chisqr': float(beta_fit.chisqr),
+                  'redchi': float(beta_fit.redchi),
+                  'method': str(beta_fit.method)}
+    if getattr(beta_fit, 'm_interval', None) is not None:
+        parameters['loglik'] = float(beta_fit.loglik)
+        parameters['m_profile'] = [float(beta_fit.m_interval[0]), 
+                                   float(beta_fit.m_interval[1])]
+    if hasattr(beta_fit, 'bootstrap'):
+        m_replicates, intervals = beta_fit.bootstrap
+        parameters['bootstrap_replicates'] = len(m_replicates)
+        for method, row in intervals.iterrows():
+            parameters['m_' + method] = [float(row['lower']), 
+                                         float(row['upper'])]
+    return(parameters)
+
+def _check_save_format(save_format):
+    '''ValueError for an unknown save_format, ImportError if its writer 
+        is missing, so a run fails before anything is written'''
+    if save_format is None:
+        return
+    if save_format not in fit_table_extensions:
+        raise ValueError('save_format must be one of ' + 
+                         ', '.join(fit_table_extensions) + ', not ' + 
+                         str(save_format))
+    if save_format in ('parquet', 'feather'):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("save_format '" + save_format + 
+                              "' needs pyarrow")
+
+def _save_fit_table(occurr_freqs, beta_fit, r_square, n_reads, n_samples, 
+                    file_header, save_format):
+    '''Writes [name]_NeutralFit.[ext] if a save_format is given'''
+    if save_format is None:
+        return(None)
+    _check_save_format(save_format)
+    fn = str(file_header) + '_NeutralFit.' + fit_table_extensions[save_format]
+    return(write_fit_table(occurr_freqs, 
+                           fit_parameters(beta_fit, r_square, n_reads, 
+                                          n_samples), fn))
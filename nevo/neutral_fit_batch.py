@@ -0,0 +1,286 @@
+import os
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from biom import load_table
+from nevo.utils import load_abundances, cohort_columns
+from nevo.neutral_fit import neufit, _load_taxonomy
+
+manifest_parameters = {'arg_ignore_level': 0, 'arg_rarefaction_level': 0,
+                       'seed': None, 'engine': 'lmfit'}
+#Parameters a manifest can set per job, with their defaults
+
+manifest_columns = ('name', 'data', 'taxonomy', 'metadata', 'sample_column',
+                    'cohort', 'dataset_type') + tuple(manifest_parameters)
+#Columns of the job table of read_manifest
+
+#Loaded tables, metadata and taxonomies of the current worker process,
+#kept warm across jobs (least recently used dropped), see _warm
+_batch_state = {'loaded': OrderedDict(), 'max_tables': 4,
+                'output_path': None, 'profile': False}
+
+def _missing(value):
+    return(value is None or (isinstance(value, float) and np.isnan(value))
+           or (isinstance(value, str) and value == ''))
+
+def read_manifest(fn):
+    '''Reads a neufit-batch manifest into a table with one row per job
+
+    Parameters
+    ----------
+    fn: str, path
+        A YAML (.yaml/.yml, needs PyYAML: the yaml extra of nevo) or
+        TSV manifest.
+
+        The YAML manifest crosses datasets x cohorts x parameter sets:
+
+            dataset_type: batch            # optional
+            datasets:
+              - name: tcga_cancer
+                data: cancer.biom          # biom, _data.csv or .csv.gz
+                taxonomy: taxonomy.tsv     # optional
+                metadata: meta.tsv         # needed for cohorts
+                sample_column: sample_name # optional
+                cohorts:                   # optional, default whole table
+                  e: {primary_site: Esophagus}
+                  hn: "primary_site == 'Head and Neck'"
+            parameters:                    # optional
+              - {name: s1, seed: 1, engine: fast}
+              - {name: s2, seed: 2, engine: fast}
+
+        The TSV manifest has one row per job and the columns of
+        manifest_columns (only data is required); its cohort column is
+        a query string on the metadata, see cohort_columns.
+
+    Returns
+    -------
+    pandas df
+        One row per job, columns manifest_columns.
+    '''
+    if str(fn).lower().endswith(('.yaml', '.yml')):
+        import yaml
+        with open(fn) as f:
+            manifest = yaml.safe_load(f)
+        parameter_sets = manifest.get('parameters') or [{}]
+        rows = []
+        for d, dataset in enumerate(manifest['datasets']):
+            dataset_name = dataset.get('name', 'dataset' + str(d))
+            cohorts = dataset.get('cohorts') or {None: None}
+            for cohort, spec in cohorts.items():
+                for p, parameters in enumerate(parameter_sets):
+                    parameters = dict(parameters)
+                    name = [dataset_name]
+                    if cohort is not None:
+                        name.append(str(cohort))
+                    parameter_name = parameters.pop('name', None)
+                    if parameter_name is None and len(parameter_sets) > 1:
+                        parameter_name = 'p' + str(p)
+                    if parameter_name is not None:
+                        name.append(str(parameter_name))
+                    row = {'name': '_'.join(name),
+                           'data': dataset['data'],
+                           'taxonomy': dataset.get('taxonomy'),
+                           'metadata': dataset.get('metadata'),
+                           'sample_column': dataset.get('sample_column'),
+                           'cohort': spec,
+                           'dataset_type': manifest.get('dataset_type')}
+                    row.update(parameters)
+                    rows.append(row)
+        jobs = pd.DataFrame(rows)
+    else:
+        jobs = pd.read_table(fn, sep='\t', dtype=object)
+
+    if 'data' not in jobs.columns:
+        raise ValueError('The manifest has no data column')
+    for column in manifest_columns:
+        if column not in jobs.columns:
+            jobs[column] = None
+    unknown = set(jobs.columns) - set(manifest_columns)
+    if unknown:
+        raise ValueError('Unknown manifest columns: ' +
+                         ', '.join(sorted(unknown)))
+    jobs = jobs[list(manifest_columns)].astype(object)
+
+    # Defaults and types of the job parameters
+    for i, job in jobs.iterrows():
+        if _missing(job['name']):
+            jobs.at[i, 'name'] = os.path.basename(str(job['data'])
+                                                  ).split('.')[0]
+        if _missing(job['sample_column']):
+            jobs.at[i, 'sample_column'] = 'sample_name'
+        if _missing(job['dataset_type']):
+            jobs.at[i, 'dataset_type'] = 'batch'
+        for parameter, default in manifest_parameters.items():
+            value = job[parameter]
+            if _missing(value):
+                value = default
+            elif parameter != 'engine':
+                value = int(value)
+            jobs.at[i, parameter] = value
+        if not _missing(job['cohort']) and _missing(job['metadata']):
+            raise ValueError('Job ' + str(jobs.at[i, 'name']) +
+                             ' has a cohort but no metadata')
+    if jobs['name'].duplicated().any():
+        raise ValueError('Duplicate job names: ' +
+                         ', '.join(jobs['name'][jobs['name'].duplicated()]))
+    return(jobs)
+
+def _init_batch_worker(output_path, max_tables, profile = False):
+    _batch_state['loaded'].clear()
+    _batch_state['output_path'] = output_path
+    _batch_state['max_tables'] = max_tables
+    _batch_state['profile'] = profile
+
+def _warm(kind, path, dataset_type = None):
+    '''Table, metadata or taxonomy of path, loaded at most once per
+        worker while it stays among the max_tables most recently used'''
+    loaded = _batch_state['loaded']
+    key = (kind, path, dataset_type)
+    if key in loaded:
+        loaded.move_to_end(key)
+        return(loaded[key])
+    if kind == 'table':
+        if str(path).lower().endswith('.biom'):
+            matrix, obs_ids, sample_ids = load_abundances(load_table(path))
+        else:
+            matrix, obs_ids, sample_ids = load_abundances(path)
+        value = (matrix.tocsc(), obs_ids, sample_ids)
+    elif kind == 'metadata':
+        value = pd.read_table(path, sep='\t')
+    else:
+        value = _load_taxonomy(path, dataset_type)
+    loaded[key] = value
+    while len(loaded) > _batch_state['max_tables']:
+        loaded.popitem(last=False)
+    return(value)
+
+def _run_job(job):
+    '''Runs neufit for one job of the manifest, returns its summary row'''
+    row = {'name': job['name'], 'data': job['data']}
+    try:
+        matrix, obs_ids, sample_ids = _warm('table', job['data'])
+        if not _missing(job['cohort']):
+            meta = _warm('metadata', job['metadata'])
+            idx = cohort_columns(sample_ids, meta, {'cohort': job['cohort']},
+                                 job['sample_column'])['cohort']
+            data = (matrix[:, idx], obs_ids, sample_ids[idx])
+        else:
+            data = (matrix, obs_ids, sample_ids)
+        taxonomy = None
+        if not _missing(job['taxonomy']):
+            taxonomy = _warm('taxonomy', job['taxonomy'],
+                             job['dataset_type'])
+
+        result = neufit(job['name'], job['dataset_type'], data, taxonomy,
+                        arg_ignore_level=job['arg_ignore_level'],
+                        arg_rarefaction_level=job['arg_rarefaction_level'],
+                        seed=job['seed'], engine=job['engine'],
+                        profile=_batch_state['profile'])
+        result.write(_batch_state['output_path'])
+        row.update({'m': result.beta_fit.best_values['m'],
+                    'r_square': result.r_square,
+                    'n_samples': result.n_samples,
+                    'n_otus': len(result.occurr_freqs),
+                    'n_reads': result.n_reads,
+                    'file_header': result.file_header, 'error': None})
+        if _batch_state['profile']:
+            row.update({'seconds': result.profile['total_seconds'],
+                        'peak_rss_mb': result.profile['peak_rss_mb']})
+    except Exception as e: #One failing job does not stop the batch
+        print('job ' + str(job['name']) + ' failed: ' + repr(e))
+        row.update({'m': np.nan, 'r_square': np.nan, 'n_samples': np.nan,
+                    'n_otus': np.nan, 'n_reads': np.nan,
+                    'file_header': None, 'error': repr(e)})
+    return(row)
+
+def _run_jobs(jobs):
+    '''Runs a list of jobs (of one data file) in order, see _run_job'''
+    return([_run_job(job) for job in jobs])
+
+def job_size(job):
+    '''Size estimate used for largest-job-first scheduling, the size of
+        the data file'''
+    try:
+        return(os.path.getsize(job['data']))
+    except OSError:
+        return(0)
+
+def _file_tasks(records, n_workers):
+    '''Groups the jobs into tasks by data file, largest total first
+
+    Every data file is one task, so it is loaded by one worker only.
+    Only when there are fewer files than workers are the jobs of a file
+    split into up to n_workers//n_files tasks, so no worker idles.
+    '''
+    files = OrderedDict()
+    for job in records:
+        files.setdefault(str(job['data']), []).append(job)
+    n_splits = max(1, n_workers//len(files)) if files else 1
+    tasks = []
+    for file_jobs in files.values():
+        for split in np.array_split(np.arange(len(file_jobs)),
+                                    min(n_splits, len(file_jobs))):
+            tasks.append([file_jobs[i] for i in split])
+    sizes = [sum(job_size(job) for job in task) for task in tasks]
+    order = sorted(range(len(tasks)), key=lambda i: -sizes[i])
+    return([tasks[i] for i in order])
+
+def run_batch(jobs, output_path = None, n_jobs = None, max_tables = 4,
+              summary_fn = None, profile = False):
+    '''Runs the jobs of a manifest on a process pool
+
+    The jobs of one data file are one task (_file_tasks), so every table
+    is loaded by one worker instead of by all of them; tasks are
+    submitted largest first (job_size) so the large ones do not end up
+    last. Every worker keeps its max_tables most recently used tables,
+    metadata and taxonomies in memory across jobs.
+
+    Parameters
+    ----------
+    jobs: pandas df
+        Job table, see read_manifest.
+    output_path: str, path, optional
+        Root directory of the neufit outputs, default neufit_output_path.
+    n_jobs: int, optional
+        Number of worker processes; default uses all cores, 1 runs the
+        jobs in this process.
+    max_tables: int, optional
+        Number of loaded files every worker keeps warm.
+    summary_fn: str, path, optional
+        If given, the summary is also written there as TSV.
+    profile: bool, optional
+        If 'True', every job writes its [name]_profile.json, see neufit;
+        the summary gets the seconds and peak RSS (MB) of every job.
+
+    Returns
+    -------
+    summary: pandas df
+        One row per job, in manifest order, indexed by name: data, m,
+        r_square, n_samples, n_otus, n_reads, file_header and the error
+        of failed jobs, followed by the job parameters.
+    '''
+    records = jobs.to_dict('records')
+    n_workers = n_jobs if n_jobs is not None else (os.cpu_count() or 1)
+    tasks = _file_tasks(records, n_workers)
+
+    if n_jobs == 1:
+        _init_batch_worker(output_path, max_tables, profile)
+        rows = [row for task in tasks for row in _run_jobs(task)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_batch_worker,
+                                 initargs=(output_path, max_tables,
+                                           profile)) as pool:
+            rows = [row for task_rows in pool.map(_run_jobs, tasks)
+                    for row in task_rows]
+
+    summary = pd.DataFrame(rows).set_index('name').loc[jobs['name']]
+    parameters = jobs.set_index('name')[['cohort', 'dataset_type'] +
+                                        list(manifest_parameters)]
+    parameters['cohort'] = parameters['cohort'].map(
+        lambda spec: None if _missing(spec) else str(spec))
+    summary = summary.join(parameters)
+    if summary_fn is not None:
+        summary.to_csv(summary_fn, sep='\t')
+    return(summary)
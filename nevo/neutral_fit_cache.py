@@ -0,0 +1,179 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+from scipy import sparse
+import nevo
+
+default_cache_dir = os.environ.get('NEVO_CACHE_DIR',
+                                   os.path.join(os.path.expanduser('~'),
+                                                '.cache', 'nevo'))
+#location of the on-disk cache of pipeline stages
+
+cached_sources = ('utils.py', 'neutral_fit.py', 'neutral_fit_utils.py')
+#Modules whose source is part of the code version of every cache key
+
+@lru_cache(maxsize=None)
+def code_version():
+    '''nevo version plus a digest of the modules computing cached stages,
+        so editing them invalidates the cache'''
+    digest = hashlib.sha256(nevo.__version__.encode())
+    for name in cached_sources:
+        with open(os.path.join(os.path.dirname(nevo.__file__), name),
+                  'rb') as f:
+            digest.update(f.read())
+    return(digest.hexdigest())
+
+@lru_cache(maxsize=256)
+def _file_digest(path, size, mtime):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return(digest.hexdigest())
+
+def content_digest(value):
+    '''Hex digest of the content of a stage input
+
+    Parameters
+    ----------
+    value: str, path, pandas df/index, numpy array, scipy sparse matrix,
+    tuple/list, dict or scalar
+        Paths are hashed by file content (remembered per size and mtime
+        within the process), tables by their values, index and columns.
+
+    Returns
+    -------
+    str
+        sha256 hex digest.
+    '''
+    digest = hashlib.sha256()
+    if isinstance(value, (str, os.PathLike)) and os.path.isfile(value):
+        stat = os.stat(value)
+        digest.update(b'file')
+        digest.update(_file_digest(os.path.abspath(value), stat.st_size,
+                                   stat.st_mtime_ns).encode())
+    elif isinstance(value, pd.DataFrame):
+        digest.update(b'frame')
+        digest.update(pd.util.hash_pandas_object(value, index=True).values
+                      .tobytes())
+        digest.update(content_digest(value.columns).encode())
+    elif isinstance(value, (pd.Index, pd.Series)):
+        digest.update(b'index')
+        digest.update(pd.util.hash_pandas_object(value, index=False).values
+                      .tobytes())
+    elif sparse.issparse(value):
+        value = sparse.csr_matrix(value)
+        digest.update(b'sparse' + repr(value.shape).encode() +
+                      value.dtype.str.encode())
+        for array in (value.data, value.indices, value.indptr):
+            digest.update(np.ascontiguousarray(array).tobytes())
+    elif isinstance(value, np.ndarray) and value.dtype != object:
+        digest.update(b'array' + repr(value.shape).encode() +
+                      value.dtype.str.encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (tuple, list)):
+        digest.update(b'sequence')
+        for item in value:
+            digest.update(content_digest(item).encode())
+    elif isinstance(value, dict):
+        digest.update(b'dict')
+        for k in sorted(value, key=repr):
+            digest.update(repr(k).encode())
+            digest.update(content_digest(value[k]).encode())
+    elif isinstance(value, np.ndarray):
+        digest.update(content_digest(pd.Index(value)).encode())
+    else:
+        digest.update(repr(value).encode())
+    return(digest.hexdigest())
+
+class StageCache:
+    '''Content-addressed on-disk cache of pipeline stages
+
+    Every stage ('conversion', 'statistics', 'fit', ...) is stored in its
+    own directory under root as one pickle per key. Keys are digests of
+    the stage name, the code version and the stage inputs, so a result
+    is reused only for identical inputs and code. Hits refresh the file
+    time; when the cache grows beyond max_bytes the least recently used
+    entries are evicted.
+
+    Parameters
+    ----------
+    root: str, path, optional
+        Cache directory, default is default_cache_dir.
+    max_bytes: int, optional
+        Size bound of the whole cache, default 2 GiB.
+    '''
+
+    def __init__(self, root = None, max_bytes = 2*1024**3):
+        self.root = default_cache_dir if root is None else str(root)
+        self.max_bytes = max_bytes
+
+    def key(self, stage, *inputs):
+        '''Cache key of a stage for the given inputs'''
+        digest = hashlib.sha256((stage + '\n' + code_version()).encode())
+        for value in inputs:
+            digest.update(content_digest(value).encode())
+        return(digest.hexdigest())
+
+    def _path(self, stage, key):
+        return(os.path.join(self.root, stage, key + '.pkl'))
+
+    def get(self, stage, key):
+        '''Cached value of the stage, or None on a miss'''
+        path = self._path(stage, key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return(None)
+        os.utime(path) #Most recently used
+        return(value)
+
+    def put(self, stage, key, value):
+        '''Stores the value of the stage, then evicts down to max_bytes'''
+        path = self._path(stage, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        self.evict()
+
+    def cached(self, stage, key, compute):
+        '''Cached value of the stage, calling compute() on a miss'''
+        value = self.get(stage, key)
+        if value is None:
+            value = compute()
+            self.put(stage, key, value)
+        return(value)
+
+    def entries(self):
+        '''All cache entries as a pandas df (path, bytes, last used),
+            least recently used first'''
+        rows = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith('.pkl'):
+                    path = os.path.join(dirpath, name)
+                    stat = os.stat(path)
+                    rows.append((path, stat.st_size, stat.st_mtime))
+        entries = pd.DataFrame(rows, columns=['path', 'bytes', 'last_used'])
+        return(entries.sort_values('last_used', ignore_index=True))
+
+    def evict(self):
+        '''Removes least recently used entries until within max_bytes'''
+        entries = self.entries()
+        excess = entries['bytes'].sum() - self.max_bytes
+        for path, size in zip(entries['path'], entries['bytes']):
+            if excess <= 0:
+                break
+            os.remove(path)
+            excess -= size
+
+    def clear(self):
+        '''Removes every entry'''
+        for path in self.entries()['path']:
+            os.remove(path)
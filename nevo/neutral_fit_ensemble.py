@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from statsmodels.stats.proportion import proportion_confint
+from nevo.neutral_fit_utils import rarefy, occurrence_stats, fit_m
+from nevo.utils import load_abundances
+
+#Abundance table and depth of the current worker process, set once per
+#worker by _init_replicate_worker so the table is not sent with every task
+_replicate_state = {}
+
+def _init_replicate_worker(abundances, depth):
+    _replicate_state['abundances'] = abundances
+    _replicate_state['depth'] = depth
+
+def _rarefy_and_fit(seed):
+    '''One replicate: rarefies the worker's table with its own RNG stream,
+        fits m and classifies every OTU
+
+    Parameters
+    ----------
+    seed: numpy SeedSequence
+        Independent seed of this replicate.
+
+    Returns
+    -------
+    m, stderr, r_square: float
+        Fit of this replicate (fast engine).
+    n_otus: int
+        Number of OTUs left after rarefaction.
+    above, below: numpy array of bool
+        Per OTU of the input table, whether it lies above/below the
+        Wilson confidence interval of the neutral prediction; OTUs lost
+        to rarefaction are neither.
+    '''
+    abundances = _replicate_state['abundances']
+    depth = _replicate_state['depth']
+
+    rarefied = rarefy(abundances, depth, seed=np.random.default_rng(seed))
+    n_samples = rarefied.shape[1]
+    mean_abundance, occurrence = occurrence_stats(rarefied, depth)
+    present = occurrence > 0
+
+    beta_fit = fit_m(mean_abundance[present], occurrence[present], depth)
+    observed = occurrence[present]
+    r_square = 1.0 - np.sum(np.square(observed - beta_fit.best_fit))/ \
+        np.sum(np.square(observed - np.mean(observed)))
+    lower, upper = proportion_confint(beta_fit.best_fit*n_samples, n_samples,
+                                      alpha=0.05, method='wilson')
+
+    above = np.zeros(len(occurrence), dtype=bool)
+    below = np.zeros(len(occurrence), dtype=bool)
+    above[present] = observed > upper
+    below[present] = observed < lower
+    return(beta_fit.best_values['m'], beta_fit.stderr, r_square,
+           int(present.sum()), above, below)
+
+def neufit_ensemble(_data_filename, n_replicates = 10, arg_ignore_level = 0,
+                    arg_rarefaction_level = 0, seed = None, n_jobs = None):
+    '''Runs K independent rarefaction-and-fit replicates of neufit
+
+    Every replicate rarefies the same table with its own RNG stream,
+    spawned from seed with numpy's SeedSequence, and fits m with the fast
+    engine (fit_m). The replicates run on a process pool; each worker
+    receives the table once, so throughput scales close to linearly with
+    the number of cores. Results only depend on seed, not on n_jobs.
+
+    Parameters
+    ----------
+    _data_filename: str, path, biom Table, pandas df or tuple
+        The OTU abudance table, anything accepted by load_abundances.
+    n_replicates: int, optional
+        Number of rarefaction replicates K.
+    arg_ignore_level: int, optional
+        Ignores OTUs below this abudance threshold, as in neufit.
+    arg_rarefaction_level: int, optional
+        Sets the rarefaction level, as in neufit. Leaving the default of
+        0 changes this value to the highest possible uniform read depth.
+    seed: int, optional
+        Seed from which the replicate RNG streams are spawned; default
+        is an unseeded run.
+    n_jobs: int, optional
+        Number of worker processes; default uses all cores, 1 runs the
+        replicates in this process.
+
+    Returns
+    -------
+    replicates: pandas df
+        One row per replicate: m, stderr, r_square, n_otus.
+    otu_frequencies: pandas df
+        Per OTU, the fraction of replicates in which it was classified
+        non-neutral (non_neutral_frequency) and above/below the neutral
+        confidence interval (above_frequency, below_frequency).
+    '''
+    abundances, otu_ids, sample_ids = load_abundances(_data_filename)
+    keep = np.asarray(abundances.sum(1)).ravel() > arg_ignore_level
+    abundances, otu_ids = abundances[keep].tocsc(), otu_ids[keep]
+    sample_reads = np.asarray(abundances.sum(0)).ravel()
+
+    # Determine uniform read depth
+    if arg_rarefaction_level == 0 or arg_rarefaction_level > max(sample_reads):
+        arg_rarefaction_level = min(sample_reads)
+    depth = int(arg_rarefaction_level)
+
+    seeds = np.random.SeedSequence(seed).spawn(n_replicates)
+    if n_jobs == 1:
+        _init_replicate_worker(abundances, depth)
+        results = [_rarefy_and_fit(s) for s in seeds]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_replicate_worker,
+                                 initargs=(abundances, depth)) as pool:
+            results = list(pool.map(_rarefy_and_fit, seeds))
+
+    replicates = pd.DataFrame([r[:4] for r in results],
+                              columns=['m', 'stderr', 'r_square', 'n_otus'])
+    replicates.index.name = 'replicate'
+    above = np.mean([r[4] for r in results], axis=0)
+    below = np.mean([r[5] for r in results], axis=0)
+    otu_frequencies = pd.DataFrame({'non_neutral_frequency': above + below,
+                                    'above_frequency': above,
+                                    'below_frequency': below},
+                                   index=otu_ids)
+
+    print(ensemble_report(replicates))
+    print('=========================================================')
+    return(replicates, otu_frequencies)
+
+def ensemble_report(replicates):
+    '''Summary of the spread of m and R^2 across rarefaction replicates'''
+    lines = [str(len(replicates)) + ' rarefaction replicates']
+    for column, label in (('m', 'm'), ('r_square', 'R^2')):
+        values = replicates[column]
+        lines.append('{}: mean = {:.6g}, sd = {:.3g}, 2.5% = {:.6g}, '
+                     '97.5% = {:.6g}'.format(label, values.mean(),
+                                             values.std(),
+                                             values.quantile(0.025),
+                                             values.quantile(0.975)))
+    return('\n'.join(lines))
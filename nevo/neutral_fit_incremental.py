@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from nevo.utils import load_abundances
+from nevo.neutral_fit_utils import rarefy
+
+class StatisticsStore:
+    '''Sufficient statistics of neufit, updated one batch of samples at a
+        time
+
+    neufit only needs, per OTU, the sum of its rarefied reads and the
+    number of samples it occurs in, plus n_samples and the rarefaction
+    depth. The store keeps these and updates them as batches of samples
+    are added (rarefied on their own, with the depth of the store) or
+    removed, so a refit costs time proportional to the batch instead of
+    the whole table. The rarefied columns are kept as well, one sparse
+    block per added batch, so samples can be removed again and the
+    bootstrap has its table. Pass the store to neufit as the table to
+    refit.
+
+    Parameters
+    ----------
+    depth: int
+        Rarefaction depth of every sample; samples with fewer reads are
+        dropped when added.
+
+    Notes
+    -----
+    neufit's arg_ignore_level filters OTUs by their total over the whole
+    table, which changes with every batch; the store keeps every OTU.
+    '''
+
+    def __init__(self, depth):
+        self.depth = int(depth)
+        self.otu_ids = pd.Index([], dtype=object)
+        self.row_sums = np.zeros(0, dtype=np.int64)
+        self.row_nonzero = np.zeros(0, dtype=np.int64)
+        self._blocks = {} #Batch number -> (sample ids, rarefied csc block)
+        self._sample_block = {} #Sample id -> batch number
+        self._next_block = 0
+
+    @classmethod
+    def from_table(cls, data, depth = 0, seed = None):
+        '''Store of a whole table, rarefied like neufit
+
+        Parameters
+        ----------
+        data: str, path, biom Table, pandas df or tuple
+            Anything accepted by load_abundances.
+        depth: int, optional
+            Rarefaction depth; the default 0 uses the smallest sample
+            depth, like neufit's arg_rarefaction_level.
+        seed: int, optional
+            Seed of the rarefaction.
+        '''
+        data = load_abundances(data)
+        if depth == 0:
+            depth = np.asarray(data[0].sum(0)).ravel().min()
+        store = cls(depth)
+        store.add(data, seed=seed)
+        return(store)
+
+    @property
+    def n_samples(self):
+        return(len(self._sample_block))
+
+    @property
+    def sample_ids(self):
+        '''Ids of the samples in the store, in the order they were added'''
+        return(pd.Index([s for b in sorted(self._blocks)
+                         for s in self._blocks[b][0]]))
+
+    def _row_counts(self, block):
+        '''Per-OTU read sums and occurrences of a rarefied csc block'''
+        n_otus = len(self.otu_ids)
+        sums = np.bincount(block.indices, weights=block.data,
+                           minlength=n_otus).astype(np.int64)
+        nonzero = np.bincount(block.indices[block.data > 0],
+                              minlength=n_otus).astype(np.int64)
+        return(sums, nonzero)
+
+    def add(self, data, seed = None):
+        '''Rarefies a batch of new samples and merges it into the store
+
+        Parameters
+        ----------
+        data: str, path, biom Table, pandas df or tuple
+            The new samples, anything accepted by load_abundances; OTUs
+            not yet in the store are added.
+        seed: int, numpy Generator, optional
+            Seed of the rarefaction of this batch.
+
+        Returns
+        -------
+        pandas Index
+            Ids of the samples added, without the dropped ones.
+        '''
+        matrix, otu_ids, sample_ids = load_abundances(data)
+        known = sample_ids[sample_ids.isin(list(self._sample_block))]
+        if len(known) or sample_ids.duplicated().any():
+            raise ValueError('Samples already in the store: ' +
+                             ', '.join(map(str, known[:5])))
+        depths = np.asarray(matrix.sum(0)).ravel()
+        for sample, reads in zip(sample_ids[depths < self.depth],
+                                 depths[depths < self.depth]):
+            print('dropping sample ' + str(sample) + ' with ' +
+                  str(reads) + ' reads < ' + str(self.depth))
+        sample_ids = sample_ids[depths >= self.depth]
+        rarefied = rarefy(matrix, self.depth, seed=seed)
+
+        # Rows of the batch in the OTU order of the store
+        new = otu_ids[~otu_ids.isin(self.otu_ids)]
+        if len(new):
+            self.otu_ids = self.otu_ids.append(new)
+            self.row_sums = np.concatenate((self.row_sums,
+                                            np.zeros(len(new), np.int64)))
+            self.row_nonzero = np.concatenate((self.row_nonzero,
+                                               np.zeros(len(new), np.int64)))
+        rows = self.otu_ids.get_indexer(otu_ids)
+        block = sparse.csc_matrix((rarefied.data, rows[rarefied.indices],
+                                   rarefied.indptr),
+                                  shape=(len(self.otu_ids), len(sample_ids)))
+        block.sort_indices()
+
+        sums, nonzero = self._row_counts(block)
+        self.row_sums += sums
+        self.row_nonzero += nonzero
+        self._blocks[self._next_block] = (sample_ids, block)
+        for sample in sample_ids:
+            self._sample_block[sample] = self._next_block
+        self._next_block += 1
+        return(sample_ids)
+
+    def remove(self, sample_ids):
+        '''Removes samples from the store, KeyError if any is missing'''
+        sample_ids = pd.Index(sample_ids)
+        missing = sample_ids[~sample_ids.isin(list(self._sample_block))]
+        if len(missing):
+            raise KeyError(str(len(missing)) + ' samples are not in the '
+                           'store, e.g. ' + str(list(missing[:5])))
+        batches = pd.Series([self._sample_block[s] for s in sample_ids])
+        for b, samples in sample_ids.groupby(batches.values).items():
+            ids, block = self._blocks[b]
+            drop = ids.isin(samples)
+            sums, nonzero = self._row_counts(block[:, np.flatnonzero(drop)])
+            self.row_sums[:len(sums)] -= sums
+            self.row_nonzero[:len(nonzero)] -= nonzero
+            if drop.all():
+                del self._blocks[b]
+            else:
+                self._blocks[b] = (ids[~drop],
+                                   block[:, np.flatnonzero(~drop)])
+            for sample in samples:
+                del self._sample_block[sample]
+
+    def statistics(self):
+        '''Mean relative abundance and occurrence frequency of the OTUs
+            present in the stored samples
+
+        Returns
+        -------
+        mean_relative_abundance, occurrence_frequency: numpy array
+            As occurrence_stats of the rarefied table.
+        otu_ids: pandas Index
+            OTU ids of both.
+        '''
+        if self.n_samples == 0:
+            raise ValueError('The store has no samples')
+        present = self.row_nonzero > 0
+        return((1.0*self.row_sums[present])/self.depth/self.n_samples,
+               (1.0*self.row_nonzero[present])/self.n_samples,
+               self.otu_ids[present])
+
+    def _stacked(self):
+        '''All batches as one csc_matrix over every OTU of the store;
+            older batches are padded with the OTUs added after them'''
+        n_otus = len(self.otu_ids)
+        blocks = [sparse.csc_matrix((block.data, block.indices,
+                                     block.indptr),
+                                    shape=(n_otus, block.shape[1]))
+                  for ids, block in (self._blocks[b]
+                                     for b in sorted(self._blocks))]
+        if not blocks:
+            return(sparse.csc_matrix((n_otus, 0), dtype=np.int64))
+        return(sparse.hstack(blocks, format='csc'))
+
+    def table(self):
+        '''The rarefied table of the OTUs present as a csc_matrix, OTUs
+            as rows and samples (sample_ids) as columns'''
+        return(self._stacked()[self.row_nonzero > 0])
+
+    def save(self, fn):
+        '''Writes the store as one .npz file
+
+        OTU and sample ids keep their type: string and numeric ids are
+        stored as such, ids of mixed or other types are pickled.
+        '''
+        matrix = self._stacked()
+        with open(fn, 'wb') as f:
+            np.savez_compressed(f, depth=self.depth,
+                                otu_ids=_id_array(self.otu_ids),
+                                sample_ids=_id_array(self.sample_ids),
+                                row_sums=self.row_sums,
+                                row_nonzero=self.row_nonzero,
+                                data=matrix.data, indices=matrix.indices,
+                                indptr=matrix.indptr)
+
+    @classmethod
+    def load(cls, fn):
+        '''Reads a store written by save, as a single batch; pickled
+            ids are only read from trusted files'''
+        with np.load(fn, allow_pickle=True) as f:
+            store = cls(int(f['depth']))
+            store.otu_ids = _id_index(f['otu_ids'])
+            store.row_sums = f['row_sums']
+            store.row_nonzero = f['row_nonzero']
+            sample_ids = _id_index(f['sample_ids'])
+            block = sparse.csc_matrix((f['data'], f['indices'], f['indptr']),
+                                      shape=(len(store.otu_ids),
+                                             len(sample_ids)))
+        if len(sample_ids):
+            store._blocks[0] = (sample_ids, block)
+            store._sample_block = dict.fromkeys(sample_ids, 0)
+            store._next_block = 1
+        return(store)
+
+def _id_array(ids):
+    '''Ids as a numpy array for np.savez: str if all ids are str, the
+        numeric dtype of numeric ids, else object (pickled)'''
+    ids = pd.Index(ids)
+    if pd.api.types.is_numeric_dtype(ids.dtype) and \
+            not pd.api.types.is_bool_dtype(ids.dtype):
+        return(ids.to_numpy())
+    values = ids.to_numpy(dtype=object)
+    if all(isinstance(i, str) for i in values):
+        return(values.astype(str))
+    return(values)
+
+def _id_index(values):
+    '''Inverse of _id_array'''
+    if values.dtype.kind in 'OU':
+        return(pd.Index(values, dtype=object))
+    return(pd.Index(values))
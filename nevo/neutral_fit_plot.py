@@ -2,12 +2,22 @@ import os
 import numpy as np
 from scipy.stats import beta 
 from datetime import datetime
-from statsmodels.stats.proportion import proportion_confint 
-from matplotlib import pyplot
-from math import log10
-from nevo.neutral_fit_utils import beta_cdf
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from nevo.neutral_fit_utils import neutral_curve
 
-def neufit_plot(occurr_freqs, n_reads, n_samples, r_square, beta_fit, file_header):
+def new_axes():
+    '''New figure and axes on the non-interactive Agg canvas
+    
+    The figure is not registered with pyplot, so plots never share state
+    and can be drawn from several threads or processes at once.
+    '''
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return(fig.add_subplot())
+
+def neufit_plot(occurr_freqs, n_reads, n_samples, r_square, beta_fit, 
+                file_header, ax = None):
     '''Creates the neutral evolution png plot 
     
     Modified by: Caitlin Guccione 08-25-2021
@@ -60,14 +70,16 @@ def neufit_plot(occurr_freqs, n_reads, n_samples, r_square, beta_fit, file_heade
     file_header: str, path
         Filepath for all nevo outputs. Includes path, data nickname and 
         time stamp.
+    ax: matplotlib Axes, optional
+        Axes to draw on, by default a new one from new_axes.
         
     Returns
     -------
-    png
-        A plot showing the the input data and how well it fits the neutral
-        model 
     fn: str, path
         A filepath where the plot is stored. 
+    ax: matplotlib Axes
+        A plot showing the the input data and how well it fits the neutral
+        model 
 
     Notes
     -----
@@ -78,6 +90,8 @@ def neufit_plot(occurr_freqs, n_reads, n_samples, r_square, beta_fit, file_heade
     code functional in the pipeline:
         - Turned the plotting section into a reusable function
         - Added a plot clearing option to avoid double keys
+        - Draws on its own Figure/Axes instead of the pyplot state
+        - Reuses the curve cached on beta_fit (neutral_curve)
     
     TODO
     ----
@@ -98,36 +112,35 @@ def neufit_plot(occurr_freqs, n_reads, n_samples, r_square, beta_fit, file_heade
     (2018). The Neutral Metaorganism. bioRxiv. https://doi.org/10.1101/367243
     '''
     
-    pyplot.cla() #CG: Clears previous plot - to avoid double keys
+    if ax is None:
+        ax = new_axes()
+
+    # Neutral curve and confidence band, computed once per fit
+    curve = neutral_curve(beta_fit, n_samples, 
+                          min(occurr_freqs['mean_abundance']))
 
     # Prepare results plot
-    pyplot.xlabel('Mean relative abundance across samples', fontsize=15)
-    pyplot.xscale('log')
-    x_range = np.logspace(log10(min(occurr_freqs['mean_abundance'])/10),
-                          0, 1000)
-    pyplot.xlim(min(x_range), max(x_range))
-    pyplot.xticks(fontsize=16)
-    pyplot.ylabel('Occurrence frequency in samples', fontsize=15)
-    pyplot.ylim(-0.05, 1.05)
-    pyplot.yticks(fontsize=16)
+    ax.set_xlabel('Mean relative abundance across samples', fontsize=15)
+    ax.set_xscale('log')
+    ax.set_xlim(min(curve.x), max(curve.x))
+    ax.tick_params(axis='x', labelsize=16)
+    ax.set_ylabel('Occurrence frequency in samples', fontsize=15)
+    ax.set_ylim(-0.05, 1.05)
+    ax.tick_params(axis='y', labelsize=16)
 
     # Plot data points
-    pyplot.plot(occurr_freqs['mean_abundance'], occurr_freqs['occurrence'],
-                'o', markersize=6, fillstyle='full', color='black')
+    ax.plot(occurr_freqs['mean_abundance'], occurr_freqs['occurrence'],
+            'o', markersize=6, fillstyle='full', color='black')
 
     # Plot best fit
-    pyplot.plot(x_range, beta_cdf(x_range, n_reads, beta_fit.best_values['m']),
-                '-', lw=5, color='darkred')
-    lower, upper = proportion_confint(beta_cdf(x_range, n_reads,
-                                               beta_fit.best_values['m'])*n_samples,
-                                      n_samples, alpha=0.05, method='wilson')
-    pyplot.plot(x_range, lower, '--', lw=2, color='darkred')
-    pyplot.plot(x_range, upper, '--', lw=2, color='darkred')
-    pyplot.fill_between(x_range, lower, upper, color='lightgrey')
+    ax.plot(curve.x, curve.prediction, '-', lw=5, color='darkred')
+    ax.plot(curve.x, curve.lower, '--', lw=2, color='darkred')
+    ax.plot(curve.x, curve.upper, '--', lw=2, color='darkred')
+    ax.fill_between(curve.x, curve.lower, curve.upper, color='lightgrey')
 
-    pyplot.text(0.05, 0.9, '$R^2 = ' + '{:1.2f}'.format(r_square) + '$',
-                fontsize=16, transform=pyplot.gca().transAxes)
-    pyplot.tight_layout()
+    ax.text(0.05, 0.9, '$R^2 = ' + '{:1.2f}'.format(r_square) + '$',
+            fontsize=16, transform=ax.transAxes)
+    ax.figure.tight_layout()
     
     fn = file_header + '_NeutralFitPlot.png'
-    return(fn)
\ No newline at end of file
+    return(fn, ax)
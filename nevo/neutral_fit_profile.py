@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+try:
+    import resource
+except ImportError: #Windows, no peak RSS
+    resource = None
+
+#Profiler of the running pipeline, None when profiling is off, see
+#profiling and stage
+_profile_state = {'profiler': None}
+
+_null_stage = nullcontext()
+
+def _rss_mb():
+    '''Current resident set size of this process in MB (Linux), else the
+        peak resident set size'''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return(pages*os.sysconf('SC_PAGE_SIZE')/1024.0**2)
+    except (OSError, ValueError, IndexError):
+        return(_peak_rss_mb())
+
+def _peak_rss_mb():
+    '''Peak resident set size of this process in MB, NaN where the
+        resource module is missing (Windows)'''
+    if resource is None:
+        return(float('nan'))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return(peak/1024.0**2 if sys.platform == 'darwin' else peak/1024.0)
+
+class StageProfiler:
+    '''Wall/CPU time and memory of every pipeline stage
+
+    Stages nest: a stage entered inside another is recorded as
+    'outer/inner'. Every stage records its wall and CPU seconds, the RSS
+    at its start and end and the peak RSS of the process so far, and,
+    with trace_memory, the peak of Python allocations (tracemalloc)
+    during the stage. Worker processes (bootstrap, ensemble, batch) are
+    not included.
+
+    Parameters
+    ----------
+    trace_memory: bool, optional
+        If 'True', also traces Python allocations with tracemalloc, which
+        is exact per stage but slows the run down.
+    '''
+
+    def __init__(self, trace_memory = False):
+        self.trace_memory = trace_memory
+        self.stages = []
+        self._stack = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        '''Context manager timing one stage'''
+        path = self._stack[-1]['stage'] + '/' + name if self._stack else name
+        frame = {'stage': path, 'traced_peak': 0}
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if self._stack:#Keep the outer stage's peak before resetting
+                parent = self._stack[-1]
+                parent['traced_peak'] = max(parent['traced_peak'],
+                                            tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._stack.append(frame)
+        rss_start = _rss_mb()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield frame
+        finally:
+            record = {'stage': path,
+                      'seconds': time.perf_counter() - wall,
+                      'cpu_seconds': time.process_time() - cpu,
+                      'rss_start_mb': rss_start,
+                      'rss_end_mb': _rss_mb(),
+                      'peak_rss_mb': _peak_rss_mb()}
+            self._stack.pop()
+            if self.trace_memory:
+                peak = max(frame['traced_peak'],
+                           tracemalloc.get_traced_memory()[1])
+                record['traced_peak_mb'] = peak/1024.0**2
+                if self._stack:
+                    parent = self._stack[-1]
+                    parent['traced_peak'] = max(parent['traced_peak'], peak)
+            self.stages.append(record)
+
+    def record(self):
+        '''The profile as a plain dict (json serializable)'''
+        return({'total_seconds': time.perf_counter() - self._start,
+                'peak_rss_mb': _peak_rss_mb(),
+                'trace_memory': self.trace_memory,
+                'stages': list(self.stages)})
+
+    def write_json(self, fn):
+        '''Writes the profile record as JSON, returns fn'''
+        with open(fn, 'w') as f:
+            json.dump(self.record(), f, indent=2)
+        return(fn)
+
+def stage(name):
+    '''Times a stage with the active profiler; a shared no-op context when
+        profiling is off, so instrumented code costs nothing then'''
+    profiler = _profile_state['profiler']
+    if profiler is None:
+        return(_null_stage)
+    return(profiler.stage(name))
+
+@contextmanager
+def profiling(profile):
+    '''Activates a profiler for the enclosed code
+
+    Parameters
+    ----------
+    profile: bool or StageProfiler
+        True starts a new StageProfiler; False/None leaves profiling as
+        it is. An already active profiler is kept, so a profiled pipeline
+        also collects the stages of the functions it calls.
+
+    Yields
+    ------
+    StageProfiler or None
+        The profiler started here, which the caller reports; None if 
+        profiling is off or an outer profiler is already active.
+    '''
+    if not profile or _profile_state['profiler'] is not None:
+        yield None
+        return
+    profiler = profile if isinstance(profile, StageProfiler) else \
+        StageProfiler()
+    _profile_state['profiler'] = profiler
+    try:
+        yield profiler
+    finally:
+        _profile_state['profiler'] = None
+        if profiler.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
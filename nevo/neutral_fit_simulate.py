@@ -0,0 +1,476 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+from nevo.utils import write_sparse_table, write_sparse_npz
+
+simulation_formats = {'tsv': '_data.csv', 'sparse': '_data.npz',
+                      'biom': '.biom'}
+#File suffix of every output format of write_simulated_table
+
+def source_abundances(n_otus, sigma = 2.0, seed = None):
+    '''Relative abundances of the OTUs in the source pool (metacommunity)
+
+    Parameters
+    ----------
+    n_otus: int
+        Number of OTUs in the source pool.
+    sigma: float, optional
+        Standard deviation of the log abundances (lognormal pool); larger
+        values give a longer tail of rare OTUs.
+    seed: int, numpy Generator, optional
+        Seed (or Generator) of the draw.
+
+    Returns
+    -------
+    numpy array
+        Relative abundances summing to 1, most abundant OTU first.
+    '''
+    rng = np.random.default_rng(seed)
+    p = np.sort(rng.lognormal(0.0, sigma, n_otus))[::-1]
+    return(p/p.sum())
+
+def _urn_reads(p_cumsum, theta, depths, rng):
+    '''OTU index of every read of a block of samples, drawn from the
+        Dirichlet-multinomial of the neutral model with a Polya urn
+
+    Read k of a sample is a new immigrant drawn from the source pool with
+    probability theta/(theta + k), otherwise a copy of one of the k
+    earlier reads of the sample. Copies are resolved by pointer jumping,
+    so the whole block is a handful of array operations and the cost is
+    proportional to the number of reads, not to the number of OTUs.
+    '''
+    total = int(depths.sum())
+    starts = np.repeat(np.cumsum(depths) - depths, depths)
+    k = np.arange(total) - starts
+    new = rng.random(total)*(theta + k) < theta
+    parent = starts + (rng.random(total)*k).astype(np.int64)
+    parent[new] = np.flatnonzero(new)
+    while True:
+        jumped = parent[parent]
+        if np.array_equal(jumped, parent):
+            break
+        parent = jumped
+    otus = np.zeros(total, dtype=np.int64)
+    otus[new] = np.minimum(np.searchsorted(p_cumsum,
+                                           rng.random(new.sum())*p_cumsum[-1],
+                                           side='right'), len(p_cumsum) - 1)
+    return(otus[parent])
+
+def simulate_neutral_table(n_otus, n_samples, m, N, depth = None,
+                           sigma = 2.0, source = None, seed = None,
+                           chunksize = 2**22):
+    '''Simulates an OTU abundance table from the Sloan neutral model
+
+    Every sample is a local community whose relative abundances follow
+    the stationary distribution of the neutral model, a Dirichlet with
+    parameters N*m*p (so every OTU is Beta(N*m*p, N*m*(1-p)) distributed,
+    the distribution beta_cdf integrates), and is sequenced to depth
+    reads. Both steps together are one Dirichlet-multinomial draw per
+    sample, which is sampled read by read with a Polya urn (_urn_reads).
+
+    Parameters
+    ----------
+    n_otus: int
+        Number of OTUs in the source pool.
+    n_samples: int
+        Number of samples (local communities).
+    m: float
+        Immigration probability, 0 < m <= 1.
+    N: int
+        Size of the local communities.
+    depth: int or list-like of int, optional
+        Reads per sample, or one depth per sample; default N, the depth
+        neufit uses as N after rarefaction.
+    sigma: float, optional
+        Spread of the lognormal source pool, see source_abundances.
+    source: numpy array, optional
+        Relative abundances of the source pool, one per OTU; default
+        draws source_abundances(n_otus, sigma).
+    seed: int, numpy Generator, optional
+        The same seed and chunksize give the same table.
+    chunksize: int, optional
+        Number of reads simulated at once, bounds the memory used.
+
+    Returns
+    -------
+    matrix: scipy csr_matrix
+        OTU abundance table (int) with OTUs as rows and samples as columns.
+    obs_ids: pandas Index
+        OTU ids ('otu_0', ...), most abundant in the source pool first.
+    sample_ids: pandas Index
+        Sample ids ('sample_0', ...).
+
+    Notes
+    -----
+    beta_cdf is the continuum approximation of these counts: neufit
+    recovers m closely for small m (within ~10% for m = 0.01) and
+    increasingly overestimates it for large m (~0.3 for m = 0.2).
+    '''
+    if not 0 < m <= 1:
+        raise ValueError('m must be in (0, 1], not ' + str(m))
+    rng = np.random.default_rng(seed)
+    if source is None:
+        source = source_abundances(n_otus, sigma, rng)
+    elif len(source) != n_otus:
+        raise ValueError('source has ' + str(len(source)) + ' OTUs, not ' +
+                         str(n_otus))
+    p_cumsum = np.cumsum(source, dtype=float)
+    depths = np.broadcast_to(np.asarray(N if depth is None else depth,
+                                        dtype=np.int64), (n_samples,))
+    theta = float(N)*m
+
+    # Simulate blocks of samples of about chunksize reads each
+    rows, cols, counts = [], [], []
+    start = 0
+    while start < n_samples:
+        stop = start + max(1, int(np.searchsorted(np.cumsum(depths[start:]),
+                                                  chunksize, side='right')))
+        block = depths[start:stop]
+        otus = _urn_reads(p_cumsum, theta, block, rng)
+        samples = np.repeat(np.arange(start, stop, dtype=np.int64), block)
+        keys, n = np.unique(samples*n_otus + otus, return_counts=True)
+        rows.append(keys % n_otus)
+        cols.append(keys//n_otus)
+        counts.append(n)
+        start = stop
+
+    matrix = sparse.csr_matrix((np.concatenate(counts).astype(np.int64),
+                                (np.concatenate(rows), np.concatenate(cols))),
+                               shape=(n_otus, n_samples))
+    obs_ids = pd.Index(['otu_' + str(i) for i in range(n_otus)])
+    sample_ids = pd.Index(['sample_' + str(j) for j in range(n_samples)])
+    return(matrix, obs_ids, sample_ids)
+
+def simulate_taxonomy(obs_ids, branching = 4):
+    '''Placeholder taxonomy of simulated OTUs, for the plots and outliers
+
+    Every rank groups branching taxa of the rank below it (genus_0 holds
+    the first branching OTUs, family_0 the first branching genera, ...),
+    with one species per OTU and a single Kingdom.
+
+    Returns
+    -------
+    pandas df
+        Indexed by otu_id, columns Kingdom, Phylum, Class, Order, Family,
+        Genus and Species.
+    '''
+    index = np.arange(len(obs_ids))
+    taxonomy = pd.DataFrame({'Kingdom': 'Bacteria'},
+                            index=pd.Index(obs_ids, name='otu_id'))
+    for level, rank in enumerate(('Phylum', 'Class', 'Order', 'Family',
+                                  'Genus')):
+        group = index//branching**(5 - level)
+        taxonomy[rank] = [rank.lower() + '_' + str(g) for g in group]
+    taxonomy['Species'] = ['species_' + str(i) for i in index]
+    return(taxonomy)
+
+def write_simulated_table(matrix, obs_ids, sample_ids, prefix,
+                          formats = ('tsv', 'sparse', 'biom'),
+                          taxonomy = True):
+    '''Writes a (simulated) abundance table in the input formats of neufit
+
+    Parameters
+    ----------
+    matrix, obs_ids, sample_ids:
+        The table, see simulate_neutral_table.
+    prefix: str, path
+        Path and name of the outputs, extended by the suffixes of
+        simulation_formats.
+    formats: list-like of str, optional
+        Any of 'tsv' (dense _data.csv, write_sparse_table), 'sparse'
+        (_data.npz, write_sparse_npz) and 'biom' (HDF5 BIOM).
+    taxonomy: bool, optional
+        If 'True', also writes simulate_taxonomy as [prefix]_taxonomy.csv.
+
+    Returns
+    -------
+    dict
+        Path of every written format (and of 'taxonomy').
+    '''
+    fns = {}
+    for fmt in formats:
+        if fmt not in simulation_formats:
+            raise ValueError('Unknown format ' + str(fmt) + ', use one of ' +
+                             ', '.join(simulation_formats))
+        fn = str(prefix) + simulation_formats[fmt]
+        if fmt == 'tsv':
+            write_sparse_table(matrix, obs_ids, sample_ids, fn)
+        elif fmt == 'sparse':
+            write_sparse_npz(matrix, obs_ids, sample_ids, fn)
+        else:
+            from biom import Table
+            from biom.util import biom_open
+            table = Table(sparse.csr_matrix(matrix), list(obs_ids),
+                          list(sample_ids))
+            with biom_open(fn, 'w') as f:
+                table.to_hdf5(f, 'nevo simulate_neutral_table')
+        fns[fmt] = fn
+    if taxonomy == True:
+        fns['taxonomy'] = str(prefix) + '_taxonomy.csv'
+        simulate_taxonomy(obs_ids).to_csv(fns['taxonomy'], sep='\t')
+    return(fns)
+
+#Source pool and dynamics of the current worker process, set once per
+#worker by _init_simulation_worker
+_simulation_state = {}
+
+def _init_simulation_worker(p_cumsum, m, N, n_steps, events_per_step):
+    _simulation_state['p_cumsum'] = p_cumsum
+    _simulation_state['m'] = m
+    _simulation_state['N'] = N
+    _simulation_state['n_steps'] = n_steps
+    _simulation_state['events_per_step'] = events_per_step
+
+def _simulate_chunk(task):
+    '''Runs one chunk of local communities forward in time
+    
+    Every community is an array of its N individuals (OTU indices),
+    started from a draw of the source pool. In every step each community
+    loses events_per_step random individuals, each replaced by an 
+    immigrant from the source pool with probability m and otherwise by 
+    the offspring of a random individual of the community. All 
+    communities of the chunk are advanced together, one array operation
+    per step.
+    
+    Parameters
+    ----------
+    task: (numpy SeedSequence, int)
+        Seed and number of communities of the chunk.
+    
+    Returns
+    -------
+    scipy csc_matrix
+        Final abundances, OTUs as rows and communities as columns.
+    '''
+    seed, n_communities = task
+    rng = np.random.default_rng(seed)
+    p_cumsum = _simulation_state['p_cumsum']
+    m, N = _simulation_state['m'], _simulation_state['N']
+    k = _simulation_state['events_per_step']
+    n_otus = len(p_cumsum)
+    
+    def immigrants(shape):
+        return(np.minimum(np.searchsorted(p_cumsum, 
+                                          rng.random(shape)*p_cumsum[-1],
+                                          side='right'), 
+                          n_otus - 1).astype(np.int32))
+    
+    individuals = immigrants(n_communities*N) #Flat, community by community
+    base = (np.arange(n_communities, dtype=np.intp)*N)[:, np.newaxis]
+    n_steps = _simulation_state['n_steps']
+    block = max(1, 2**20//(n_communities*k))
+    for first in range(0, n_steps, block):
+        #Random draws of a block of steps at once, shape (steps, 
+        #communities, events)
+        shape = (min(block, n_steps - first), n_communities, k)
+        dead = (rng.random(shape)*N).astype(np.intp)
+        #Parent among the other N - 1 individuals
+        parent = (rng.random(shape)*(N - 1)).astype(np.intp)
+        parent += (parent >= dead) + base
+        dead += base
+        immigrant = rng.random(shape) < m
+        arrival = np.zeros(shape, dtype=np.int32)
+        arrival[immigrant] = immigrants(int(immigrant.sum()))
+        for step in range(shape[0]):
+            offspring = individuals[parent[step]]
+            np.copyto(offspring, arrival[step], where=immigrant[step])
+            individuals[dead[step]] = offspring
+    
+    rows = np.repeat(np.arange(n_communities, dtype=np.int64), N)
+    keys, counts = np.unique(individuals + rows*np.int64(n_otus), 
+                             return_counts=True)
+    return(sparse.csc_matrix((counts, (keys % n_otus, keys//n_otus)),
+                             shape=(n_otus, n_communities)))
+
+def simulate_communities(source, m, N, n_communities, n_generations = None,
+                         events_per_step = None, seed = None, n_jobs = None,
+                         chunksize = None):
+    '''Forward simulation of local communities under the neutral model
+    
+    Time-stepped Hubbell/Sloan (Moran) dynamics with immigration: in 
+    every event one individual of a local community of size N dies and 
+    is replaced by an immigrant from the source pool (probability m) or 
+    by the offspring of a local individual. Every community is one 
+    sample; the communities are simulated in chunks, every chunk as one
+    batch of array operations, on a process pool.
+    
+    Parameters
+    ----------
+    source: numpy array
+        Relative abundances of the OTUs in the source pool.
+    m: float
+        Immigration probability, 0 < m <= 1.
+    N: int
+        Number of individuals of every local community.
+    n_communities: int
+        Number of local communities (samples).
+    n_generations: int, optional
+        Length of the run in generations of N events; default 
+        ceil(5/(m + 1/N)), about five relaxation times of the model.
+    events_per_step: int, optional
+        Number of death/replacement events of a community per array 
+        step. 1 is the exact Moran process; more events per step treat 
+        them as simultaneous, which is an O(events_per_step/N) 
+        approximation. Default max(1, N//100).
+    seed: int or numpy SeedSequence, optional
+        Seed from which one RNG stream per chunk is spawned, so results
+        do not depend on n_jobs.
+    n_jobs: int, optional
+        Number of worker processes; default uses all cores, 1 runs the
+        chunks in this process.
+    chunksize: int, optional
+        Number of communities per chunk; default keeps about 2^22 
+        individuals per chunk.
+    
+    Returns
+    -------
+    scipy csr_matrix
+        Abundances (int) of the communities, OTUs as rows and
+        communities as columns; every column sums to N.
+
+    Notes
+    -----
+    The cost is about 50 ns per event and core, and every community
+    takes n_generations*N events: a few thousand communities per second
+    and core for N of a few hundred and m >= 0.1, proportionally fewer
+    for larger communities or smaller m.
+    '''
+    if not 0 < m <= 1:
+        raise ValueError('m must be in (0, 1], not ' + str(m))
+    source = np.asarray(source, dtype=float)
+    if n_generations is None:
+        n_generations = int(np.ceil(5.0/(m + 1.0/N)))
+    if events_per_step is None:
+        events_per_step = max(1, N//100)
+    if chunksize is None:
+        chunksize = max(1, 2**22//N)
+    n_steps = int(np.ceil(n_generations*N/float(events_per_step)))
+    
+    sizes = [min(chunksize, n_communities - start) 
+             for start in range(0, n_communities, chunksize)]
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    tasks = list(zip(seed.spawn(len(sizes)), sizes))
+    initargs = (np.cumsum(source), m, N, n_steps, events_per_step)
+    if n_jobs == 1:
+        _init_simulation_worker(*initargs)
+        chunks = [_simulate_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, 
+                                 initializer=_init_simulation_worker,
+                                 initargs=initargs) as pool:
+            chunks = list(pool.map(_simulate_chunk, tasks))
+    return(sparse.hstack(chunks, format='csr').astype(np.int64))
+
+def calibrate_m(m_values, n_otus = 1000, n_communities = 200, N = 1000, 
+                sigma = 2.0, seed = None, n_jobs = None, **kws):
+    '''Checks the m neufit recovers against the simulated immigration rate
+    
+    For every m a set of communities is simulated forward 
+    (simulate_communities) from one lognormal source pool and fitted 
+    with the fast engine, exactly as neufit fits a table rarefied to N 
+    reads.
+    
+    Parameters
+    ----------
+    m_values: list-like of float
+        Simulated immigration rates.
+    n_otus, n_communities, N, sigma:
+        Size of the source pool, number and size of the communities and 
+        spread of the pool, see simulate_communities and 
+        source_abundances.
+    seed: int, optional
+        Seed of the pool and the simulations.
+    n_jobs: int, optional
+        Number of worker processes of every simulation.
+    **kws:
+        Passed on to simulate_communities (n_generations, 
+        events_per_step, chunksize).
+    
+    Returns
+    -------
+    pandas df
+        One row per m: m, m_fit, stderr, r_square, relative bias
+        (m_fit/m - 1) and the number of OTUs observed.
+
+    Notes
+    -----
+    With the defaults neufit overestimates m of the forward dynamics, 
+    more than of simulate_neutral_table: m_fit is about 0.065 for 
+    m = 0.05 and 0.38-0.40 for m = 0.2, the same with events_per_step=1
+    as with the default.
+    '''
+    from nevo.neutral_fit_utils import occurrence_stats, fit_m
+    seeds = np.random.SeedSequence(seed).spawn(len(m_values) + 1)
+    source = source_abundances(n_otus, sigma, np.random.default_rng(seeds[0]))
+    rows = []
+    for m, s in zip(m_values, seeds[1:]):
+        counts = simulate_communities(source, m, N, n_communities, seed=s,
+                                      n_jobs=n_jobs, **kws)
+        mean_abundance, occurrence = occurrence_stats(counts, N)
+        present = occurrence > 0
+        beta_fit = fit_m(mean_abundance[present], occurrence[present], N)
+        observed = occurrence[present]
+        r_square = 1.0 - np.sum(np.square(observed - beta_fit.best_fit))/ \
+            np.sum(np.square(observed - np.mean(observed)))
+        rows.append((m, beta_fit.best_values['m'], beta_fit.stderr, 
+                     r_square, beta_fit.best_values['m']/m - 1.0, 
+                     int(present.sum())))
+    return(pd.DataFrame(rows, columns=['m', 'm_fit', 'stderr', 'r_square',
+                                       'bias', 'n_otus']))
+
+def occurrence_envelope(occurr_freqs, m, N, n_samples, n_simulations = 100,
+                        alpha = 0.05, seed = None, n_jobs = None, **kws):
+    '''Monte-Carlo envelope of the occurrence of every OTU under the 
+        fitted neutral model
+    
+    The observed mean abundances are used as the source pool and 
+    n_simulations sets of n_samples communities are simulated forward 
+    (simulate_communities); the envelope is the alpha/2 and 1 - alpha/2
+    quantile of the simulated occurrence of every OTU, a null band that
+    includes the sampling of the pool instead of the binomial (Wilson) 
+    interval of neufit.
+    
+    Parameters
+    ----------
+    occurr_freqs: pandas df
+        neufit output with the mean_abundance of every OTU.
+    m: float
+        Fitted migration rate, e.g. beta_fit.best_values['m'].
+    N: int
+        Community size, the n_reads of neufit.
+    n_samples: int
+        Number of samples of the fitted table.
+    n_simulations: int, optional
+        Number of simulated tables.
+    alpha: float, optional
+        The envelope covers 1 - alpha of the simulations.
+    seed: int, optional
+        Seed of the simulations, results do not depend on n_jobs.
+    n_jobs: int, optional
+        Number of worker processes.
+    **kws:
+        Passed on to simulate_communities.
+    
+    Returns
+    -------
+    pandas df
+        Indexed like occurr_freqs: mc_lower, mc_median, mc_upper.
+    '''
+    source = occurr_freqs['mean_abundance'].to_numpy(dtype=float)
+    counts = simulate_communities(source/source.sum(), m, N, 
+                                  n_simulations*n_samples, seed=seed, 
+                                  n_jobs=n_jobs, **kws)
+    #Occurrence of every OTU in every simulated table, columns of a 
+    #simulation are consecutive
+    present = (counts > 0).astype(float)
+    tables = sparse.csr_matrix((np.ones(n_simulations*n_samples), 
+                                (np.arange(n_simulations*n_samples),
+                                 np.repeat(np.arange(n_simulations), 
+                                           n_samples))))
+    occurrence = (present @ tables).toarray()/n_samples
+    lower, median, upper = np.quantile(occurrence, 
+                                       [alpha/2, 0.5, 1.0 - alpha/2], axis=1)
+    return(pd.DataFrame({'mc_lower': lower, 'mc_median': median, 
+                         'mc_upper': upper}, index=occurr_freqs.index))
@@ -1,6 +1,11 @@
 import os
 import numpy as np
-from scipy.stats import beta 
+import pandas as pd
+from scipy import sparse
+from scipy.optimize import minimize_scalar, brentq
+from scipy.stats import beta, chi2
+from scipy.special import betainc, betaln, digamma
+from statsmodels.stats.proportion import proportion_confint
 
 def beta_cdf(p, N, m):
     '''Expected long term distribution under the 
@@ -49,65 +54,771 @@ def beta_cdf(p, N, m):
     S., Hentschel, U., Schulenburg, H., Bosch, T. C. G. and Traulsen, A. 
     (2018). The Neutral Metaorganism. bioRxiv. https://doi.org/10.1101/367243
     '''
-    return beta.cdf(1.0, N*m*p, N*m*(1.0-p)) - beta.cdf(1.0/N, N*m*p, N*m*(1.0-p))
+    # CG: beta.cdf(1.0, ...) is always 1, and betainc is the regularized 
+    # incomplete beta function behind beta.cdf without the generic 
+    # scipy.stats dispatch
+    p = np.asarray(p, dtype=float)
+    return 1.0 - betainc(N*m*p, N*m*(1.0-p), 1.0/N)
 
-def subsample(counts, depth):
-    '''Subsamples counts to uniform depth, dropping all samples 
-        without enough depth 
+def beta_cdf_dm(p, N, m, tol = 1e-14, max_terms = 10000):
+    '''Analytic derivative of beta_cdf with respect to m
     
-    Copyright
-    ---------
-    Github: https://github.com/misieber/neufit
-    Theroy as described in [1]_. and [2]_.
+    beta_cdf = 1 - I_x(a, b) with x = 1/N, a = N*m*p and b = N*m*(1-p).
+    I_x is expanded with the hypergeometric series
     
-    Copyright (C) 2018 Michael Sieber (sieber.ecoevo.de)
-    All rights reserved.
+        I_x(a, b) = x^a (1-x)^b / (a B(a, b)) * sum_k t_k, 
+        t_0 = 1, t_{k+1} = t_k * (a+b+k) / (a+1+k) * x
+    
+    which converges quickly since x = 1/N is small, and is 
+    differentiated term by term in a and b. All OTUs are handled as one 
+    array; the loop only runs over the terms of the series.
+    
+    Parameters
+    ----------
+    p: numpy array
+        Mean relative abundances.
+    N: int
+        Number of reads (community size).
+    m: float
+        Migration rate.
+    tol: float, optional
+        Relative size of the last series term at which to stop.
+    max_terms: int, optional
+        Maximum number of series terms.
+    
+    Returns
+    -------
+    numpy array
+        d beta_cdf(p, N, m) / d m for every p.
+    '''
+    p = np.asarray(p, dtype=float)
+    x = 1.0/N
+    a = N*m*p
+    b = N*m*(1.0-p)
+    
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        term = np.ones_like(a)
+        series = np.ones_like(a)
+        series_da = np.zeros_like(a)
+        series_db = np.zeros_like(a)
+        dlog_da = np.zeros_like(a) #d log(t_k) / da
+        dlog_db = np.zeros_like(a) #d log(t_k) / db
+        for k in range(max_terms):
+            dlog_da += 1.0/(a+b+k) - 1.0/(a+1.0+k)
+            dlog_db += 1.0/(a+b+k)
+            term *= (a+b+k)/(a+1.0+k)*x
+            series += term
+            series_da += term*dlog_da
+            series_db += term*dlog_db
+            if not np.any(term > tol*series):
+                break
+        
+        incomplete = np.exp(a*np.log(x) + b*np.log1p(-x) - np.log(a) - 
+                            betaln(a, b))*series
+        dlogI_da = (np.log(x) - 1.0/a - digamma(a) + digamma(a+b) + 
+                    series_da/series)
+        dlogI_db = (np.log1p(-x) - digamma(b) + digamma(a+b) + 
+                    series_db/series)
+        grad = -incomplete*N*(p*dlogI_da + (1.0-p)*dlogI_db)
+    return np.where(incomplete > 0, grad, 0.0)
 
-    Redistribution and use in source and binary forms, with or without
-    modification, are permitted provided that the following conditions 
-    are met:
+def _beta_residual(params, p, occurrence):
+    '''Residual of the lmfit fit of m, model - data'''
+    return beta_cdf(p, params['N'].value, params['m'].value) - occurrence
 
-    1. Redistributions of source code must retain the above copyright 
-       notice, this list of conditions and the following disclaimer.
-    2. Redistributions in binary form must reproduce the above 
-       copyright notice, this list of conditions and the following 
-       disclaimer in the documentation and/or other materials provided 
-       with the distribution.
+def beta_cdf_jacobian(params, p, occurrence):
+    '''Jacobian of the lmfit residual (model - data, _beta_residual), for
+        lmfit.minimize(..., Dfun=beta_cdf_jacobian)
+    
+    Only m is varied (N is fixed), so the Jacobian is a single column.
+    The residual is ours, so its sign (and the Jacobian's) does not 
+    depend on the lmfit release.
+    '''
+    return beta_cdf_dm(p, params['N'].value, 
+                       params['m'].value)[:, np.newaxis]
 
-    THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS 
-    "AS IS" ANDANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT 
-    LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR 
-    A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT 
-    OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, 
-    SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED 
-    TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
-    PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF 
-    LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING 
-    NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS 
-    SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+def fit_m_lmfit(p, occurrence, N):
+    '''Least-squares fit of m with lmfit's Levenberg-Marquardt (leastsq)
+        and the analytic Jacobian, the 'lmfit' engine of neufit
     
-    References
+    Parameters
     ----------
-    .. [1] Sloan, W. T., Lunn, M., Woodcock, S., Head, I. M., Nee, S. 
-    and Curtis, T. P. (2006). Quantifying the roles of immigration 
-    and chance in shaping prokaryote community structure. Environmental 
-    Microbiology, 8:732-740. https://doi.org/10.1111/j.1462-2920.2005.00956.x
+    p: numpy array
+        Mean relative abundances.
+    occurrence: numpy array
+        Observed occurrence frequencies.
+    N: int
+        Number of reads (community size).
     
-    .. [2] Sieber, M., Pita, L., Weiland-Bräuer, N., Dirksen, P., Wang, J., 
-    Mortzfeld, B., Franzenburg, S., Schmitz, R. A., Baines, J. F., Fraune, 
-    S., Hentschel, U., Schulenburg, H., Bosch, T. C. G. and Traulsen, A. 
-    (2018). The Neutral Metaorganism. bioRxiv. https://doi.org/10.1101/367243    
+    Returns
+    -------
+    NeutralFitResult
+        With lmfit's standard error of m (scaled by the reduced 
+        chi-square).
+    '''
+    from lmfit import Parameters, minimize
+    p = np.asarray(p, dtype=float)
+    occurrence = np.asarray(occurrence, dtype=float)
+    params = Parameters()
+    params.add('N', value=N, vary=False)
+    params.add('m', value=0.5, min=0.0, max=1.0)
+    result = minimize(_beta_residual, params, args=(p, occurrence), 
+                      Dfun=beta_cdf_jacobian, method='leastsq')
+    m = result.params['m'].value
+    stderr = result.params['m'].stderr
+    best_fit = beta_cdf(p, N, m)
+    residual = best_fit - occurrence
+    return NeutralFitResult(m, N, best_fit, 
+                            np.nan if stderr is None else stderr, 
+                            float(residual @ residual), len(occurrence), 
+                            result.nfev, 'leastsq')
+
+class NeutralFitResult:
+    '''Result of the fits of m (fit_m, fit_m_lmfit, fit_m_ml), a light 
+        stand-in for lmfit's ModelResult
+    
+    Attributes
+    ----------
+    best_values: dict
+        Best-fit 'm' and the fixed 'N', as in ModelResult.best_values.
+    best_fit: numpy array
+        beta_cdf evaluated at the best-fit m, i.e. predicted_occurrence.
+    stderr: float
+        Standard error of m, scaled by the reduced chi-square like lmfit.
+    chisqr, redchi: float
+        Sum of squared residuals and its value per degree of freedom.
+    ndata, nfev: int
+        Number of data points and of function evaluations.
+    method: str
+        Name of the optimizer.
+    loglik: float or None
+        Binomial log-likelihood at the best-fit m (fit_m_ml only).
+    m_interval: tuple or None
+        Profile-likelihood interval (lower, upper) of m (fit_m_ml only).
     '''
-    for sample in counts:
-        if counts[sample].sum() >= depth:
-            flattened = np.repeat(np.arange(counts[sample].size), counts[sample])
-            subsample = np.random.choice(flattened, depth, replace=False)
-            counts[sample] = np.bincount(subsample, minlength=counts[sample].size)
+    
+    def __init__(self, m, N, best_fit, stderr, chisqr, ndata, nfev, 
+                 method, loglik = None, m_interval = None):
+        self.best_values = {'N': float(N), 'm': m}
+        self.best_fit = best_fit
+        self.stderr = stderr
+        self.chisqr = chisqr
+        self.ndata = ndata
+        self.redchi = chisqr/max(ndata - 1, 1)
+        self.nfev = nfev
+        self.method = method
+        self.loglik = loglik
+        self.m_interval = m_interval
+    
+    def fit_report(self):
+        '''Fit statistics in the layout of lmfit's fit_report'''
+        m = self.best_values['m']
+        if np.isfinite(self.stderr) and m != 0:
+            m_line = '{:.8g} +/- {:.8g} ({:.2%})'.format(m, self.stderr, 
+                                                         self.stderr/m)
         else:
-            #CG: changed the following print statment from Python2 to Python3 
-            print('dropping sample ' + sample + ' with ' + str(counts[sample].sum()) + ' reads < ' + str(depth))
-            counts = counts.drop(sample, axis=1)
-    return counts
+            m_line = '{:.8g} +/- nan'.format(m)
+        likelihood = ''
+        if self.loglik is not None:
+            likelihood = '    log-likelihood     = {:.8f}\n'.format(
+                self.loglik)
+        interval = ''
+        if self.m_interval is not None:
+            interval = '    m profile-likelihood interval = [{:.8g}, ' \
+                '{:.8g}]\n'.format(*self.m_interval)
+        return ('[[Fit Statistics]]\n'
+                '    # fitting method   = ' + self.method + '\n'
+                '    # function evals   = ' + str(self.nfev) + '\n'
+                '    # data points      = ' + str(self.ndata) + '\n'
+                '    # variables        = 1\n'
+                '    chi-square         = {:.8f}\n'.format(self.chisqr) +
+                '    reduced chi-square = {:.8f}\n'.format(self.redchi) +
+                likelihood +
+                '[[Variables]]\n'
+                '    N:  ' + '{:g}'.format(self.best_values['N']) + 
+                ' (fixed)\n'
+                '    m:  ' + m_line + '\n' + interval)
+
+class NeutralCurve:
+    '''The fitted neutral curve and its 95% Wilson band on an x grid
+    
+    Attributes
+    ----------
+    x: numpy array
+        Log-spaced mean relative abundances, from min_abundance/10 to 1.
+    prediction: numpy array
+        beta_cdf at the best-fit m.
+    lower, upper: numpy array
+        Wilson confidence interval of the prediction for n_samples.
+    key: tuple
+        (m, N, n_samples, min_abundance, n_points) the curve was built 
+        for.
+    '''
+    
+    def __init__(self, m, N, n_samples, min_abundance, n_points = 1000):
+        self.key = (m, N, n_samples, min_abundance, n_points)
+        self.x = np.logspace(np.log10(min_abundance/10), 0, n_points)
+        self.prediction = beta_cdf(self.x, N, m)
+        self.lower, self.upper = proportion_confint(self.prediction*n_samples,
+                                                    n_samples, alpha=0.05, 
+                                                    method='wilson')
+    
+    def to_frame(self):
+        '''The curve as a pandas df for exports'''
+        return(pd.DataFrame({'mean_abundance': self.x, 
+                             'predicted_occurrence': self.prediction,
+                             'lower_conf_int': self.lower, 
+                             'upper_conf_int': self.upper}))
+
+def neutral_curve(beta_fit, n_samples, min_abundance, n_points = 1000):
+    '''The NeutralCurve of a fit, built once and cached on beta_fit.curve
+    
+    Parameters
+    ----------
+    beta_fit: lmfit ModelResult or NeutralFitResult
+        The neutral fit.
+    n_samples: int
+        Number of samples, for the Wilson band.
+    min_abundance: float
+        Smallest mean relative abundance of the data; the grid starts a 
+        decade below it.
+    n_points: int, optional
+        Size of the x grid.
+    
+    Returns
+    -------
+    NeutralCurve
+        beta_fit.curve, rebuilt only if it was built for another fit or 
+        grid.
+    '''
+    key = (beta_fit.best_values['m'], beta_fit.best_values['N'], n_samples,
+           min_abundance, n_points)
+    curve = getattr(beta_fit, 'curve', None)
+    if curve is None or curve.key != key:
+        curve = NeutralCurve(*key)
+        beta_fit.curve = curve
+    return(curve)
+
+plateau_rtol = 1e-12
+#Relative growth of the sum of squares of a stalled Gauss-Newton step 
+#still taken as rounding at the minimum, see _gauss_newton_m
+
+def _gauss_newton_m(p, occurrence, N, segment, n_fits, tol, max_iter):
+    '''Gauss-Newton fit of one m per segment of the stacked arrays
+    
+    Steps are taken in u = log(m), which keeps m positive, clipped at 
+    m = 1 and halved until the sum of squares of that segment decreases. 
+    A step halved below tol without a decrease stalls: if the sum of 
+    squares only grew by rounding (plateau_rtol) m is at the minimum and
+    is kept as converged, otherwise the segment is left unconverged for 
+    the fallback of the caller. Every evaluation of beta_cdf/beta_cdf_dm covers all segments still 
+    being fitted at once; per-segment sums are taken with np.bincount.
+    
+    Returns
+    -------
+    m: numpy array
+        Best-fit m of every segment.
+    converged: numpy array of bool
+        Whether the iteration converged for every segment.
+    nfev: numpy array of int
+        Number of beta_cdf evaluations that covered every segment.
+    '''
+    def sums(values, select):
+        return np.bincount(segment[select], values, minlength=n_fits)
+    
+    everything = np.ones(len(p), dtype=bool)
+    m = np.full(n_fits, 0.5) #lmfit's initial value
+    residual = occurrence - beta_cdf(p, N, m[segment])
+    chisqr = sums(np.square(residual), everything)
+    nfev = np.ones(n_fits, dtype=int)
+    active = np.ones(n_fits, dtype=bool)
+    converged = np.zeros(n_fits, dtype=bool)
+    
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        select = active[segment]
+        m_select = m[segment][select]
+        jac = m_select*beta_cdf_dm(p[select], N[select], m_select)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = (sums(residual[select]*jac, select)/
+                    sums(np.square(jac), select))
+        active &= np.isfinite(step) #failed, left for the fallback
+        
+        # Step halving, only re-evaluating the segments still trying
+        m_new = m.copy()
+        chisqr_new = chisqr.copy()
+        residual_new = residual.copy()
+        trying = active.copy()
+        while trying.any():
+            m_new[trying] = np.exp(np.minimum(np.log(m[trying]) + 
+                                              step[trying], 0.0))
+            select = trying[segment]
+            residual_new[select] = occurrence[select] - beta_cdf(
+                p[select], N[select], m_new[segment][select])
+            chisqr_try = sums(np.square(residual_new[select]), select)
+            nfev[trying] += 1
+            accept = trying & (chisqr_try <= chisqr)
+            chisqr_new[accept] = chisqr_try[accept]
+            # Stalled below tol: keep m at a rounding plateau, else fail
+            stalled = trying & ~accept & (np.abs(step) < tol)
+            plateau = stalled & (chisqr_try - chisqr <= 
+                                 plateau_rtol*chisqr)
+            m_new[stalled] = m[stalled]
+            residual_new[stalled[segment]] = residual[stalled[segment]]
+            active &= ~(stalled & ~plateau)
+            step[trying & ~accept] /= 2.0
+            trying &= ~(accept | stalled)
+        
+        done = active & (np.abs(m_new - m) <= tol*m_new)
+        m[active] = m_new[active]
+        chisqr[active] = chisqr_new[active]
+        residual = residual_new
+        converged |= done
+        active &= ~done
+    
+    return(m, converged, nfev)
+
+def fit_m(p, occurrence, N, tol = 1e-10, max_iter = 100):
+    '''Least-squares fit of the migration rate m of the neutral model
+    
+    With N fixed to the read depth the neutral fit is a bounded 
+    one-dimensional least-squares problem in m on [0, 1]; this solves it 
+    directly instead of going through the lmfit Model machinery. 
+    
+    m is solved for with Gauss-Newton steps in log(m), which keeps m 
+    positive, using the analytic derivative beta_cdf_dm; steps are 
+    clipped at m = 1 and halved until the sum of squares decreases. If 
+    that does not converge, scipy's bounded scalar optimizer (Brent) is 
+    used on [0, 1] instead. The standard error is computed like lmfit's.
+    
+    Parameters
+    ----------
+    p: numpy array
+        Mean relative abundances.
+    occurrence: numpy array
+        Observed occurrence frequencies.
+    N: int
+        Number of reads (community size).
+    tol: float, optional
+        Relative tolerance on m.
+    max_iter: int, optional
+        Maximum number of Gauss-Newton steps.
+    
+    Returns
+    -------
+    NeutralFitResult
+    '''
+    p = np.asarray(p, dtype=float)
+    occurrence = np.asarray(occurrence, dtype=float)
+    
+    def sse(m):
+        residual = occurrence - beta_cdf(p, N, m)
+        return residual @ residual
+    
+    m, converged, nfev = _gauss_newton_m(
+        p, occurrence, np.full(len(p), float(N)), 
+        np.zeros(len(p), dtype=int), 1, tol, max_iter)
+    m, nfev = float(m[0]), int(nfev[0])
+    method = 'gauss-newton'
+    
+    if not converged[0]:
+        opt = minimize_scalar(sse, bounds=(0.0, 1.0), method='bounded', 
+                              options={'xatol': tol})
+        m = float(opt.x)
+        nfev += opt.nfev
+        method = 'bounded'
+    
+    best_fit = beta_cdf(p, N, m)
+    chisqr = float(sse(m))
+    
+    # Asymptotic standard error, scaled by the reduced chi-square
+    jac_sq = np.sum(np.square(beta_cdf_dm(p, N, m)))
+    ndata = len(occurrence)
+    if jac_sq > 0 and ndata > 1:
+        stderr = np.sqrt(chisqr/(ndata - 1)/jac_sq)
+    else:
+        stderr = np.nan
+    return NeutralFitResult(m, N, best_fit, stderr, chisqr, ndata, nfev, 
+                            method)
+
+def _binomial_loglik(p, counts, n_samples, N, m):
+    '''Binomial log-likelihood of the occurrence counts under beta_cdf, 
+        with its derivative and Fisher information in m
+    
+    Returns
+    -------
+    loglik, score, information: float
+        log L, d log L / dm and the expected information 
+        n * sum (dP/dm)^2 / (P (1 - P)).
+    prediction: numpy array
+        beta_cdf(p, N, m).
+    '''
+    prediction = beta_cdf(p, N, m)
+    P = np.clip(prediction, 1e-300, 1.0 - 1e-16)
+    loglik = np.sum(counts*np.log(P) + (n_samples - counts)*np.log1p(-P))
+    dP = beta_cdf_dm(p, N, m)
+    variance = P*(1.0 - P)
+    score = np.sum((counts - n_samples*P)/variance*dP)
+    information = n_samples*np.sum(np.square(dP)/variance)
+    return(loglik, score, information, prediction)
+
+def fit_m_ml(p, occurrence, N, n_samples, alpha = 0.05, tol = 1e-10, 
+             max_iter = 100):
+    '''Maximum-likelihood fit of the migration rate m of the neutral model
+    
+    Every OTU occurs in k = occurrence*n_samples of n_samples samples; 
+    under the neutral model k is binomial with probability 
+    P = beta_cdf(p, N, m). Unlike the least-squares fit (fit_m), which 
+    weights every OTU equally, the likelihood weights every residual by 
+    the inverse binomial variance 1/(P (1 - P)), so OTUs with P near 0 
+    or 1, whose occurrence the model pins down, weigh more than those 
+    near P = 1/2.
+    
+    m is solved for with Fisher scoring steps in log(m) on the closed 
+    form score, using beta_cdf_dm for dP/dm over all OTUs at once; steps 
+    are clipped at m = 1 and halved until the likelihood increases, with 
+    scipy's bounded scalar optimizer as the fallback. The standard error 
+    is the inverse square root of the Fisher information. The interval 
+    of m is the profile-likelihood interval, all m with 
+    2 (log L(m_hat) - log L(m)) below the chi-square(1) quantile.
+    
+    Parameters
+    ----------
+    p: numpy array
+        Mean relative abundances.
+    occurrence: numpy array
+        Observed occurrence frequencies.
+    N: int
+        Number of reads (community size).
+    n_samples: int
+        Number of samples the occurrences were counted in.
+    alpha: float or None, optional
+        The profile-likelihood interval covers 1 - alpha; None skips 
+        the interval (m_interval is None), e.g. for bootstrap refits.
+    tol: float, optional
+        Relative tolerance on m.
+    max_iter: int, optional
+        Maximum number of scoring steps.
+    
+    Returns
+    -------
+    NeutralFitResult
+        With loglik and m_interval set; chisqr is the sum of squared 
+        residuals at the likelihood optimum, for comparison with fit_m.
+    
+    Raises
+    ------
+    ValueError
+        If every OTU occurs in every sample: the occurrences then carry
+        no information on m and the likelihood has no proper maximum.
+    
+    Notes
+    -----
+    The binomial model assumes the samples are independent draws of the
+    neutral model; overdispersed data give intervals that are too narrow
+    (compare with the bootstrap of neufit).
+    '''
+    p = np.asarray(p, dtype=float)
+    occurrence = np.asarray(occurrence, dtype=float)
+    counts = occurrence*n_samples
+    if np.all(counts >= n_samples):
+        raise ValueError('Every OTU occurs in every sample, the '
+                         'occurrences do not determine m')
+    
+    def loglik(m):
+        return _binomial_loglik(p, counts, n_samples, N, m)[0]
+    
+    m = 0.5 #lmfit's initial value
+    best, score, information, _ = _binomial_loglik(p, counts, n_samples, 
+                                                   N, m)
+    nfev = 1
+    converged = False
+    for _ in range(max_iter):
+        # Fisher scoring step in u = log(m)
+        step = score/(m*information) if information > 0 else np.nan
+        if not np.isfinite(step):
+            break
+        while True:
+            m_new = float(np.exp(min(np.log(m) + step, 0.0)))
+            fit_new = _binomial_loglik(p, counts, n_samples, N, m_new)
+            nfev += 1
+            if fit_new[0] >= best or abs(step) < tol:
+                break
+            step /= 2.0
+        done = abs(m_new - m) <= tol*m_new
+        m, (best, score, information, _) = m_new, fit_new
+        if done:
+            converged = True
+            break
+    method = 'binomial-ml'
+    
+    if not converged:
+        opt = minimize_scalar(lambda m: -loglik(m), bounds=(0.0, 1.0), 
+                              method='bounded', options={'xatol': tol})
+        m = float(opt.x)
+        nfev += opt.nfev
+        method = 'binomial-ml bounded'
+        best, score, information, _ = _binomial_loglik(p, counts, 
+                                                       n_samples, N, m)
+    
+    # Profile-likelihood interval, searched in log(m) on both sides
+    m_interval = None
+    if alpha is not None:
+        threshold = best - chi2.ppf(1.0 - alpha, 1)/2.0
+        def excess(u):
+            return loglik(np.exp(u)) - threshold
+        lower, upper = 0.0, 1.0
+        u_min = np.log(m) - 50.0
+        if excess(u_min) < 0:
+            lower = float(np.exp(brentq(excess, u_min, np.log(m), 
+                                        xtol=tol)))
+        if m < 1.0 and excess(0.0) < 0:
+            upper = float(np.exp(brentq(excess, np.log(m), 0.0, xtol=tol)))
+        m_interval = (lower, upper)
+    
+    best_fit = beta_cdf(p, N, m)
+    residual = occurrence - best_fit
+    stderr = 1.0/np.sqrt(information) if information > 0 else np.nan
+    return NeutralFitResult(m, N, best_fit, stderr, 
+                            float(residual @ residual), len(occurrence), 
+                            nfev, method, loglik=float(best), 
+                            m_interval=m_interval)
+
+def fit_m_batch(cohorts, tol = 1e-10, max_iter = 100):
+    '''Fits m of many cohorts at once
+    
+    All cohorts are stacked into one array and fitted together by the 
+    same Gauss-Newton iteration as fit_m, so every evaluation of the 
+    neutral curve is one array operation over all cohorts and dozens of 
+    cohort/stratum fits cost about as much as one fit of their combined 
+    size. Cohorts that do not converge are refitted one by one with 
+    fit_m. Cohorts with fewer than 2 OTUs are not fitted: their row is 
+    all NaN with method 'skipped'.
+    
+    Parameters
+    ----------
+    cohorts: dict
+        Maps cohort name to (mean_abundance, occurrence, N), the per-OTU
+        mean relative abundances and occurrence frequencies (e.g. the 
+        columns of neufit's occurr_freqs) and the read depth.
+    tol: float, optional
+        Relative tolerance on m.
+    max_iter: int, optional
+        Maximum number of Gauss-Newton steps.
+    
+    Returns
+    -------
+    pandas df
+        One row per cohort with columns m, stderr, r_square, N, n_otus,
+        chisqr, nfev and method.
+    '''
+    names = list(cohorts)
+    columns = ['m', 'stderr', 'r_square', 'N', 'n_otus', 'chisqr', 
+               'nfev', 'method']
+    if len(names) == 0:
+        return pd.DataFrame(columns=columns)
+    p = [np.asarray(cohorts[name][0], dtype=float) for name in names]
+    occurrence = [np.asarray(cohorts[name][1], dtype=float) 
+                  for name in names]
+    N_fits = np.array([float(cohorts[name][2]) for name in names])
+    n_otus = np.array([len(x) for x in p])
+    segment = np.repeat(np.arange(len(names)), n_otus)
+    p, occurrence = np.concatenate(p), np.concatenate(occurrence)
+    N = N_fits[segment]
+    
+    n_fits = len(names)
+    
+    # Only cohorts with at least 2 OTUs are fitted
+    fitted = n_otus >= 2
+    m = np.full(n_fits, np.nan)
+    nfev = np.zeros(n_fits, dtype=int)
+    method = np.full(n_fits, 'skipped', dtype=object)
+    if fitted.any():
+        select = fitted[segment]
+        index = np.flatnonzero(fitted)
+        m_fit, converged, nfev_fit = _gauss_newton_m(
+            p[select], occurrence[select], N[select], 
+            (np.cumsum(fitted) - 1)[segment[select]], len(index), tol, 
+            max_iter)
+        m[index], nfev[index] = m_fit, nfev_fit
+        method[index] = 'gauss-newton'
+        for i in index[~converged]:
+            select = segment == i
+            single = fit_m(p[select], occurrence[select], N_fits[i], tol, 
+                           max_iter)
+            m[i], nfev[i] = single.best_values['m'], nfev[i] + single.nfev
+            method[i] = single.method
+    
+    # Fit statistics, all cohorts at once
+    residual = occurrence - beta_cdf(p, N, m[segment])
+    jac = beta_cdf_dm(p, N, m[segment])
+    chisqr = 1.0*np.bincount(segment, np.square(residual), minlength=n_fits)
+    jac_sq = 1.0*np.bincount(segment, np.square(jac), minlength=n_fits)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_occurrence = np.bincount(segment, occurrence, 
+                                      minlength=n_fits)/n_otus
+        total = np.bincount(segment, np.square(occurrence - 
+                                               mean_occurrence[segment]),
+                            minlength=n_fits)
+        stderr = np.where((jac_sq > 0) & fitted, 
+                          np.sqrt(chisqr/(n_otus - 1)/jac_sq), np.nan)
+        r_square = 1.0 - chisqr/total
+    chisqr[~fitted] = np.nan
+    r_square[~fitted] = np.nan
+    
+    return pd.DataFrame({'m': m, 'stderr': stderr, 'r_square': r_square,
+                         'N': N_fits, 'n_otus': n_otus, 'chisqr': chisqr,
+                         'nfev': nfev, 'method': method}, 
+                        index=pd.Index(names, name='cohort'), 
+                        columns=columns)
+
+def neutral_fit_report(beta_fit):
+    '''fit_report text for either a lmfit ModelResult or a 
+        NeutralFitResult'''
+    if isinstance(beta_fit, NeutralFitResult):
+        return beta_fit.fit_report()
+    from lmfit import fit_report
+    return fit_report(beta_fit)
+
+def _split_draws(data, indptr, depth, rng):
+    '''Multivariate hypergeometric draws of depth reads from every 
+        segment data[indptr[j]:indptr[j + 1]], all segments at once
+    
+    Every pass splits each segment with reads left in two halves and 
+    draws the reads of its left half from a hypergeometric distribution
+    (reads in the left half vs. the right half, without replacement); 
+    segments of one entry get their reads. The result is an exact 
+    multivariate hypergeometric draw of every segment.
+    
+    Returns
+    -------
+    numpy array
+        Drawn counts, in the layout of data.
+    '''
+    drawn = np.zeros_like(data)
+    cumulative = np.concatenate(([0], np.cumsum(data)))
+    start, end = indptr[:-1].astype(np.int64), indptr[1:].astype(np.int64)
+    n_draw = np.full(len(start), depth, dtype=np.int64)
+    while len(start):
+        active = (end > start) & (n_draw > 0)
+        start, end, n_draw = start[active], end[active], n_draw[active]
+        single = end - start == 1
+        drawn[start[single]] = n_draw[single]
+        start, end, n_draw = start[~single], end[~single], n_draw[~single]
+        mid = (start + end)//2
+        left = rng.hypergeometric(cumulative[mid] - cumulative[start], 
+                                  cumulative[end] - cumulative[mid], n_draw)
+        start = np.concatenate((start, mid))
+        end = np.concatenate((mid, end))
+        n_draw = np.concatenate((left, n_draw - left))
+    return(drawn)
+
+def rarefy(counts, depth, seed = None):
+    '''Rarefies all samples (columns) of counts to a uniform depth, 
+        dropping all samples without enough depth
+    
+    Replacement for neufit's subsample() which does not expand each 
+    sample into one index per read. Every sample is drawn directly from 
+    its count vector by multivariate hypergeometric sampling (sampling 
+    reads without replacement), so memory scales with the number of 
+    non-zero counts instead of the number of reads. 
+    
+    Parameters
+    ----------
+    counts: pandas df, numpy array or scipy sparse matrix
+        OTU abundance table with OTUs as rows and samples as columns. 
+    depth: int
+        Number of reads to draw from every sample. 
+    seed: int, numpy Generator, optional
+        Seed (or Generator) used for the random draws; default draws 
+        a fresh, unseeded Generator.
+    
+    Returns
+    -------
+    rarefied: pandas df, numpy array or scipy sparse matrix
+        Rarefied abundance table of the same type as counts (sparse 
+        input is returned as csc_matrix), without the dropped samples.
+    
+    Notes
+    -----
+    All samples are drawn together by recursive halving (_split_draws):
+    every column's non-zero entries are split into two halves, the 
+    reads falling into the left half are one hypergeometric draw, and 
+    both halves are split again with their share of the reads. Every 
+    level is one vectorized rng.hypergeometric call over the segments of
+    all columns, so the whole table takes about log2(max non-zero OTUs 
+    per sample) calls and no Python loop over samples; the sparsity 
+    pattern is reused for the output. numpy limits hypergeometric draws 
+    to samples with fewer than 10^9 reads, larger samples raise a 
+    ValueError.
+    '''
+    rng = np.random.default_rng(seed)
+    
+    # Unpack the table into a csc matrix, remembering the labels
+    labels = None
+    if isinstance(counts, pd.DataFrame):
+        labels = (counts.index, counts.columns)
+        matrix = sparse.csc_matrix(counts.values)
+    elif sparse.issparse(counts):
+        matrix = sparse.csc_matrix(counts, copy=True)
+    else:
+        matrix = sparse.csc_matrix(np.asarray(counts))
+    matrix.sum_duplicates()
+    
+    depths = np.asarray(matrix.sum(0)).ravel()
+    keep = depths >= depth
+    if labels is not None:
+        for sample, reads in zip(labels[1][~keep], depths[~keep]):
+            print('dropping sample ' + str(sample) + ' with ' + 
+                  str(reads) + ' reads < ' + str(depth))
+    matrix = matrix[:, keep]
+    if np.any(depths[keep] >= 10**9):
+        raise ValueError('rarefy() supports samples with fewer than 10^9 reads')
+    
+    # Draw every sample from its non-zero counts
+    matrix.data = _split_draws(matrix.data.astype(np.int64), matrix.indptr, 
+                               depth, rng)
+    matrix.eliminate_zeros()
+    
+    if sparse.issparse(counts):
+        return matrix
+    if labels is not None:
+        return pd.DataFrame(matrix.toarray(), index=labels[0], 
+                            columns=labels[1][keep])
+    return matrix.toarray()
+
+def occurrence_stats(counts, n_reads):
+    '''Mean relative abundance and occurrence frequency of every OTU 
+        in a rarefied abundance table
+    
+    Parameters
+    ----------
+    counts: numpy array or scipy sparse matrix
+        Rarefied OTU abundance table with OTUs as rows and samples as 
+        columns.
+    n_reads: int
+        Uniform read depth of every sample.
+    
+    Returns
+    -------
+    mean_relative_abundance: numpy array
+        Mean relative abundance of every OTU across samples.
+    occurrence_frequency: numpy array
+        Fraction of samples in which every OTU occurs.
+    '''
+    n_samples = counts.shape[1]
+    if sparse.issparse(counts):
+        counts = sparse.csr_matrix(counts)
+        counts.eliminate_zeros()
+        row_sums = np.asarray(counts.sum(1)).ravel()
+        row_nonzero = np.diff(counts.indptr)
+    else:
+        row_sums = np.asarray(counts).sum(1)
+        row_nonzero = np.count_nonzero(counts, axis=1)
+    mean_relative_abundance = (1.0*row_sums)/n_reads/n_samples
+    occurrence_frequency = (1.0*row_nonzero)/n_samples
+    return(mean_relative_abundance, occurrence_frequency)
 
 def non_negative_int(arg):
     '''Argparser type: non-negative int
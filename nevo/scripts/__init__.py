@@ -17,4 +17,5 @@ def cli(ctx):
     ctx.call_on_close(_terribly_handle_brokenpipeerror)
 
 
-import_module('nevo.scripts._neutral_fit')
\ No newline at end of file
+import_module('nevo.scripts._neutral_fit')
+import_module('nevo.scripts._neutral_fit_batch')
\ No newline at end of file
@@ -1,18 +1,15 @@
 import os
 import click
 from .__init__ import cli
-from nevo.utils import (biom_addmetatax_custom_tcga_ehn,
-                          non_neutral_outliers)
-from nevo.neutral_fit import neufit
 
 
 @cli.command(name='neufit')
 @click.option(
-    '--fnData',
+    '--fnData', 'fnData',
     required=True,
     help='TODO')
 @click.option(
-    '--fnTaxonomy',
+    '--fnTaxonomy', 'fnTaxonomy',
     required=True,
     help='TODO')
 @click.option(
@@ -25,33 +22,59 @@ from nevo.neutral_fit import neufit
     help='TODO')
 @click.option(
     '--custom-filename',
-    required=True,
+    required=False,
+    default=None,
     help='TODO')
 @click.option(
     '--norm-graph',
     required=False,
+    type=bool,
     default=True,
     help='TODO')
 @click.option(
     '--colored-graph',
     required=False,
+    type=bool,
     default=True,
     help='TODO')
 @click.option(
     '--non-neutral',
     required=False,
+    type=bool,
     default=True,
     help='TODO')
 @click.option(
     '--non-save',
     required=False,
+    type=bool,
     default=False,
     help='TODO')
 @click.option(
     '--full-non-neutral',
     required=False,
+    type=bool,
     default=False,
     help='TODO')
+@click.option(
+    '--output-path',
+    required=False,
+    default=None,
+    help='Root directory of the outputs, default neufit_output_path.')
+@click.option(
+    '--engine',
+    required=False,
+    type=click.Choice(['lmfit', 'fast', 'ml']),
+    default='lmfit',
+    help="Fit engine of m: 'lmfit' and 'fast' fit the occurrence "
+         "frequencies by least squares, 'ml' maximizes the binomial "
+         "likelihood of the occurrence counts and reports a "
+         "profile-likelihood interval of m.")
+@click.option(
+    '--profile',
+    is_flag=True,
+    default=False,
+    help='Times every stage and samples its memory, written as '
+         '[name]_profile.json next to the .txt report.')
 def standalone_neufit(fnData : str,
                       fnTaxonomy : str,
                       output_filename : str,
@@ -61,7 +84,10 @@ def standalone_neufit(fnData : str,
                       colored_graph : bool = True,
                       non_neutral : bool = True,
                       non_save : bool = False,
-                      full_non_neutral : bool = True):
+                      full_non_neutral : bool = True,
+                      output_path : str = None,
+                      engine : str = 'lmfit',
+                      profile : bool = False):
     '''Calls all functions needed to create neutral model 
     
     Written by: Caitlin Guccione, 08-25-2021
@@ -99,11 +125,27 @@ def standalone_neufit(fnData : str,
         Class, Order, Family, Genus, Species, predicted_occurence, 
         lower_conf_int, and upper_conf_int. This data can be used for custom
         coloring of the neutral evolution graph. 
+    output_path: str, path, optional
+        Root directory of the outputs, default neufit_output_path.
+    engine: str, optional
+        Fit engine of m, 'lmfit' (default), 'fast' or 'ml', see neufit.
+    profile: bool, optional
+        If 'True', writes the time and memory of every stage (loading, 
+        rarefaction, fit, plots, ...) as [name]_profile.json.
     
     '''
+    #Imported here so the cli starts without the scientific stack
+    from nevo.neutral_fit import neufit, _plot_and_outliers, _write_profile
+    from nevo.neutral_fit_profile import profiling
+    
     # run within wrapper
-    neufit(fnData, fnTaxonomy, output_filename,
-           dataset_type, custom_filename,
-           norm_graph = norm_graph, colored_graph = colored_graph, non_neutral = non_neutral,
-           non_save = non_save,
-           full_non_neutral = full_non_neutral)
\ No newline at end of file
+    with profiling(profile) as profiler:
+        result = neufit(output_filename, dataset_type, fnData, fnTaxonomy, 
+                        full_non_neutral, engine=engine, 
+                        output_path=output_path)
+        if non_save == False:
+            result.write()
+        _plot_and_outliers(*result, dataset_type, norm_graph, colored_graph, 
+                           non_neutral, non_save)
+    if profiler is not None and non_save == False:
+        click.echo(_write_profile(profiler, result))
@@ -0,0 +1,67 @@
+import os
+import click
+from .__init__ import cli
+
+
+@cli.command(name='neufit-batch')
+@click.argument(
+    'manifest',
+    type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--output-dir',
+    required=True,
+    type=click.Path(file_okay=False),
+    help='Root directory of the neufit outputs of every job.')
+@click.option(
+    '--summary',
+    required=False,
+    default=None,
+    type=click.Path(dir_okay=False),
+    help='Summary table (TSV) of m, R^2, n_samples, n_otus and n_reads '
+         'per job; default neufit_batch_summary.tsv in --output-dir.')
+@click.option(
+    '--n-jobs',
+    required=False,
+    default=None,
+    type=int,
+    help='Number of worker processes; default all cores.')
+@click.option(
+    '--max-tables',
+    required=False,
+    default=4,
+    type=int,
+    help='Number of loaded tables every worker keeps in memory.')
+@click.option(
+    '--profile',
+    is_flag=True,
+    default=False,
+    help='Writes the time and memory of every stage of every job as '
+         '[name]_profile.json next to its .txt report.')
+def standalone_neufit_batch(manifest : str,
+                            output_dir : str,
+                            summary : str = None,
+                            n_jobs : int = None,
+                            max_tables : int = 4,
+                            profile : bool = False):
+    '''Runs neufit for every job of a YAML/TSV manifest
+
+    Datasets x cohorts x parameter sets of the manifest (see
+    nevo.neutral_fit_batch.read_manifest) are run on a process pool,
+    largest job first, and summarized in one table.
+    '''
+    #Imported here so the cli starts without the scientific stack
+    from nevo.neutral_fit_batch import read_manifest, run_batch
+
+    os.makedirs(output_dir, exist_ok=True)
+    if summary is None:
+        summary = os.path.join(output_dir, 'neufit_batch_summary.tsv')
+    jobs = read_manifest(manifest)
+    results = run_batch(jobs, output_path=output_dir, n_jobs=n_jobs,
+                        max_tables=max_tables, summary_fn=summary,
+                        profile=profile)
+    click.echo(results[['m', 'r_square', 'n_samples', 'n_otus',
+                        'n_reads']].to_string())
+    failed = results['error'].notna().sum()
+    if failed:
+        raise click.ClickException(str(failed) + ' of ' + str(len(results))
+                                   + ' jobs failed, see ' + summary)
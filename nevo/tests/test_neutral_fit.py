@@ -0,0 +1,209 @@
+import io
+import os
+import sys
+import shutil
+import tempfile
+import importlib
+import contextlib
+import unittest
+from unittest import mock
+import numpy as np
+from scipy import sparse
+import matplotlib
+matplotlib.use('Agg')
+import nevo.utils
+import pandas as pd
+import pandas.testing as pdt
+import nevo.neutral_fit
+from nevo.neutral_fit import neufit, neufit_cohorts
+from nevo.utils import read_fit_table
+from nevo.neutral_fit_simulate import simulate_neutral_table
+from nevo.neutral_fit_utils import fit_m
+from nevo.tests.test_neutral_fit_utils import synthetic_occurrence
+
+
+def simulated_table(n_otus = 300, n_samples = 30, seed = 0):
+    '''Small neutral table (matrix, obs_ids, sample_ids) for neufit'''
+    return(simulate_neutral_table(n_otus, n_samples, 0.05, 1000, seed=seed))
+
+
+def run_quietly(f, *args, **kws):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return(f(*args, **kws))
+
+
+def written_files(path):
+    return(sorted(os.path.relpath(os.path.join(root, fn), path)
+                  for root, dirs, fns in os.walk(path) for fn in fns))
+
+
+class PlotAndOutliersTests(unittest.TestCase):
+
+    def tearDown(self):
+        importlib.reload(nevo.utils)
+        importlib.reload(nevo.neutral_fit)
+
+    def test_without_ipython(self):
+        # Shown (non_save) plots and outliers fall back to print outside
+        # IPython instead of failing on an undefined display
+        with mock.patch.dict(sys.modules, {'IPython': None,
+                                           'IPython.display': None}):
+            utils = importlib.reload(nevo.utils)
+            neutral_fit = importlib.reload(nevo.neutral_fit)
+        self.assertIs(utils.display, print)
+        self.assertIs(neutral_fit.display, print)
+
+        p, occurrence, N = synthetic_occurrence(300)
+        occurr_freqs = neutral_fit._occurrence_table(
+            p, occurrence, ['otu_' + str(i) for i in range(len(p))], None,
+            'hutchKraken')
+        beta_fit = fit_m(occurr_freqs['mean_abundance'].values,
+                         occurr_freqs['occurrence'].values, N)
+        neutral_fit._neutral_prediction(occurr_freqs, beta_fit, 200)
+        shown = io.StringIO()
+        with contextlib.redirect_stdout(shown):
+            neutral_fit._plot_and_outliers(occurr_freqs, N, 200, 0.9,
+                                           beta_fit, 'test', 'hutchKraken',
+                                           norm_graph=True,
+                                           colored_graph=False,
+                                           non_neutral=True, non_save=True)
+        self.assertIn('Figure(', shown.getvalue())
+        self.assertIn('Difference off Neutral Model', shown.getvalue())
+
+
+class NeufitResultTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        # The default root of the outputs, which nothing may touch
+        self.default = os.path.join(self.path, 'default')
+        patch = mock.patch.object(nevo.neutral_fit, 'neufit_output_path',
+                                  self.default)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.output_path = os.path.join(self.path, 'out')
+        self.result = run_quietly(neufit, 'x', 'batch', simulated_table(),
+                                  None, seed=0, profile=True,
+                                  full_non_neutral=True,
+                                  output_path=self.output_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_nothing_written(self):
+        self.assertIsInstance(self.result, nevo.neutral_fit.NeufitResult)
+        self.assertEqual(written_files(self.path), [])
+        self.assertIsNone(self.result.file_header)
+        # The header is only computed
+        self.assertTrue(self.result.header().startswith(
+            self.output_path + '/batch/x/x_'))
+        self.assertEqual(written_files(self.path), [])
+
+    def test_tuple(self):
+        occurr_freqs, n_reads, n_samples, r_square, beta_fit, file_header = \
+            self.result
+        self.assertIs(occurr_freqs, self.result.occurr_freqs)
+        self.assertIs(beta_fit, self.result.beta_fit)
+        self.assertEqual((n_reads, n_samples, r_square),
+                         (self.result.n_reads, self.result.n_samples,
+                          self.result.r_square))
+        self.assertEqual(file_header, self.result.header())
+        self.assertEqual(written_files(self.path), [])
+
+    def test_write(self):
+        fns = self.result.write(save_format='hdf5')
+        header = self.result.file_header
+        self.assertEqual(header, self.result.header())
+        self.assertEqual(fns, [header + '.txt', header + '_FullNonNeutral.csv',
+                               header + '_NeutralFit.h5',
+                               header + '_profile.json'])
+        self.assertEqual(written_files(self.path),
+                         sorted(os.path.relpath(fn, self.path)
+                                for fn in fns))
+        with open(fns[0]) as f:
+            self.assertEqual(f.read(), self.result.report)
+        non_neutral = pd.read_csv(fns[1], index_col=0)
+        self.assertEqual(list(non_neutral.index),
+                         list(self.result.non_neutral.index))
+        occurr_freqs, parameters = read_fit_table(fns[2])
+        pdt.assert_frame_equal(occurr_freqs, self.result.occurr_freqs,
+                               check_dtype=False)
+        self.assertEqual(parameters, self.result.parameters)
+        # The tuple now carries the written file_header
+        self.assertEqual(list(self.result)[5], header)
+
+    def test_single_writers(self):
+        self.assertEqual(self.result.write_report(),
+                         self.result.header() + '.txt')
+        self.assertEqual(written_files(self.path),
+                         [os.path.relpath(self.result.header() + '.txt',
+                                          self.path)])
+        fn = self.result.write_non_neutral()
+        self.assertTrue(fn.endswith('_FullNonNeutral.csv'))
+        fn = self.result.write_fit_table('hdf5')
+        self.assertTrue(fn.endswith('_NeutralFit.h5'))
+        self.assertEqual(len(written_files(self.path)), 3)
+
+    def test_output_path(self):
+        # write's output_path overrides neufit's, which overrides the
+        # default root
+        other = os.path.join(self.path, 'other')
+        fn = self.result.write_report(other)
+        self.assertTrue(fn.startswith(other + '/batch/x/x_'))
+        result = run_quietly(neufit, 'x', 'batch', simulated_table(), None,
+                             seed=0)
+        result.write()
+        roots = set(fn.split(os.sep)[0] for fn in written_files(self.path))
+        self.assertEqual(roots, {'other', 'default'})
+
+
+class NeufitCohortsTests(unittest.TestCase):
+
+    def test_one_otu_cohort(self):
+        # A cohort with a single OTU has no fit and is dropped with a
+        # warning; the other cohorts are fitted as without it
+        one = (sparse.csr_matrix(np.full((1, 10), 500)), ['otu_0'],
+               ['s' + str(i) for i in range(10)])
+        with self.assertWarnsRegex(UserWarning, 'fewer than 2 .*: one$'):
+            results = run_quietly(neufit_cohorts,
+                                  {'a': simulated_table(), 'one': one},
+                                  'batch', None, seed=0)
+        self.assertEqual(list(results), ['a'])
+        alone = run_quietly(neufit_cohorts, {'a': simulated_table()},
+                            'batch', None, seed=0)
+        self.assertEqual(results['a'].beta_fit.best_values['m'],
+                         alone['a'].beta_fit.best_values['m'])
+        self.assertEqual(results['a'].beta_fit.method, 'gauss-newton')
+
+
+class SaveFormatTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_unknown_format(self):
+        # Fails before fitting, and write before writing the report
+        with self.assertRaises(ValueError):
+            run_quietly(neufit, 'x', 'batch', simulated_table(), None,
+                        save_format='csv', output_path=self.path)
+        result = run_quietly(neufit, 'x', 'batch', simulated_table(), None,
+                             seed=0, output_path=self.path)
+        with self.assertRaises(ValueError):
+            result.write(save_format='csv')
+        self.assertEqual(written_files(self.path), [])
+
+    def test_missing_pyarrow(self):
+        with mock.patch.dict(sys.modules, {'pyarrow': None}):
+            for save_format in ('parquet', 'feather'):
+                with self.assertRaises(ImportError):
+                    run_quietly(neufit, 'x', 'batch', simulated_table(),
+                                None, save_format=save_format,
+                                output_path=self.path)
+        self.assertEqual(written_files(self.path), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
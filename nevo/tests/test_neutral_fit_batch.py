@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+from nevo.neutral_fit_batch import _file_tasks
+
+
+class FileTasksTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.files = {}
+        for name, size in (('small', 10), ('large', 1000)):
+            self.files[name] = os.path.join(self.path, name + '.csv')
+            with open(self.files[name], 'w') as f:
+                f.write('x'*size)
+        self.jobs = [{'name': name + str(i), 'data': self.files[name]}
+                     for i in range(4) for name in ('small', 'large')]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def task_files(self, tasks):
+        return([sorted(set(job['data'] for job in task)) for task in tasks])
+
+    def test_one_task_per_file(self):
+        tasks = _file_tasks(self.jobs, 2)
+        self.assertEqual(self.task_files(tasks), [[self.files['large']],
+                                                  [self.files['small']]])
+        self.assertEqual([job['name'] for job in tasks[1]],
+                         ['small0', 'small1', 'small2', 'small3'])
+
+    def test_split_with_idle_workers(self):
+        # 4 workers and 2 files: every file is split in 2 tasks, largest
+        # first, and never mixed with the other file
+        tasks = _file_tasks(self.jobs, 4)
+        self.assertEqual(self.task_files(tasks),
+                         [[self.files['large']]]*2 + [[self.files['small']]]*2)
+        self.assertEqual(sorted(job['name'] for task in tasks
+                                for job in task),
+                         sorted(job['name'] for job in self.jobs))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+import warnings
+import numpy as np
+from nevo.neutral_fit_simulate import simulate_neutral_table
+from nevo.neutral_fit_utils import rarefy, occurrence_stats, fit_m, fit_m_ml
+from nevo.neutral_fit_bootstrap import bootstrap_m, bootstrap_report
+
+
+def neutral_table(n_otus = 1000, n_samples = 60, m = 0.05, N = 2000,
+                  seed = 0):
+    '''Rarefied neutral simulation (uneven depths) and its best-fit m'''
+    rng = np.random.default_rng(seed)
+    counts = simulate_neutral_table(n_otus, n_samples, m, N,
+                                    depth=rng.integers(N, 2*N, n_samples),
+                                    seed=seed)[0]
+    counts = rarefy(counts.tocsc(), N, seed=seed)
+    mean_abundance, occurrence = occurrence_stats(counts, N)
+    present = occurrence > 0
+    m_fit = fit_m(mean_abundance[present], occurrence[present], N)
+    return(counts, N, m_fit.best_values['m'])
+
+
+class BootstrapMTests(unittest.TestCase):
+
+    def test_intervals_contain_m(self):
+        counts, N, m = neutral_table()
+        for resample in ('samples', 'otus'):
+            with warnings.catch_warnings():
+                warnings.simplefilter('error')
+                m_replicates, intervals = bootstrap_m(counts, N, m, 200,
+                                                      resample=resample,
+                                                      seed=0, n_jobs=1)
+            self.assertEqual(len(m_replicates), 200)
+            for method in ('percentile', 'bca'):
+                lower, upper = intervals.loc[method]
+                self.assertLess(lower, m, (resample, method))
+                self.assertGreater(upper, m, (resample, method))
+            # m is not at the edge of the replicates
+            below = np.mean(m_replicates < m)
+            self.assertTrue(0.1 < below < 0.9, (resample, below))
+
+    def test_ml_engine(self):
+        # Replicates of the ML fit are refitted by ML, not least squares
+        counts, N, m = neutral_table()
+        mean_abundance, occurrence = occurrence_stats(counts, N)
+        present = occurrence > 0
+        m_ml = fit_m_ml(mean_abundance[present], occurrence[present], N,
+                        counts.shape[1]).best_values['m']
+        self.assertGreater(abs(m_ml - m), 0.002)
+        m_replicates, intervals = bootstrap_m(counts, N, m_ml, 50, seed=0,
+                                              n_jobs=1, engine='ml')
+        self.assertTrue(0.1 < np.mean(m_replicates < m_ml) < 0.9)
+        lower, upper = intervals.loc['bca']
+        self.assertTrue(lower < m_ml < upper)
+
+    def test_m_outside_replicates(self):
+        counts, N, m = neutral_table()
+        with self.assertWarns(UserWarning):
+            m_replicates, intervals = bootstrap_m(counts, N, 2*m, 50,
+                                                  seed=0, n_jobs=1)
+        self.assertTrue(intervals.loc['bca'].isna().all())
+        self.assertTrue(intervals.loc['percentile'].notna().all())
+        self.assertIn('BCa undefined',
+                      bootstrap_report(m_replicates, intervals, 'samples'))
+
+
+if __name__ == '__main__':
+    unittest.main()
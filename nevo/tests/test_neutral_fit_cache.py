@@ -0,0 +1,105 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import contextlib
+from unittest import mock
+import nevo.neutral_fit
+from nevo.neutral_fit_cache import StageCache
+from nevo.utils import write_sparse_table
+from nevo.tests.test_utils import abundance_table
+
+
+class StageCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = StageCache(os.path.join(self.path, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_hit_and_miss(self):
+        calls = []
+        def compute():
+            calls.append(1)
+            return({'value': len(calls)})
+        key = self.cache.key('stage', 'input', 1)
+        self.assertIsNone(self.cache.get('stage', key))
+        self.assertEqual(self.cache.cached('stage', key, compute),
+                         {'value': 1})
+        self.assertEqual(self.cache.cached('stage', key, compute),
+                         {'value': 1})
+        self.assertEqual(len(calls), 1)
+        # Another input or stage is a miss
+        self.assertNotEqual(self.cache.key('stage', 'input', 2), key)
+        self.assertNotEqual(self.cache.key('other', 'input', 1), key)
+        self.assertEqual(self.cache.cached(
+            'stage', self.cache.key('stage', 'input', 2), compute),
+            {'value': 2})
+
+    def test_file_content(self):
+        fn = os.path.join(self.path, 'table.csv')
+        with open(fn, 'w') as f:
+            f.write('a')
+        key = self.cache.key('stage', fn)
+        self.assertEqual(self.cache.key('stage', fn), key)
+        with open(fn, 'w') as f:
+            f.write('ab')
+        self.assertNotEqual(self.cache.key('stage', fn), key)
+
+    def test_lru_eviction(self):
+        value = b'x'*10000
+        keys = [self.cache.key('stage', i) for i in range(4)]
+        for key in keys[:3]:
+            self.cache.put('stage', key, value)
+        size = self.cache.entries()['bytes'].iloc[0]
+        # Used in the order 1, 2, 0: 1 is the least recently used
+        for t, key in zip((100, 200, 300), keys):
+            os.utime(self.cache._path('stage', key), (t, t))
+        self.cache.get('stage', keys[0])
+        self.cache.max_bytes = 3*size + size//2
+        self.cache.put('stage', keys[3], value)
+        self.assertIsNone(self.cache.get('stage', keys[1]))
+        for key in (keys[0], keys[2], keys[3]):
+            self.assertEqual(self.cache.get('stage', key), value)
+        self.assertLessEqual(self.cache.entries()['bytes'].sum(),
+                             self.cache.max_bytes)
+        self.cache.clear()
+        self.assertEqual(len(self.cache.entries()), 0)
+
+    def test_neufit(self):
+        # A second identical run hits; the seed, arg_ignore_level and the
+        # content of the table are part of the key
+        fn = os.path.join(self.path, 'x_data.csv')
+        write_sparse_table(*abundance_table(), fn)
+        statistics = mock.Mock(wraps=nevo.neutral_fit._neutral_statistics)
+        def run(**kws):
+            kws = dict({'seed': 0, 'arg_ignore_level': 0}, **kws)
+            with contextlib.redirect_stdout(io.StringIO()):
+                return(nevo.neutral_fit.neufit('x', 'batch', fn, None,
+                                               cache=self.cache,
+                                               engine='fast', **kws))
+        with mock.patch.object(nevo.neutral_fit, '_neutral_statistics',
+                               statistics):
+            first = run()
+            second = run()
+            self.assertEqual(statistics.call_count, 1)
+            self.assertEqual(second.beta_fit.best_values['m'],
+                             first.beta_fit.best_values['m'])
+            run(seed=1)
+            self.assertEqual(statistics.call_count, 2)
+            run(arg_ignore_level=5)
+            self.assertEqual(statistics.call_count, 3)
+            write_sparse_table(*abundance_table(seed=1), fn)
+            run()
+            self.assertEqual(statistics.call_count, 4)
+            # Without a seed nothing is cached
+            run(seed=None)
+            run(seed=None)
+            self.assertEqual(statistics.call_count, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import io
+import unittest
+import contextlib
+import numpy as np
+import pandas.testing as pdt
+from nevo.neutral_fit_ensemble import neufit_ensemble
+from nevo.neutral_fit_simulate import simulate_neutral_table
+
+
+def uneven_table(seed = 0):
+    '''Neutral table with uneven depths, so every replicate rarefies'''
+    depth = np.random.default_rng(seed).integers(1000, 2000, 30)
+    return(simulate_neutral_table(500, 30, 0.05, 1000, depth=depth,
+                                  seed=seed))
+
+
+class NeufitEnsembleTests(unittest.TestCase):
+
+    def run_ensemble(self, **kws):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return(neufit_ensemble(uneven_table(), n_replicates=6, **kws))
+
+    def test_n_jobs(self):
+        # One RNG stream per replicate: the same seed gives the same
+        # replicates on any number of workers
+        replicates, otu_frequencies = self.run_ensemble(seed=0, n_jobs=1)
+        for n_jobs in (2, None):
+            other, other_frequencies = self.run_ensemble(seed=0,
+                                                         n_jobs=n_jobs)
+            pdt.assert_frame_equal(other, replicates)
+            pdt.assert_frame_equal(other_frequencies, otu_frequencies)
+
+    def test_replicates(self):
+        replicates, otu_frequencies = self.run_ensemble(seed=0, n_jobs=1)
+        self.assertEqual(len(replicates), 6)
+        # Replicates rarefy independently, and so do other seeds
+        self.assertGreater(replicates['m'].nunique(), 1)
+        other = self.run_ensemble(seed=1, n_jobs=1)[0]
+        self.assertFalse(np.allclose(other['m'], replicates['m']))
+        self.assertTrue(((otu_frequencies >= 0) &
+                         (otu_frequencies <= 1)).all().all())
+        pdt.assert_series_equal(otu_frequencies['above_frequency'] +
+                                otu_frequencies['below_frequency'],
+                                otu_frequencies['non_neutral_frequency'],
+                                check_names=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
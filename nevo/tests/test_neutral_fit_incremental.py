@@ -0,0 +1,78 @@
+import io
+import os
+import shutil
+import contextlib
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+from scipy import sparse
+from nevo.neutral_fit import neufit
+from nevo.neutral_fit_incremental import StatisticsStore
+
+
+class StatisticsStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.matrix = sparse.csr_matrix(rng.poisson(3.0, (20, 6)))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def round_trip(self, otu_ids, sample_ids):
+        store = StatisticsStore.from_table((self.matrix, pd.Index(otu_ids),
+                                            pd.Index(sample_ids)), seed=0)
+        fn = os.path.join(self.path, 'store.npz')
+        store.save(fn)
+        loaded = StatisticsStore.load(fn)
+        self.assertEqual(list(loaded.otu_ids), list(store.otu_ids))
+        self.assertEqual(list(loaded.sample_ids), list(store.sample_ids))
+        # Ids of the loaded store are found again
+        store.remove(sample_ids[:2])
+        loaded.remove(sample_ids[:2])
+        for expected, actual in zip(store.statistics(), loaded.statistics()):
+            npt.assert_array_equal(np.asarray(expected), np.asarray(actual))
+        return(loaded)
+
+    def test_string_ids(self):
+        loaded = self.round_trip(['otu_' + str(i) for i in range(20)],
+                                 ['s' + str(i) for i in range(6)])
+        self.assertEqual(loaded.otu_ids.dtype, object)
+
+    def test_integer_ids(self):
+        loaded = self.round_trip(list(range(100, 120)), list(range(6)))
+        self.assertEqual(loaded.sample_ids.dtype.kind, 'i')
+        loaded.remove([2])
+        self.assertEqual(loaded.n_samples, 3)
+
+    def test_mixed_ids(self):
+        self.round_trip(['otu_' + str(i) for i in range(19)] + [19],
+                        [0, 1, 's2', 's3', ('s', 4), 5.5])
+
+
+class StoreNeufitTests(unittest.TestCase):
+
+    def test_ignore_level(self):
+        rng = np.random.default_rng(0)
+        store = StatisticsStore.from_table(
+            (sparse.csr_matrix(rng.poisson(3.0, (50, 8))),
+             pd.Index(['otu_' + str(i) for i in range(50)]),
+             pd.Index(['s' + str(i) for i in range(8)])), seed=0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = neufit('store', 'batch', store, None, engine='fast')
+            self.assertEqual(len(result.occurr_freqs),
+                             np.count_nonzero(store.row_nonzero))
+            # The stored sums cannot be filtered like a table
+            with self.assertRaises(ValueError):
+                neufit('store', 'batch', store, None, arg_ignore_level=5,
+                       engine='fast')
+            with self.assertRaises(ValueError):
+                neufit('store', 'batch', store, None,
+                       arg_rarefaction_level=store.depth + 1, engine='fast')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import math
+import unittest
+from unittest import mock
+import nevo.neutral_fit_profile as neutral_fit_profile
+from nevo.neutral_fit_profile import StageProfiler, profiling, stage
+
+
+class StageProfilerTests(unittest.TestCase):
+
+    def test_nested_stage_paths(self):
+        with profiling(True) as profiler:
+            with stage('a'):
+                with stage('b'):
+                    with stage('c'):
+                        pass
+                with stage('d'):
+                    pass
+        self.assertEqual([record['stage'] for record in profiler.stages],
+                         ['a/b/c', 'a/b', 'a/d', 'a'])
+
+    def test_without_resource(self):
+        # Windows has no resource module: no peak RSS, but the profile
+        # is still recorded
+        with mock.patch.object(neutral_fit_profile, 'resource', None):
+            profiler = StageProfiler()
+            with profiler.stage('a'):
+                pass
+            record = profiler.record()
+        self.assertTrue(math.isnan(record['peak_rss_mb']))
+        self.assertEqual(record['stages'][0]['stage'], 'a')
+
+
+if __name__ == '__main__':
+    unittest.main()
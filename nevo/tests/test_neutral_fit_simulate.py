@@ -0,0 +1,128 @@
+import unittest
+import numpy as np
+import pandas as pd
+import numpy.testing as npt
+from nevo.neutral_fit_simulate import (source_abundances,
+                                       simulate_neutral_table,
+                                       simulate_communities, calibrate_m,
+                                       occurrence_envelope)
+from nevo.neutral_fit_utils import occurrence_stats, fit_m
+
+
+def fitted_m(counts, N):
+    '''m neufit fits to a table with N reads in every sample'''
+    mean_abundance, occurrence = occurrence_stats(counts.tocsc(), N)
+    present = occurrence > 0
+    return(fit_m(mean_abundance[present], occurrence[present],
+                 N).best_values['m'])
+
+
+class SimulateNeutralTableTests(unittest.TestCase):
+
+    def test_depths(self):
+        matrix, obs_ids, sample_ids = simulate_neutral_table(300, 20, 0.05,
+                                                             1000, seed=0)
+        self.assertEqual(matrix.shape, (300, 20))
+        self.assertEqual((len(obs_ids), len(sample_ids)), (300, 20))
+        npt.assert_array_equal(np.asarray(matrix.sum(0)).ravel(), 1000)
+        self.assertTrue((matrix.data > 0).all())
+        # One depth per sample, also across chunks of reads
+        depth = np.random.default_rng(0).integers(500, 1500, 20)
+        matrix = simulate_neutral_table(300, 20, 0.05, 1000, depth=depth,
+                                        seed=0, chunksize=3000)[0]
+        npt.assert_array_equal(np.asarray(matrix.sum(0)).ravel(), depth)
+
+    def test_seed(self):
+        first = simulate_neutral_table(300, 20, 0.05, 1000, seed=1)[0]
+        second = simulate_neutral_table(300, 20, 0.05, 1000, seed=1)[0]
+        self.assertEqual((first != second).nnz, 0)
+        other = simulate_neutral_table(300, 20, 0.05, 1000, seed=2)[0]
+        self.assertGreater((first != other).nnz, 0)
+
+    def test_source(self):
+        source = source_abundances(300, seed=0)
+        self.assertAlmostEqual(source.sum(), 1.0)
+        self.assertTrue((np.diff(source) <= 0).all())
+        # Mean relative abundances follow the source pool
+        matrix = simulate_neutral_table(300, 200, 0.2, 1000, source=source,
+                                        seed=0)[0]
+        mean = np.asarray(matrix.mean(1)).ravel()/1000
+        self.assertGreater(np.corrcoef(mean, source)[0, 1], 0.99)
+        with self.assertRaises(ValueError):
+            simulate_neutral_table(200, 20, 0.05, 1000, source=source)
+        with self.assertRaises(ValueError):
+            simulate_neutral_table(300, 20, 0.0, 1000)
+
+    def test_recovered_m(self):
+        # neufit recovers small m closely and overestimates large m
+        # (~0.3 for m = 0.2), see the notes of simulate_neutral_table
+        for seed in range(2):
+            m = fitted_m(simulate_neutral_table(1000, 200, 0.01, 1000,
+                                                seed=seed)[0], 1000)
+            self.assertLess(abs(m/0.01 - 1.0), 0.12, seed)
+            m = fitted_m(simulate_neutral_table(1000, 200, 0.2, 1000,
+                                                seed=seed)[0], 1000)
+            self.assertTrue(0.27 < m < 0.32, (seed, m))
+
+
+class SimulateCommunitiesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.source = source_abundances(300, seed=0)
+
+    def test_community_size(self):
+        counts = simulate_communities(self.source, 0.1, 200, 50, seed=0,
+                                      n_jobs=1, chunksize=16)
+        self.assertEqual(counts.shape, (300, 50))
+        npt.assert_array_equal(np.asarray(counts.sum(0)).ravel(), 200)
+        counts = simulate_communities(self.source, 0.1, 200, 10, seed=0,
+                                      n_jobs=1, events_per_step=1)
+        npt.assert_array_equal(np.asarray(counts.sum(0)).ravel(), 200)
+        with self.assertRaises(ValueError):
+            simulate_communities(self.source, 1.5, 200, 10)
+
+    def test_n_jobs(self):
+        # One RNG stream per chunk: the same seed gives the same
+        # communities on any number of workers
+        first = simulate_communities(self.source, 0.1, 200, 50, seed=0,
+                                     n_jobs=1, chunksize=16)
+        second = simulate_communities(self.source, 0.1, 200, 50, seed=0,
+                                      n_jobs=2, chunksize=16)
+        self.assertEqual((first != second).nnz, 0)
+        other = simulate_communities(self.source, 0.1, 200, 50, seed=1,
+                                     n_jobs=1, chunksize=16)
+        self.assertGreater((first != other).nnz, 0)
+
+    def test_calibrate_m(self):
+        # The bias documented in calibrate_m, and simultaneous events
+        # (default N//100 per step) fit as the exact Moran process
+        default = calibrate_m([0.05, 0.2], seed=0, n_jobs=1)
+        exact = calibrate_m([0.05, 0.2], seed=0, n_jobs=1, events_per_step=1)
+        for fits in (default, exact):
+            self.assertEqual(list(fits['m']), [0.05, 0.2])
+            self.assertTrue(0.058 < fits['m_fit'][0] < 0.072, fits)
+            self.assertTrue(0.34 < fits['m_fit'][1] < 0.42, fits)
+            npt.assert_allclose(fits['bias'], fits['m_fit']/fits['m'] - 1.0)
+        npt.assert_allclose(default['m_fit'], exact['m_fit'], rtol=0.03)
+
+    def test_occurrence_envelope(self):
+        # Neutral communities lie within the envelope of their own fit
+        counts = simulate_communities(self.source, 0.2, 200, 50, seed=0,
+                                      n_jobs=1)
+        mean_abundance, occurrence = occurrence_stats(counts.tocsc(), 200)
+        occurr_freqs = pd.DataFrame({'mean_abundance': mean_abundance,
+                                     'occurrence': occurrence},
+                                    index=['otu_' + str(i)
+                                           for i in range(300)])
+        envelope = occurrence_envelope(occurr_freqs, 0.2, 200, 50,
+                                       n_simulations=40, seed=1, n_jobs=1)
+        self.assertTrue(envelope.index.equals(occurr_freqs.index))
+        self.assertTrue((envelope['mc_lower'] <= envelope['mc_median']).all())
+        self.assertTrue((envelope['mc_median'] <= envelope['mc_upper']).all())
+        inside = (occurrence >= envelope['mc_lower']) & \
+            (occurrence <= envelope['mc_upper'])
+        self.assertGreater(inside.mean(), 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
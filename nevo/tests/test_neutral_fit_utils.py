@@ -0,0 +1,213 @@
+import io
+import unittest
+import contextlib
+from unittest import mock
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+from scipy import sparse
+import nevo.neutral_fit_utils as utils
+from nevo.neutral_fit_utils import (beta_cdf, fit_m, fit_m_lmfit, fit_m_ml,
+                                   fit_m_batch, rarefy)
+
+
+def synthetic_occurrence(n_otus, n_samples = 200, N = 10000, m = 0.05,
+                         seed = 0):
+    '''Mean abundances and occurrences drawn around the neutral curve'''
+    rng = np.random.default_rng(seed)
+    p = np.sort(rng.dirichlet(np.full(n_otus, 0.3)))
+    p = np.clip(p, 1e-9, None)
+    occurrence = rng.binomial(n_samples, beta_cdf(p, N, m))/n_samples
+    return p, occurrence, N
+
+
+def r_square(occurrence, best_fit):
+    return 1.0 - (np.sum(np.square(occurrence - best_fit))/
+                  np.sum(np.square(occurrence - occurrence.mean())))
+
+
+def count_table(n_otus = 200, n_samples = 40, seed = 0):
+    '''Sparse-ish counts with uneven sample depths'''
+    rng = np.random.default_rng(seed)
+    counts = rng.poisson(rng.lognormal(0.0, 2.0, (n_otus, 1)),
+                         (n_otus, n_samples))
+    counts[:, :3] //= 50 #Short samples
+    return(counts)
+
+
+class RarefyTests(unittest.TestCase):
+
+    def test_depth_and_bounds(self):
+        counts = count_table()
+        depth = 300
+        keep = counts.sum(0) >= depth
+        self.assertTrue(0 < keep.sum() < len(keep))
+        rarefied = rarefy(sparse.csr_matrix(counts), depth, seed=0)
+        self.assertTrue(sparse.isspmatrix_csc(rarefied))
+        rarefied = rarefied.toarray()
+        self.assertEqual(rarefied.shape, (counts.shape[0], keep.sum()))
+        npt.assert_array_equal(rarefied.sum(0), depth)
+        self.assertTrue(np.all(rarefied >= 0))
+        self.assertTrue(np.all(rarefied <= counts[:, keep]))
+
+    def test_hypergeometric_mean(self):
+        # Many copies of one sample: the mean and variance of every OTU
+        # are those of the multivariate hypergeometric distribution
+        sample = np.array([1, 2, 5, 10, 40, 200, 742])
+        total, depth, n_copies = sample.sum(), 250, 4000
+        rarefied = rarefy(np.repeat(sample[:, np.newaxis], n_copies, 1),
+                          depth, seed=1)
+        share = sample/total
+        mean = depth*share
+        variance = mean*(1.0 - share)*(total - depth)/(total - 1.0)
+        z = (rarefied.mean(1) - mean)/np.sqrt(variance/n_copies)
+        self.assertTrue(np.all(np.abs(z) < 4.5), z)
+        npt.assert_allclose(rarefied.var(1, ddof=1), variance, rtol=0.1)
+
+    def test_input_types(self):
+        counts = count_table()
+        otus = ['otu_' + str(i) for i in range(counts.shape[0])]
+        samples = ['s' + str(i) for i in range(counts.shape[1])]
+        frame = pd.DataFrame(counts, index=otus, columns=samples)
+        with contextlib.redirect_stdout(io.StringIO()) as printed:
+            from_frame = rarefy(frame, 300, seed=2)
+        self.assertIn('dropping sample s0', printed.getvalue())
+        keep = counts.sum(0) >= 300
+        self.assertEqual(list(from_frame.columns),
+                         list(np.array(samples)[keep]))
+        self.assertEqual(list(from_frame.index), otus)
+        from_sparse = rarefy(sparse.csr_matrix(counts), 300, seed=2)
+        from_array = rarefy(counts, 300, seed=2)
+        self.assertIsInstance(from_array, np.ndarray)
+        npt.assert_array_equal(from_frame.values, from_sparse.toarray())
+        npt.assert_array_equal(from_array, from_sparse.toarray())
+
+    def test_seed(self):
+        counts = sparse.csr_matrix(count_table())
+        first = rarefy(counts, 300, seed=3).toarray()
+        npt.assert_array_equal(first, rarefy(counts, 300, seed=3).toarray())
+        self.assertFalse(np.array_equal(first,
+                                        rarefy(counts, 300, seed=4).toarray()))
+        # The input is not modified
+        npt.assert_array_equal(counts.toarray(), count_table())
+
+
+class FitEngineEquivalenceTests(unittest.TestCase):
+    '''The fast engine (fit_m) against the lmfit engine (fit_m_lmfit)'''
+
+    def assert_equivalent(self, fast, reference, occurrence):
+        npt.assert_allclose(fast.best_values['m'],
+                            reference.best_values['m'], rtol=1e-6)
+        npt.assert_allclose(fast.stderr, reference.stderr, rtol=1e-4)
+        npt.assert_allclose(r_square(occurrence, fast.best_fit),
+                            r_square(occurrence, reference.best_fit),
+                            atol=1e-9)
+        npt.assert_allclose(fast.best_fit, reference.best_fit, atol=1e-8)
+
+    def test_equivalent(self):
+        for n_otus in (100, 1000, 10000):
+            p, occurrence, N = synthetic_occurrence(n_otus, seed=n_otus)
+            fast = fit_m(p, occurrence, N)
+            self.assertEqual(fast.method, 'gauss-newton')
+            self.assert_equivalent(fast, fit_m_lmfit(p, occurrence, N),
+                                   occurrence)
+
+    def test_stalled_at_minimum(self):
+        # The last step of this fit is halved below tol without lowering
+        # the sum of squares (rounding at the minimum) and is accepted
+        p, occurrence, N = synthetic_occurrence(2000)
+        fast = fit_m(p, occurrence, N)
+        self.assertEqual(fast.method, 'gauss-newton')
+        self.assert_equivalent(fast, fit_m_lmfit(p, occurrence, N),
+                               occurrence)
+        # ... which is the plateau rule: without it the fit falls back
+        with mock.patch.object(utils, 'plateau_rtol', -1.0):
+            self.assertEqual(fit_m(p, occurrence, N).method, 'bounded')
+
+    def test_stalled_away_from_minimum(self):
+        # Uphill steps are halved below tol; they must not be taken as
+        # converged but fall back to the bounded optimizer
+        p, occurrence, N = synthetic_occurrence(2000)
+        reference = fit_m_lmfit(p, occurrence, N)
+        beta_cdf_dm = utils.beta_cdf_dm
+        with mock.patch.object(utils, 'beta_cdf_dm',
+                               lambda *args: -beta_cdf_dm(*args)):
+            fast = fit_m(p, occurrence, N)
+        self.assertEqual(fast.method, 'bounded')
+        npt.assert_allclose(fast.best_values['m'],
+                            reference.best_values['m'], rtol=1e-6)
+
+
+class FitMBatchTests(unittest.TestCase):
+
+    def test_small_cohorts(self):
+        # Cohorts with fewer than 2 OTUs, first, between and last, are
+        # skipped without touching the statistics of their neighbours
+        a, b = synthetic_occurrence(500), synthetic_occurrence(300, seed=3)
+        empty = (np.array([]), np.array([]), 10000)
+        cohorts = {'empty_first': empty, 'a': a,
+                   'one': (a[0][:1], a[1][:1], 10000), 'b': b,
+                   'empty_last': empty}
+        fits = fit_m_batch(cohorts)
+        for name in ('empty_first', 'one', 'empty_last'):
+            self.assertEqual(fits.loc[name, 'method'], 'skipped')
+            self.assertTrue(fits.loc[name, ['m', 'stderr', 'r_square',
+                                            'chisqr']].isna().all())
+        for name in ('a', 'b'):
+            single = fit_m(*cohorts[name])
+            npt.assert_allclose(fits.loc[name, 'm'],
+                                single.best_values['m'], rtol=1e-8)
+            npt.assert_allclose(fits.loc[name, 'chisqr'], single.chisqr,
+                                rtol=1e-8)
+            npt.assert_allclose(fits.loc[name, 'r_square'],
+                                r_square(cohorts[name][1],
+                                         single.best_fit), rtol=1e-8)
+
+    def test_refit_method(self):
+        # Cohorts the batch does not converge on are refitted one by one
+        # with fit_m and carry its method
+        cohorts = {'a': synthetic_occurrence(500),
+                   'b': synthetic_occurrence(300, seed=3)}
+        gauss_newton_m = utils._gauss_newton_m
+        calls = []
+        def first_fails(*args):
+            m, converged, nfev = gauss_newton_m(*args)
+            calls.append(1)
+            if len(calls) == 1:
+                converged = np.array([True, False])
+            return(m, converged, nfev)
+        with mock.patch.object(utils, '_gauss_newton_m', first_fails):
+            fits = fit_m_batch(cohorts)
+        self.assertEqual(list(fits['method']), ['gauss-newton',
+                                                'gauss-newton'])
+        self.assertEqual(len(calls), 2)
+        beta_cdf_dm = utils.beta_cdf_dm
+        with mock.patch.object(utils, 'beta_cdf_dm',
+                               lambda *args: -beta_cdf_dm(*args)):
+            fits = fit_m_batch(cohorts)
+        self.assertEqual(list(fits['method']), ['bounded', 'bounded'])
+        for name in cohorts:
+            npt.assert_allclose(fits.loc[name, 'm'],
+                                fit_m(*cohorts[name]).best_values['m'],
+                                rtol=1e-6)
+
+
+class FitMMLTests(unittest.TestCase):
+
+    def test_without_interval(self):
+        p, occurrence, N = synthetic_occurrence(1000)
+        full = fit_m_ml(p, occurrence, N, 200)
+        fit = fit_m_ml(p, occurrence, N, 200, alpha=None)
+        self.assertIsNone(fit.m_interval)
+        self.assertEqual(fit.best_values['m'], full.best_values['m'])
+        self.assertTrue(full.m_interval[0] < full.best_values['m'] <
+                        full.m_interval[1])
+
+    def test_every_otu_everywhere(self):
+        p = np.random.default_rng(0).dirichlet(np.full(50, 0.3))
+        with self.assertRaises(ValueError):
+            fit_m_ml(p, np.ones(50), 2000, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,346 @@
+import io
+import os
+import shutil
+import contextlib
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pandas.testing as pdt
+from biom import Table
+from biom.util import biom_open
+from scipy import sparse
+from nevo.utils import (biom2table_tax, write_fit_table, read_fit_table,
+                        non_neutral_outliers, write_sparse_table,
+                        write_sparse_npz, read_sparse_table, scan_table,
+                        load_abundances, read_biom_columns,
+                        read_biom_cohorts, split_cohorts, cohort_columns,
+                        tcga_ehn_cohorts)
+from nevo.neutral_fit import neufit
+
+ranks = ['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
+
+
+def abundance_table(n_otus = 200, n_samples = 30, seed = 0):
+    '''(matrix, obs_ids, sample_ids) with uneven depths and rare OTUs'''
+    rng = np.random.default_rng(seed)
+    counts = rng.poisson(rng.lognormal(-1.0, 2.0, (n_otus, 1)),
+                         (n_otus, n_samples))
+    return(sparse.csr_matrix(counts),
+           pd.Index(['otu_' + str(i) for i in range(n_otus)]),
+           pd.Index(['s' + str(i) for i in range(n_samples)]))
+
+
+def quiet_neufit(data, **kws):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return(neufit('x', 'batch', data, None, **kws))
+
+
+class FitTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_hdf5_round_trip(self):
+        occurr_freqs = pd.DataFrame(
+            {'mean_abundance': [0.1, 0.2, 0.3],
+             'occurrence': [0.5, 0.75, 1.0],
+             'Genus': ['Bacillus', None, 'Bacillus'],
+             'taxonomy_0': pd.array(['k__A', 'k__B', 'k__A'], dtype='str'),
+             'note': np.array(['x', 1, None], dtype=object),
+             'non_neutral': [True, False, True]},
+            index=pd.Index(['otu_0', 'otu_1', 'otu_2'], name='otu_id'))
+        parameters = {'m': 0.05, 'N': 2000}
+        fn = os.path.join(self.path, 'fit.h5')
+        write_fit_table(occurr_freqs, parameters, fn)
+        table, read_parameters = read_fit_table(fn)
+
+        self.assertEqual(read_parameters, parameters)
+        self.assertEqual(list(table.columns), list(occurr_freqs.columns))
+        pdt.assert_index_equal(table.index, occurr_freqs.index)
+        pdt.assert_series_equal(table['Genus'],
+                                occurr_freqs['Genus'].astype('category'))
+        for column in ('taxonomy_0', 'note'):
+            self.assertTrue(pd.api.types.is_string_dtype(table[column]))
+        self.assertEqual(list(table['taxonomy_0']), ['k__A', 'k__B', 'k__A'])
+        self.assertEqual(list(table['note'][:2]), ['x', '1'])
+        self.assertTrue(pd.isna(table['note'].iloc[2]))
+        for column in ('mean_abundance', 'occurrence', 'non_neutral'):
+            pdt.assert_series_equal(table[column], occurr_freqs[column])
+
+
+class Biom2TableTaxTests(unittest.TestCase):
+
+    def test_rank_columns(self):
+        path = tempfile.mkdtemp()
+        try:
+            metadata = [{'taxonomy': [r[0].lower() + '__' + str(i)
+                                      for r in ranks]} for i in range(3)]
+            table = Table(np.arange(6).reshape(3, 2), ['o0', 'o1', 'o2'],
+                          ['s0', 's1'], observation_metadata=metadata)
+            with biom_open(os.path.join(path, 'table.biom'), 'w') as f:
+                table.to_hdf5(f, 'test')
+            feature_table, taxonomy = biom2table_tax(path, 'table.biom')
+        finally:
+            shutil.rmtree(path)
+        self.assertEqual(list(taxonomy.columns), ranks)
+        self.assertEqual(taxonomy.loc['o1', 'Genus'], 'g__1')
+
+
+def iterrows_outliers(occurr_freqs, dataset_type, threshold = 0.5):
+    '''non_neutral_outliers before vectorization, as the reference'''
+    standoutMicrobes = pd.DataFrame(columns = ('Difference off Neutral Model',
+                                               'Kingdom', 'Phylum', 'Class',
+                                               'Order', 'Family', 'Genus',
+                                               'Species'))
+    row_count = 0
+    for i,j in occurr_freqs.iterrows():
+        diff = abs(j['occurrence'] - j['predicted_occurrence'])
+        if diff > threshold:
+            if dataset_type == 'TCGA_WGS':
+                standoutMicrobes.loc[row_count] = [diff, j['Domain'],
+                                                   j['Phylum'], j['Class'],
+                                                   j['Order'], j['Family'],
+                                                   j['Genus'], j['Species']]
+            else:
+                standoutMicrobes.loc[row_count] = [diff, j['Kingdom'],
+                                                   j['Phylum'], j['Class'],
+                                                   j['Order'], j['Family'],
+                                                   j['Genus'], j['Species']]
+            row_count +=1
+    return(standoutMicrobes.sort_values(by =['Difference off Neutral Model'],
+                                        ascending=False))
+
+
+class NonNeutralOutliersTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        n = 40
+        self.occurr_freqs = pd.DataFrame(
+            {'mean_abundance': np.sort(rng.random(n)),
+             'occurrence': rng.random(n),
+             'predicted_occurrence': rng.random(n)},
+            index=pd.Index(['otu_' + str(i) for i in range(n)],
+                           name='otu_id'))
+        for rank in ['Domain'] + ranks:
+            self.occurr_freqs[rank] = [rank[0] + str(i) for i in range(n)]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def written(self, occurr_freqs, dataset_type, **kws):
+        file_header = os.path.join(self.path, dataset_type)
+        with contextlib.redirect_stdout(io.StringIO()):
+            non_neutral_outliers(file_header, occurr_freqs, dataset_type,
+                                 False, **kws)
+        with open(file_header + '_NonNeutral_Outliers.csv') as f:
+            return(f.read())
+
+    def reference(self, occurr_freqs, dataset_type):
+        return(iterrows_outliers(occurr_freqs, dataset_type).to_csv(sep='\t'))
+
+    def test_same_csv_as_iterrows(self):
+        # Both Domain and Kingdom: Kingdom is reported except for TCGA_WGS
+        for dataset_type in ('hutchKraken', 'TCGA_WGS'):
+            self.assertEqual(self.written(self.occurr_freqs, dataset_type),
+                             self.reference(self.occurr_freqs, dataset_type))
+        self.assertIn('\tK', self.written(self.occurr_freqs, 'hutchKraken'))
+        self.assertIn('\tD', self.written(self.occurr_freqs, 'TCGA_WGS'))
+
+    def test_missing_highest_rank(self):
+        # Only one of Domain and Kingdom: it is reported as Kingdom
+        for dataset_type, missing in (('hutchKraken', 'Kingdom'),
+                                      ('TCGA_WGS', 'Domain')):
+            occurr_freqs = self.occurr_freqs.drop(columns=missing)
+            other = 'Domain' if missing == 'Kingdom' else 'Kingdom'
+            reference = self.occurr_freqs.copy()
+            reference[missing] = reference[other]
+            self.assertEqual(self.written(occurr_freqs, dataset_type),
+                             self.reference(reference, dataset_type))
+
+    def test_top(self):
+        reference = iterrows_outliers(self.occurr_freqs, 'hutchKraken')
+        for top in (0, 3, len(reference), len(reference) + 5):
+            written = pd.read_csv(io.StringIO(self.written(
+                self.occurr_freqs, 'hutchKraken', top=top)), sep='\t',
+                index_col=0)
+            expected = pd.read_csv(io.StringIO(reference.head(top).to_csv(
+                sep='\t')), sep='\t', index_col=0)
+            pdt.assert_frame_equal(written.reset_index(drop=True),
+                                   expected.reset_index(drop=True))
+        # A pure ranking with threshold 0
+        written = pd.read_csv(io.StringIO(self.written(
+            self.occurr_freqs, 'hutchKraken', threshold=0, top=5)),
+            sep='\t', index_col=0)
+        diff = np.abs(self.occurr_freqs['occurrence'] -
+                      self.occurr_freqs['predicted_occurrence'])
+        npt.assert_allclose(written['Difference off Neutral Model'],
+                            np.sort(diff)[::-1][:5])
+
+
+class ScanTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.table = abundance_table()
+        self.tsv = os.path.join(self.path, 'x_data.csv')
+        write_sparse_table(*self.table, self.tsv)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_scan(self):
+        # 37 does not divide the 200 rows
+        matrix, obs_ids, sample_ids = self.table
+        sums = np.asarray(matrix.sum(1)).ravel()
+        for chunksize in (37, 200, 10000):
+            for ignore in (None, 5):
+                keep = sums > (ignore or -1)
+                (sample_reads, row_sums, row_nonzero, ids, samples,
+                 kept) = scan_table(self.tsv, chunksize, ignore,
+                                    keep_matrix=True)
+                npt.assert_array_equal(sample_reads,
+                                       np.asarray(matrix[keep].sum(0))
+                                       .ravel())
+                npt.assert_array_equal(row_sums, sums[keep])
+                npt.assert_array_equal(row_nonzero, matrix[keep].getnnz(1))
+                self.assertEqual(list(ids), list(obs_ids[keep]))
+                self.assertEqual(list(samples), list(sample_ids))
+                npt.assert_array_equal(kept.toarray(),
+                                       matrix[keep].toarray())
+        read = read_sparse_table(self.tsv, chunksize=37)
+        npt.assert_array_equal(read[0].toarray(), matrix.toarray())
+        self.assertEqual(list(read[1]), list(obs_ids))
+
+    def test_neufit_parity(self):
+        # The same statistics and m from memory, the table file (whole or
+        # streamed in chunks) and npz
+        npz = os.path.join(self.path, 'x.npz')
+        write_sparse_npz(*self.table, npz)
+        kws = {'seed': 0, 'arg_ignore_level': 5, 'engine': 'fast'}
+        reference = quiet_neufit(self.table, **kws)
+        for data, chunksize in ((self.tsv, None), (self.tsv, 37),
+                                (npz, None)):
+            result = quiet_neufit(data, chunksize=chunksize, **kws)
+            pdt.assert_frame_equal(result.occurr_freqs,
+                                   reference.occurr_freqs)
+            self.assertEqual(result.beta_fit.best_values['m'],
+                             reference.beta_fit.best_values['m'])
+
+
+class CohortTests(unittest.TestCase):
+
+    def setUp(self):
+        scc, keratinizing = ('Squamous cell carcinoma, NOS',
+                             'Squamous cell carcinoma, keratinizing, NOS')
+        self.meta = pd.DataFrame(
+            [('h0', 'Head and Neck', scc),
+             ('e0', 'Esophagus', scc),
+             ('e1', 'Esophagus', 'Adenocarcinoma, NOS'),
+             ('e2', 'Esophagus', keratinizing),
+             ('e3', 'Esophagus', 'Basaloid squamous cell carcinoma'),
+             ('h1', 'Head and Neck', 'Adenocarcinoma, NOS'),
+             ('e1', 'Esophagus', 'Adenocarcinoma, NOS'), #Duplicate row
+             ('z0', 'Esophagus', scc)], #Not in the table
+            columns=['sample_name', 'primary_site', 'primary_diagnosis'])
+        self.sample_ids = ['e3', 'h0', 'e0', 'x0', 'e2', 'h1', 'e1']
+
+    def members(self, columns):
+        return({cohort: [self.sample_ids[i] for i in idx]
+                for cohort, idx in columns.items()})
+
+    def test_tcga_cohorts(self):
+        # Only the two squamous diagnoses are SCC, not every esophagus
+        # sample (the old "== 'A' or 'B'" test); x0 has no metadata
+        with contextlib.redirect_stdout(io.StringIO()):
+            columns = cohort_columns(self.sample_ids, self.meta,
+                                     tcga_ehn_cohorts)
+        self.assertEqual(self.members(columns),
+                         {'hn': ['h0', 'h1'],
+                          'e': ['e3', 'e0', 'e2', 'e1'],
+                          'e_scc': ['e0', 'e2'],
+                          'e_eac': ['e1']})
+
+    def test_column_and_query(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            by_site = cohort_columns(self.sample_ids, self.meta,
+                                     'primary_site')
+            query = cohort_columns(
+                self.sample_ids, self.meta,
+                {'adeno': "primary_diagnosis.str.startswith('Adeno')"})
+        self.assertEqual(self.members(by_site),
+                         {'Esophagus': ['e3', 'e0', 'e2', 'e1'],
+                          'Head and Neck': ['h0', 'h1']})
+        self.assertEqual(self.members(query), {'adeno': ['h1', 'e1']})
+
+    def test_split(self):
+        matrix = sparse.csr_matrix(np.arange(21).reshape(3, 7))
+        with contextlib.redirect_stdout(io.StringIO()):
+            cohorts = split_cohorts(matrix, ['a', 'b', 'c'], self.sample_ids,
+                                    self.meta, tcga_ehn_cohorts)
+        cohort, obs_ids, sample_ids = cohorts['e_scc']
+        self.assertEqual(list(sample_ids), ['e0', 'e2'])
+        npt.assert_array_equal(cohort.toarray(), matrix.toarray()[:, [2, 4]])
+
+
+class ReadBiomTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.table = abundance_table()
+        matrix, obs_ids, sample_ids = self.table
+        self.biom = os.path.join(self.path, 'x.biom')
+        with biom_open(self.biom, 'w') as f:
+            Table(matrix, list(obs_ids), list(sample_ids)).to_hdf5(f, 'test')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_columns(self):
+        matrix, obs_ids, sample_ids = self.table
+        # A subset of samples, out of order and with runs, and of OTUs
+        cols = [7, 3, 4, 5, 21, 0]
+        rows = [150, 2, 3, 99]
+        for samples, observations in ((None, None), (sample_ids[cols], None),
+                                      (None, obs_ids[rows]),
+                                      (sample_ids[cols], obs_ids[rows])):
+            read, read_obs, read_samples = read_biom_columns(
+                self.biom, samples, observations)
+            r = rows if observations is not None else slice(None)
+            c = cols if samples is not None else slice(None)
+            npt.assert_array_equal(read.toarray(),
+                                   matrix.toarray()[r][:, c])
+            self.assertEqual(list(read_obs), list(obs_ids[r]))
+            self.assertEqual(list(read_samples), list(sample_ids[c]))
+        with self.assertRaises(KeyError):
+            read_biom_columns(self.biom, ['s0', 'nope'])
+
+    def test_cohorts(self):
+        meta = pd.DataFrame({'sample_name': self.table[2],
+                             'site': ['a', 'b', 'c']*10})
+        groups = {'a': {'site': 'a'}, 'bc': "site in ['b', 'c']"}
+        read = read_biom_cohorts(self.biom, meta, groups)
+        split = split_cohorts(*self.table, meta, groups)
+        self.assertEqual(set(read), {'a', 'bc'})
+        for cohort in read:
+            npt.assert_array_equal(read[cohort][0].toarray(),
+                                   split[cohort][0].toarray())
+            self.assertEqual(list(read[cohort][2]), list(split[cohort][2]))
+
+    def test_neufit_parity(self):
+        kws = {'seed': 0, 'arg_ignore_level': 5, 'engine': 'fast'}
+        reference = quiet_neufit(self.table, **kws)
+        result = quiet_neufit(self.biom, **kws)
+        pdt.assert_frame_equal(result.occurr_freqs, reference.occurr_freqs)
+        self.assertEqual(result.beta_fit.best_values['m'],
+                         reference.beta_fit.best_values['m'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,86 @@
 import pandas as pd
-from biom import load_table 
+from biom import load_table, Table 
 import os
+import json
+import h5py
 import numpy as np
+from scipy import sparse
+from nevo.neutral_fit_profile import stage
+
+try:
+    from IPython.display import display
+except ImportError: #Outside notebooks without IPython
+    display = print
+
+neufit_input_path = '/home/cguccion/NeutralEvolutionModeling/ipynb/data_tax_csv' 
+#location of _data.csv and _tax.csv files for Neufit input
+
+tcgaEhnWGSgreg_meta = '/home/cguccion/rawData/April2021_Greg_TCGA_WGS/meta_expansion/13722_20210405-101126-TCGA-WGS-Qiita-sample-metadata_esoph_hnc_metaExpand.txt'
+tcgaEhnWGSgreg_taxa = '/home/cguccion/rawData/April2021_Greg_TCGA_WGS/raw_from_Greg/wol_gotu_taxonomy.csv'
+#Meta and taxa files of the TCGA_WGS biom files
+
+def biom2table_tax(datasetName, biomFilename):
+    '''Imports biom file -> biom Table, taxonomy pandas df (in memory)
+    
+    Parameters
+    ----------
+    datasetName: str
+        The filename of dataset ex. hutchKrakenAlex_biom 
+    biomFilename: str
+        The filename of biom file
+        
+    Returns
+    -------
+    featureTable: biom Table
+        The OTU abundance table, can be passed directly to neufit
+    pandas_TaxTable: pandas df
+        The corresponding taxonomy, indexed by OTU id
+    '''
+    #Make filename and import data
+    fullFilename = datasetName + '/' + biomFilename
+    with stage('load_table'):
+        featureTable = load_table(fullFilename) 
+    #https://biom-format.org/documentation/generated/biom.load_table.html
+    
+    pandas_TaxTable = pd.DataFrame(featureTable.metadata_to_dataframe('observation'))
+    #taxonomy_0, taxonomy_1, ... -> Kingdom, Phylum, ...
+    pandas_TaxTable = pandas_TaxTable.set_axis(
+        ['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 
+         'Species'][:pandas_TaxTable.shape[1]], axis=1)
+    
+    return(featureTable, pandas_TaxTable)
+
+def write_data_tax(featureTable, pandas_TaxTable, finalFilename):
+    '''Writes an in-memory table and taxonomy as data.csv, taxonomy.csv
+    
+    Parameters
+    ----------
+    featureTable: biom Table, pandas df or (matrix, obs_ids, sample_ids)
+        The OTU abundance table, anything accepted by load_abundances
+    pandas_TaxTable: pandas df
+        The corresponding taxonomy, indexed by OTU id
+    finalFilename: str
+        The filename to be used as the header in _data.csv and
+        _taxonomy.csv files
+        
+    Returns
+    -------
+    fnD: str
+        The file location of [name]_data.csv
+    fnT: str
+        The file location of [name]_taxonomy.csv
+    '''
+    matrix, obs_ids, sample_ids = load_abundances(featureTable)
+    
+    #Create _data.csv, straight from the sparse matrix
+    fnD = neufit_input_path + '/' + finalFilename + '_data.csv'
+    write_sparse_table(matrix, obs_ids, sample_ids, fnD)
+    
+    #Create _taxonomy.csv
+    fnT = neufit_input_path + '/' + finalFilename + '_taxonomy.csv'
+    pandas_TaxTable.to_csv(fnT, sep='\t')
+    
+    return(fnD, fnT)
 
 def biom2data_tax(datasetName, biomFilename, finalFilename):
     '''Imports biom file -> pandas dataframe -> data.csv, taxonomy.csv 
@@ -37,30 +116,331 @@ def biom2data_tax(datasetName, biomFilename, finalFilename):
      - Add more clear description of csv files 
      
       '''
-    neufit_input_path = '/home/cguccion/NeutralEvolutionModeling/ipynb/data_tax_csv' 
-    #location of _data.csv and _tax.csv files for Neufit input
+    featureTable, pandas_TaxTable = biom2table_tax(datasetName, biomFilename)
+    return(write_data_tax(featureTable, pandas_TaxTable, finalFilename))
 
+def biom_split_customTCGAehn(datasetName, biomFilename):
+    ''' Imports biom file -> splits apart head and neck from esoph 
+        (in memory), see biom_addMetaTax_customTCGAehn
     
-    #Make filename and import data
+    Parameters
+    ----------
+    datasetName: str
+        The filename of dataset ex. hutchKrakenAlex_biom 
+    biomFilename: str
+        The filename of biom file
+        
+    Returns
+    -------
+    cohorts: dict
+        Maps 'hn', 'e', 'e_scc' and 'e_eac' to a 
+        (matrix, obs_ids, sample_ids) tuple holding the sparse csc 
+        columns of that cohort; can be passed directly to neufit
+    pandas_TaxTable: pandas df
+        The corresponding taxonomy, indexed by gOTU
+    '''
+    
+    #Make filename and import all data into pandas df 
     fullFilename = datasetName + '/' + biomFilename
-    featureTable = load_table(fullFilename) 
-    #https://biom-format.org/documentation/generated/biom.load_table.html
+    meta = pd.read_csv(tcgaEhnWGSgreg_meta, sep = '\t') 
+    #Import the metadata into a pandas df
+    pandas_TaxTable = pd.read_csv(tcgaEhnWGSgreg_taxa) 
+    pandas_TaxTable = pandas_TaxTable.set_index(pandas_TaxTable.columns[0])
+    #Import the taxonomy into a pandas df, indexed by gOTU
     
-    #Create _data.csv
-    pandas_featureTable = pd.DataFrame(featureTable.matrix_data.toarray(),
-                                       featureTable.ids('observation'), 
-                                       featureTable.ids())
-    fnD = neufit_input_path + '/' + finalFilename + '_data.csv'
-    pandas_featureTable.to_csv(fnD, sep='\t')
+    #Custom : Seperate the Head and Neck Samples from Esophgous 
+    #Samples in the biom file, as column slices of the sparse matrix
+    if h5py.is_hdf5(fullFilename):
+        #HDF5 biom: read only the samples of the cohorts
+        with stage('read_biom_cohorts'):
+            sample_ids = read_biom_ids(fullFilename)[1]
+            cohorts = read_biom_cohorts(fullFilename, meta, tcga_ehn_cohorts)
+    else:
+        with stage('load_table'):
+            featureTable = load_table(fullFilename) 
+            #Loads biom file: https://biom-format.org/documentation/generated/biom.load_table.html
+            matrix = featureTable.matrix_data.tocsc() 
+            #Keep the table sparse, csc so the cohorts can be sliced by column
+            obs_ids = featureTable.ids('observation')
+            sample_ids = featureTable.ids()
+        with stage('split_cohorts'):
+            cohorts = split_cohorts(matrix, obs_ids, sample_ids, meta, 
+                                    tcga_ehn_cohorts)
     
-    #Create _taxonomy.csv
-    pandas_TaxTable = pd.DataFrame(featureTable.metadata_to_dataframe('observation'))
-    pandas_TaxTable.set_axis(['Kingdom', 'Phylum', 'Class', 'Order',
-                              'Family', 'Genus', 'Species'], axis=1)
-    fnT = neufit_input_path + '/' + finalFilename + '_taxonomy.csv'
-    pandas_TaxTable.to_csv(fnT, sep='\t')
+    #This should never print - just a saftey check 
+    assigned = len(cohorts['hn'][2]) + len(cohorts['e'][2])
+    if assigned != len(sample_ids):
+        print("something is off in the dataset -- not just Head and Neck and Esophagus")
     
-    return(fnD, fnT)
+    return(cohorts, pandas_TaxTable)
+
+tcga_ehn_cohorts = {
+    'hn': {'primary_site': 'Head and Neck'},
+    'e': {'primary_site': 'Esophagus'},
+    #Squamous cell carcinoma, NOS & Squamous cell carcinoma, 
+    #keratinizing, NOS -- there are a few other ones in there that are ignored
+    'e_scc': {'primary_site': 'Esophagus',
+              'primary_diagnosis': ['Squamous cell carcinoma, NOS', 
+                                    'Squamous cell carcinoma, keratinizing, NOS']},
+    'e_eac': {'primary_site': 'Esophagus', 
+              'primary_diagnosis': 'Adenocarcinoma, NOS'},
+}
+#Cohorts of the TCGA WGS esophagus / head and neck dataset, see split_cohorts
+
+def cohort_columns(sample_ids, meta, groups, sample_column = 'sample_name'):
+    '''Column indices of every cohort, from the sample metadata
+    
+    The metadata is indexed by sample id once and aligned to sample_ids 
+    with a single join, so the cost is linear in the number of samples 
+    and metadata rows.
+    
+    Parameters
+    ----------
+    sample_ids: list-like
+        Sample ids, one per column of the abundance table.
+    meta: pandas df
+        Sample metadata, one row per sample.
+    groups: str or dict
+        Either the name of a metadata column, giving one cohort per 
+        value of that column, or a dict mapping cohort name to 
+            - a dict {column: value or list of values}, all of which 
+            must match, or 
+            - a boolean query string evaluated on the metadata, e.g. 
+            "primary_site == 'Esophagus' and age > 50"
+    sample_column: str, optional
+        Metadata column holding the sample ids.
+    
+    Returns
+    -------
+    dict
+        Maps cohort name to the (sorted) integer column indices of its 
+        samples.
+    '''
+    meta = meta.drop_duplicates(sample_column).set_index(sample_column)
+    aligned = meta.reindex(pd.Index(sample_ids))
+    missing = aligned.index[aligned.isna().all(axis=1)]
+    if len(missing) > 0:
+        print(str(len(missing)) + ' samples are missing from the metadata '
+              'and are not in any cohort')
+    
+    if isinstance(groups, str):
+        values = aligned[groups].dropna().unique()
+        groups = {value: {groups: value} for value in values}
+    
+    columns = {}
+    for cohort, spec in groups.items():
+        if isinstance(spec, str):
+            mask = aligned.eval(spec).fillna(False).to_numpy(dtype=bool)
+        else:
+            mask = np.ones(len(aligned), dtype=bool)
+            for column, value in spec.items():
+                if isinstance(value, (list, tuple, set, np.ndarray)):
+                    mask &= aligned[column].isin(list(value)).to_numpy()
+                else:
+                    mask &= (aligned[column] == value).to_numpy()
+        columns[cohort] = np.flatnonzero(mask)
+    return(columns)
+
+def split_cohorts(matrix, obs_ids, sample_ids, meta, groups, 
+                  sample_column = 'sample_name'):
+    '''Splits an abundance table into cohorts defined by the metadata
+    
+    Every cohort is a column slice of the shared sparse matrix (only the
+    cohort's own entries are copied), see cohort_columns for the 
+    grouping spec.
+    
+    Parameters
+    ----------
+    matrix: scipy sparse matrix or numpy array
+        OTU abundance table with OTUs as rows and samples as columns.
+    obs_ids: list-like
+        OTU ids, one per row of matrix.
+    sample_ids: list-like
+        Sample ids, one per column of matrix.
+    meta: pandas df
+        Sample metadata, one row per sample.
+    groups: str or dict
+        Grouping spec, see cohort_columns.
+    sample_column: str, optional
+        Metadata column holding the sample ids.
+    
+    Returns
+    -------
+    dict
+        Maps cohort name to a (matrix, obs_ids, sample_ids) tuple that 
+        can be passed directly to neufit.
+    '''
+    matrix = sparse.csc_matrix(matrix)
+    sample_ids = np.asarray(sample_ids)
+    columns = cohort_columns(sample_ids, meta, groups, sample_column)
+    return({cohort: (matrix[:, idx], obs_ids, sample_ids[idx]) 
+            for cohort, idx in columns.items()})
+
+def read_biom_ids(fn):
+    '''Observation and sample ids of an HDF5 BIOM (2.x) file, without 
+        reading its matrix'''
+    with h5py.File(fn, 'r') as f:
+        return(pd.Index(f['observation/ids'].asstr()[()]), 
+               pd.Index(f['sample/ids'].asstr()[()]))
+
+def _positions(ids, wanted, axis):
+    '''Positions of the wanted ids in ids, KeyError if any is missing'''
+    positions = ids.get_indexer(pd.Index(wanted))
+    if (positions < 0).any():
+        missing = list(pd.Index(wanted)[positions < 0][:5])
+        raise KeyError(str((positions < 0).sum()) + ' ' + axis + 
+                       ' ids are not in the biom file, e.g. ' + str(missing))
+    return(positions)
+
+def _read_biom_major(group, positions, n_minor):
+    '''Reads the given rows of one compressed BIOM matrix (the sample 
+        CSC or observation CSR group) as a csr_matrix
+    
+    Only the data and indices of the wanted rows are read, one h5py 
+    slice per run of consecutive rows.
+    '''
+    unique, inverse = np.unique(positions, return_inverse=True)
+    indptr = group['indptr'][()]
+    starts, stops = indptr[unique], indptr[unique + 1]
+    runs = np.flatnonzero(np.diff(unique) != 1) + 1
+    data, indices = [], []
+    for run in np.split(np.arange(len(unique)), runs):
+        if len(run) == 0:
+            continue
+        start, stop = starts[run[0]], stops[run[-1]]
+        data.append(group['data'][start:stop])
+        indices.append(group['indices'][start:stop])
+    new_indptr = np.concatenate(([0], np.cumsum(stops - starts)))
+    matrix = sparse.csr_matrix(
+        (np.concatenate(data) if data else np.zeros(0), 
+         np.concatenate(indices) if indices else np.zeros(0, dtype=int), 
+         new_indptr), shape=(len(unique), n_minor))
+    return(matrix[inverse])
+
+def read_biom_columns(fn, samples = None, observations = None):
+    '''Reads only the needed samples (and observations) of an HDF5 BIOM 
+        file, out of core via h5py
+    
+    BIOM 2.x stores the table both compressed by sample (CSC) and by 
+    observation (CSR); only the slices of the requested samples are read,
+    so I/O and memory scale with the cohort instead of the whole file.
+    
+    Parameters
+    ----------
+    fn: str, path
+        HDF5 BIOM (2.x) file.
+    samples: list-like, optional
+        Sample ids to read, in the order of the returned columns; 
+        default all.
+    observations: list-like, optional
+        Observation ids to keep, in the order of the returned rows; 
+        default all. If no samples are given, only these rows are read.
+    
+    Returns
+    -------
+    matrix: scipy csc_matrix
+        Abundance table with the observations as rows and samples as 
+        columns.
+    obs_ids: pandas Index
+        Observation ids, one per row of matrix.
+    sample_ids: pandas Index
+        Sample ids, one per column of matrix.
+    '''
+    with h5py.File(fn, 'r') as f:
+        return(_read_biom_file(f, samples, observations))
+
+def _read_biom_file(f, samples, observations):
+    all_obs = pd.Index(f['observation/ids'].asstr()[()])
+    all_samples = pd.Index(f['sample/ids'].asstr()[()])
+    rows = None if observations is None else \
+        _positions(all_obs, observations, 'observation')
+    
+    if samples is None and rows is not None:
+        #Only observations wanted, read them from the CSR group
+        matrix = _read_biom_major(f['observation/matrix'], rows, 
+                                  len(all_samples))
+        return(matrix.tocsc(), all_obs[rows], all_samples)
+    
+    cols = np.arange(len(all_samples)) if samples is None else \
+        _positions(all_samples, samples, 'sample')
+    matrix = _read_biom_major(f['sample/matrix'], cols, len(all_obs)).T
+    obs_ids = all_obs
+    if rows is not None:
+        matrix, obs_ids = matrix.tocsr()[rows], all_obs[rows]
+    return(sparse.csc_matrix(matrix), obs_ids, all_samples[cols])
+
+def read_biom_cohorts(fn, meta, groups, sample_column = 'sample_name', 
+                      observations = None):
+    '''Splits an HDF5 BIOM file into cohorts, reading only their samples
+    
+    Like split_cohorts, but the samples of all cohorts are read once 
+    from the file with read_biom_columns instead of loading the whole 
+    table first.
+    
+    Parameters
+    ----------
+    fn: str, path
+        HDF5 BIOM (2.x) file.
+    meta: pandas df
+        Sample metadata, one row per sample.
+    groups: str or dict
+        Grouping spec, see cohort_columns.
+    sample_column: str, optional
+        Metadata column holding the sample ids.
+    observations: list-like, optional
+        Observation ids to keep; default all.
+    
+    Returns
+    -------
+    dict
+        Maps cohort name to a (matrix, obs_ids, sample_ids) tuple that 
+        can be passed directly to neufit.
+    '''
+    with h5py.File(fn, 'r') as f:
+        sample_ids = pd.Index(f['sample/ids'].asstr()[()])
+        columns = cohort_columns(sample_ids, meta, groups, sample_column)
+        needed = np.unique(np.concatenate([np.zeros(0, dtype=int)] + 
+                                          list(columns.values())))
+        matrix, obs_ids, read_ids = _read_biom_file(f, sample_ids[needed], 
+                                                    observations)
+    #Position of every needed sample in the columns read
+    local = np.full(len(sample_ids), -1)
+    local[needed] = np.arange(len(needed))
+    return({cohort: (matrix[:, local[idx]], obs_ids, read_ids[local[idx]]) 
+            for cohort, idx in columns.items()})
+
+def write_cohorts_customTCGAehn(cohorts, pandas_TaxTable, finalFilename):
+    '''Writes the cohorts of biom_split_customTCGAehn as data.csv, 
+        taxonomy.csv files, see biom_addMetaTax_customTCGAehn
+    
+    Parameters
+    ----------
+    cohorts: dict
+        Output of biom_split_customTCGAehn
+    pandas_TaxTable: pandas df
+        The corresponding taxonomy, indexed by gOTU
+    finalFilename: str
+        The filename to be used as the header in _data.csv and
+        _taxonomy.csv files
+    
+    Returns
+    -------
+    Same as biom_addMetaTax_customTCGAehn
+    '''
+    fns = {}
+    for cohort, prefix in (('hn', 'head_neck_'), ('e', 'esophagus_'),
+                           ('e_scc', 'esophagus_SCC_'), 
+                           ('e_eac', 'esophagus_EAC_')):
+        fnD = neufit_input_path + '/' + prefix + finalFilename + '_data.csv'
+        fnT = neufit_input_path + '/' + prefix + finalFilename + '_taxonomy.csv'
+        #Written with a leading row number, neufit reads it with index_col=1
+        pandas_TaxTable.reset_index().to_csv(fnT, sep='\t')
+        matrix, obs_ids, sample_ids = cohorts[cohort]
+        write_sparse_table(matrix, obs_ids, sample_ids, fnD)
+        fns[cohort] = (fnD, fnT)
+    
+    return(fns['hn'][0], fns['e'][0], fns['hn'][1], fns['e'][1], 
+           fns['e_scc'][0], fns['e_scc'][1], fns['e_eac'][0], fns['e_eac'][1])
 
 def biom_addMetaTax_customTCGAehn(datasetName, biomFilename, finalFilename):
     ''' Imports biom file -> pandas dataframe -> 
@@ -106,103 +486,366 @@ def biom_addMetaTax_customTCGAehn(datasetName, biomFilename, finalFilename):
      - Check that all ouputs match the return values here
      
       '''
+    cohorts, pandas_TaxTable = biom_split_customTCGAehn(datasetName, 
+                                                        biomFilename)
+    return(write_cohorts_customTCGAehn(cohorts, pandas_TaxTable, 
+                                       finalFilename))
+
+def load_abundances(data):
+    '''Normalizes any supported abundance table input to a sparse matrix
     
-    #Define filenames for meta and taxa files
-    tcgaEhnWGSgreg_ = '/home/cguccion/rawData/April2021_Greg_TCGA_WGS/raw_from_Greg'#Location of raw data
-    tcgaEhnWGSgreg_meta = str('/home/cguccion/rawData/April2021_Greg_TCGA_WGS/meta_expansion/13722_20210405-101126-TCGA-WGS-Qiita-sample-metadata_esoph_hnc_metaExpand.txt')
-    tcgaEhnWGSgreg_taxa = str(tcgaEhnWGSgreg_ + '/' + 'wol_gotu_taxonomy.csv')
+    Parameters
+    ----------
+    data: str, path, biom Table, pandas df or tuple
+        One of:
+            - path to a []_data.csv file (read with read_sparse_table)
+            - path to a .npz file (read with read_sparse_npz)
+            - path to a .biom file (HDF5 read with read_biom_columns)
+            - biom Table
+            - pandas df with OTUs as rows and samples as columns
+            - (matrix, obs_ids, sample_ids) with a numpy array or scipy 
+            sparse matrix
     
+    Returns
+    -------
+    matrix: scipy csr_matrix
+        OTU abundance table (int) with OTUs as rows and samples as columns.
+    obs_ids: pandas Index
+        OTU ids, one per row of matrix.
+    sample_ids: pandas Index
+        Sample ids, one per column of matrix.
+    '''
+    if isinstance(data, (str, os.PathLike)):
+        if str(data).lower().endswith('.npz'):
+            return(read_sparse_npz(data))
+        if str(data).lower().endswith('.biom'):
+            if h5py.is_hdf5(data):
+                matrix, obs_ids, sample_ids = read_biom_columns(data)
+                return(matrix.tocsr().astype(int), obs_ids, sample_ids)
+            data = load_table(data)
+        else:
+            return(read_sparse_table(data))
+    if isinstance(data, Table):
+        matrix = data.matrix_data
+        obs_ids, sample_ids = data.ids('observation'), data.ids()
+    elif isinstance(data, pd.DataFrame):
+        matrix = data.values
+        obs_ids, sample_ids = data.index, data.columns
+    elif isinstance(data, tuple) and len(data) == 3:
+        matrix, obs_ids, sample_ids = data
+    else:
+        raise TypeError('Unsupported abundance table: ' + str(type(data)))
+    matrix = sparse.csr_matrix(matrix).astype(int)
+    if matrix.shape != (len(obs_ids), len(sample_ids)):
+        raise ValueError('Abundance table shape ' + str(matrix.shape) + 
+                         ' does not match the number of ids')
+    return(matrix, pd.Index(obs_ids), pd.Index(sample_ids))
+
+def write_sparse_table(matrix, obs_ids, sample_ids, fn, chunksize = 10000):
+    '''Writes a sparse OTU abundance table as a _data.csv file 
     
-    #Make filename and import all data into pandas df 
-    fullFilename = datasetName + '/' + biomFilename
-    featureTable = load_table(fullFilename) 
-    #Loads biom file: https://biom-format.org/documentation/generated/biom.load_table.html
-    pandas_featureTable = pd.DataFrame(featureTable.matrix_data.toarray(),
-                                       featureTable.ids('observation'),
-                                       featureTable.ids())  
-                                        #Turn biom file into pandas df 
-    meta = pd.read_csv(tcgaEhnWGSgreg_meta, sep = '\t') 
-    #Import the metadata into a pandas df
-    pandas_TaxTable = pd.read_csv(tcgaEhnWGSgreg_taxa) 
-    #Import the taxonomy into a pandas df
+    The table is densified one block of rows at a time, so the full 
+    dense matrix is never held in memory. The output is identical to 
+    writing the dense pandas df with to_csv(fn, sep='\\t').
     
-    #Custom : Seperate the Head and Neck Samples from Esophgous 
-    #Samples in the biom file
-    hn_df = pd.DataFrame() #Biom file with just the head and neck samples
-    e_df = pd.DataFrame() #Biom file with just the esophagus samples
-    all_scc_df = pd.DataFrame() #Biom file with Squamous Cell carcinoma esophagus samples
-    eac_df = pd.DataFrame() #Biom file with EAC samples
+    Parameters
+    ----------
+    matrix: scipy sparse matrix
+        OTU abundance table with OTUs as rows and samples as columns.
+    obs_ids: list-like
+        OTU ids, one per row of matrix.
+    sample_ids: list-like
+        Sample ids, one per column of matrix.
+    fn: str, path
+        The file location of the _data.csv file to create. 
+    chunksize: int, optional
+        Number of rows densified and written at once.
+    '''
+    matrix = sparse.csr_matrix(matrix)
+    obs_ids = np.asarray(obs_ids)
+    with open(fn, 'w') as f:
+        for start in range(0, max(matrix.shape[0], 1), chunksize):
+            stop = start + chunksize
+            block = pd.DataFrame(matrix[start:stop].toarray(), 
+                                 obs_ids[start:stop], sample_ids)
+            block.to_csv(f, sep='\t', header=(start == 0))
+
+def write_sparse_npz(matrix, obs_ids, sample_ids, fn, compressed = True):
+    '''Writes a sparse OTU abundance table, with its ids, as one .npz file
     
-    for sample in pandas_featureTable.columns.values: 
-        
-        #Use the meta data to determine what cancer type the sample correlates to 
-        cancerType = meta[meta['sample_name'] == sample].reset_index().loc[0, 'primary_site'] 
-        #Finds the sample name which matches our i, 
-        #then finds the corresponding primary site in that row
-        
-        #Sort each cancer type into approriate dataframes
-        if cancerType == 'Head and Neck':
-            hn_df[sample] = pandas_featureTable.loc[:, sample]
-        elif cancerType == 'Esophagus':
-            #All esoph cancers
-            e_df[sample] = pandas_featureTable.loc[:, sample]
-            
-            #Break esoph cancer into Squamous cell carcinoma, NOS, 
-            #Squamous cell carcinoma, keratinizing, NOS & Adenocarcinoma, 
-            #NOS -- there are a few other ones in there than you have ignored 
-            esophCancerType = meta[meta['sample_name'] == sample].reset_index().loc[0, 'primary_diagnosis'] 
-            #Finds the sample name which matches our i, then 
-            #finds the corresponding primary site in that row
-            
-            if esophCancerType == 'Squamous cell carcinoma, NOS' or 'Squamous cell carcinoma, keratinizing, NOS':
-                all_scc_df[sample] = pandas_featureTable.loc[:, sample]
-            elif esophCancerType == 'Adenocarcinoma, NOS':
-                eac_df[sample] = pandas_featureTable.loc[:, sample]
-            
-        else:#This should never print - just a saftey check 
-            print("something is off in the dataset -- not just Head and Neck and Esophagus")
-        
-    #Create _data.csv and _taxonomy.csv files for head & neck and esophgous
-    
-    neufit_input_path = '/home/cguccion/NeutralEvolutionModeling/ipynb/data_tax_csv' 
-    #location of _data.csv and _tax.csv files for Neufit input
-    
-    #Head and Neck
-    fnD_hn = neufit_input_path + '/' + 'head_neck_' + \
-        finalFilename + '_data.csv'
-    fnT_hn = neufit_input_path + '/' +  'head_neck_' + \
-        finalFilename + '_taxonomy.csv'
-    pandas_TaxTable.to_csv(fnT_hn, sep='\t')
-    hn_df.to_csv(fnD_hn, sep='\t')
-    
-    #Esophgous
-    fnD_e = neufit_input_path + '/' + 'esophagus_' + \
-        finalFilename + '_data.csv'
-    fnT_e = neufit_input_path + '/' +  'esophagus_' + \
-        finalFilename + '_taxonomy.csv'
-    pandas_TaxTable.to_csv(fnT_e, sep='\t')
-    e_df.to_csv(fnD_e, sep='\t')
-    
-    ##Squamous Cell Carcinoma
-    fnD_e_scc = neufit_input_path + '/' + 'esophagus_SCC_' + \
-        finalFilename + '_data.csv'
-    fnT_e_scc = neufit_input_path + '/' +  'esophagus_SCC_' + \
-        finalFilename + '_taxonomy.csv'
-    pandas_TaxTable.to_csv(fnT_e_scc, sep='\t')
-    all_scc_df.to_csv(fnD_e_scc, sep='\t')
-    
-    ##EAC
-    fnD_e_eac = neufit_input_path + '/' + 'esophagus_EAC_' + \
-        finalFilename + '_data.csv'
-    fnT_e_eac = neufit_input_path + '/' +  'esophagus_EAC_' + \
-        finalFilename + '_taxonomy.csv'
-    pandas_TaxTable.to_csv(fnT_e_eac, sep='\t')
-    eac_df.to_csv(fnD_e_eac, sep='\t')
-    
-    
-    return(fnD_hn, fnD_e, fnT_hn, fnT_e, fnD_e_scc, fnT_e_scc, fnD_e_eac, fnT_e_eac)
+    Parameters
+    ----------
+    matrix: scipy sparse matrix
+        OTU abundance table with OTUs as rows and samples as columns.
+    obs_ids: list-like
+        OTU ids, one per row of matrix.
+    sample_ids: list-like
+        Sample ids, one per column of matrix.
+    fn: str, path
+        The .npz file to create.
+    compressed: bool, optional
+        If 'False', writes the arrays uncompressed (faster, larger).
+    '''
+    matrix = sparse.csr_matrix(matrix)
+    save = np.savez_compressed if compressed else np.savez
+    with open(fn, 'wb') as f:
+        save(f, data=matrix.data, indices=matrix.indices, 
+             indptr=matrix.indptr, shape=np.array(matrix.shape),
+             obs_ids=np.asarray(obs_ids, dtype=str), 
+             sample_ids=np.asarray(sample_ids, dtype=str))
 
-def non_neutral_outliers(file_header, occurr_freqs, dataset_type, non_save, threshold = 0.5):
+def read_sparse_npz(fn):
+    '''Reads a .npz OTU abundance table written by write_sparse_npz
+    
+    Returns
+    -------
+    matrix: scipy csr_matrix
+        OTU abundance table (int) with OTUs as rows and samples as columns.
+    obs_ids: pandas Index
+        OTU ids, one per row of matrix.
+    sample_ids: pandas Index
+        Sample ids, one per column of matrix.
+    '''
+    with np.load(fn) as f:
+        matrix = sparse.csr_matrix((f['data'], f['indices'], f['indptr']),
+                                   shape=tuple(f['shape']))
+        return(matrix.astype(int), pd.Index(f['obs_ids']), 
+               pd.Index(f['sample_ids']))
+
+def read_sparse_table(fn, chunksize = 10000):
+    '''Reads a _data.csv OTU abundance table into a sparse matrix
+    
+    The file is parsed one block of rows at a time and every block is 
+    converted to sparse before the next one is read, so the dense 
+    table is never held in memory.
+    
+    Parameters
+    ----------
+    fn: str, path
+        The path to []_data.csv file; often an OTU abudance table. May 
+        be gzip compressed (.gz).
+    chunksize: int, optional
+        Number of rows parsed at once.
+    
+    Returns
+    -------
+    matrix: scipy csr_matrix
+        OTU abundance table (int) with OTUs as rows and samples as columns.
+    obs_ids: pandas Index
+        OTU ids, one per row of matrix.
+    sample_ids: pandas Index
+        Sample ids, one per column of matrix.
+    '''
+    scan = scan_table(fn, chunksize, keep_matrix=True)
+    return(scan[5], scan[3], scan[4])
+
+def scan_table(fn, chunksize = 10000, arg_ignore_level = None, 
+               keep_matrix = False):
+    '''Streams a _data.csv OTU abundance table in one pass
+    
+    Every block of rows is parsed, filtered and reduced to its sums 
+    before the next one is read, so without keep_matrix the memory used
+    is bounded by chunksize rows, whatever the size of the table.
+    
+    Parameters
+    ----------
+    fn: str, path
+        The path to []_data.csv file, may be gzip compressed (.gz).
+    chunksize: int, optional
+        Number of rows parsed at once.
+    arg_ignore_level: int, optional
+        If set, OTUs with at most this many reads in total are dropped 
+        while reading, as neufit's arg_ignore_level.
+    keep_matrix: bool, optional
+        If 'True', also returns the (filtered) table as a sparse matrix.
+    
+    Returns
+    -------
+    sample_reads: numpy array
+        Reads per sample (column sums) of the kept OTUs.
+    row_sums: numpy array
+        Reads per kept OTU.
+    row_nonzero: numpy array
+        Number of samples in which every kept OTU occurs.
+    obs_ids: pandas Index
+        Ids of the kept OTUs.
+    sample_ids: pandas Index
+        Sample ids.
+    matrix: scipy csr_matrix or None
+        The kept rows (int), None unless keep_matrix.
+    '''
+    blocks = []
+    obs_ids = []
+    row_sums = []
+    row_nonzero = []
+    sample_reads = None
+    sample_ids = None
+    for chunk in pd.read_table(fn, header=0, index_col=0, sep='\t', 
+                               chunksize=chunksize):
+        values = chunk.values.astype(int)
+        sums = values.sum(1)
+        ids = chunk.index
+        if arg_ignore_level is not None:
+            keep = sums > arg_ignore_level
+            values, sums, ids = values[keep], sums[keep], ids[keep]
+        if sample_reads is None:
+            sample_ids = chunk.columns
+            sample_reads = np.zeros(len(sample_ids), dtype=values.dtype)
+        sample_reads += values.sum(0)
+        row_sums.append(sums)
+        row_nonzero.append(np.count_nonzero(values, axis=1))
+        obs_ids.append(ids)
+        if keep_matrix == True:
+            blocks.append(sparse.csr_matrix(values))
+    if sample_ids is None:#Header only, no OTUs
+        sample_ids = pd.read_table(fn, header=0, index_col=0, sep='\t').columns
+        matrix = sparse.csr_matrix((0, len(sample_ids)), dtype=int)
+        return(np.zeros(len(sample_ids), dtype=int), np.zeros(0, dtype=int),
+               np.zeros(0, dtype=int), pd.Index([]), sample_ids, 
+               matrix if keep_matrix == True else None)
+    matrix = sparse.vstack(blocks, format='csr') if keep_matrix == True \
+        else None
+    return(sample_reads, np.concatenate(row_sums), 
+           np.concatenate(row_nonzero), obs_ids[0].append(obs_ids[1:]), 
+           sample_ids, matrix)
+
+fit_table_formats = {'.parquet': 'parquet', '.feather': 'feather', 
+                     '.h5': 'hdf5', '.hdf5': 'hdf5'}
+#File extensions of write_fit_table/read_fit_table
+
+def _fit_table_format(fn):
+    ext = os.path.splitext(str(fn))[1].lower()
+    if ext not in fit_table_formats:
+        raise ValueError('Unknown fit table extension ' + repr(ext) + 
+                         ', use one of ' + ', '.join(fit_table_formats))
+    return(fit_table_formats[ext])
+
+def write_fit_table(occurr_freqs, parameters, fn):
+    '''Writes occurr_freqs and the fit parameters as one binary file
+    
+    The taxonomy columns are stored as dictionary encoded categoricals
+    and the fit parameters as file metadata, so the results load back 
+    with read_fit_table without parsing any text. In HDF5 every other
+    non-numeric column is dictionary encoded as well and loads back as
+    a column of str (missing values as NaN).
+    
+    Parameters
+    ----------
+    occurr_freqs: pandas df
+        Df header: otu_id, mean_abundance, occurrence, Kingdom, Phylum, 
+        Class, Order, Family, Genus, Species, predicted_occurrence, 
+        lower_conf_int, upper_conf_int
+    parameters: dict
+        Fit parameters (m, N, r_square, ...), json serializable.
+    fn: str, path
+        Output file; the extension picks the format: .parquet or 
+        .feather (needs pyarrow) or .h5/.hdf5 (h5py).
+    
+    Returns
+    -------
+    fn: str, path
+        The file written.
+    '''
+    file_format = _fit_table_format(fn)
+    table = occurr_freqs.copy()
+    for rank in taxonomy_ranks:
+        if rank in table.columns:
+            table[rank] = table[rank].astype('category')
+    
+    if file_format == 'hdf5':
+        with h5py.File(fn, 'w') as f:
+            f.attrs['nevo'] = json.dumps(parameters)
+            group = f.create_group('occurr_freqs')
+            group.attrs['columns'] = json.dumps([str(c) for c in table.columns])
+            group.attrs['index_name'] = json.dumps(table.index.name)
+            group.create_dataset('index', data=table.index.astype(str)
+                                 .to_numpy(dtype=object),
+                                 dtype=h5py.string_dtype())
+            for column in table.columns:
+                values = table[column]
+                categorical = isinstance(values.dtype, pd.CategoricalDtype)
+                if not categorical and not (
+                        pd.api.types.is_numeric_dtype(values.dtype) or 
+                        pd.api.types.is_bool_dtype(values.dtype)):
+                    #str, object, ...: no native HDF5 type, encode as text
+                    values = values.astype('category')
+                if isinstance(values.dtype, pd.CategoricalDtype):
+                    sub = group.create_group(str(column))
+                    sub.attrs['categorical'] = categorical
+                    sub.create_dataset('codes', data=values.cat.codes
+                                       .to_numpy(), compression='gzip')
+                    sub.create_dataset('categories', 
+                                       data=values.cat.categories.astype(str)
+                                       .to_numpy(dtype=object),
+                                       dtype=h5py.string_dtype())
+                else:
+                    group.create_dataset(str(column), data=values.to_numpy(),
+                                         compression='gzip')
+    else:
+        import pyarrow
+        table = pyarrow.Table.from_pandas(table)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'nevo'] = json.dumps(parameters).encode()
+        table = table.replace_schema_metadata(metadata)
+        if file_format == 'parquet':
+            import pyarrow.parquet
+            pyarrow.parquet.write_table(table, fn)
+        else:
+            import pyarrow.feather
+            pyarrow.feather.write_feather(table, fn)
+    return(fn)
+
+def read_fit_table(fn):
+    '''Loads a file written by write_fit_table
+    
+    Parameters
+    ----------
+    fn: str, path
+        A .parquet, .feather, .h5 or .hdf5 fit table.
+    
+    Returns
+    -------
+    occurr_freqs: pandas df
+        As written, taxonomy columns as categoricals; from HDF5 other
+        text columns as columns of str.
+    parameters: dict
+        The fit parameters.
+    '''
+    file_format = _fit_table_format(fn)
+    if file_format == 'hdf5':
+        with h5py.File(fn, 'r') as f:
+            parameters = json.loads(f.attrs['nevo'])
+            group = f['occurr_freqs']
+            columns = {}
+            for column in json.loads(group.attrs['columns']):
+                if isinstance(group[column], h5py.Group):
+                    categories = group[column]['categories'].asstr()[()]
+                    columns[column] = pd.Categorical.from_codes(
+                        group[column]['codes'][()], categories)
+                    if not group[column].attrs.get('categorical', True):
+                        columns[column] = np.asarray(columns[column], 
+                                                     dtype=object)
+                else:
+                    columns[column] = group[column][()]
+            index = pd.Index(group['index'].asstr()[()], 
+                             name=json.loads(group.attrs['index_name']))
+        return(pd.DataFrame(columns, index=index), parameters)
+    
+    if file_format == 'parquet':
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(fn)
+    else:
+        import pyarrow.feather
+        table = pyarrow.feather.read_table(fn)
+    parameters = json.loads(table.schema.metadata[b'nevo'])
+    return(table.to_pandas(), parameters)
+
+taxonomy_ranks = ('Domain', 'Kingdom', 'Phylum', 'Class', 'Order', 'Family',
+                  'Genus', 'Species')
+#Taxonomy columns looked for in occurr_freqs, highest rank first
+
+def non_neutral_outliers(file_header, occurr_freqs, dataset_type, non_save, 
+                         threshold = 0.5, top = None):
     ''' Creates the most Non-neutral csv file 
     
     Written by: Caitlin Guccione, 08-25-2021
@@ -216,9 +859,17 @@ def non_neutral_outliers(file_header, occurr_freqs, dataset_type, non_save, thre
         Df header: otu_id, mean_abundance, occurrence, Kingdom, Phylum, 
         Class, Order, Family, Genus, Species, predicted_occurrence, 
         lower_conf_int, upper_conf_int
+    dataset_type: str
+        The highest rank reported (as Kingdom) is Domain for 'TCGA_WGS' 
+        and Kingdom otherwise, falling back to the other one if missing;
+        the other taxonomy columns are found in occurr_freqs itself.
     threshold: int, optional
         Autoset to 0.5, but determines which bacteria are considered 
         non-neutral strictly for this csv file
+    top: int, optional
+        If set, keeps only the top microbes furthest off the neutral 
+        curve (of those above threshold; use threshold = 0 for a pure 
+        ranking).
         
      Returns
      -------
@@ -226,35 +877,33 @@ def non_neutral_outliers(file_header, occurr_freqs, dataset_type, non_save, thre
          [name]_NonNeutralOutliers.csv, holds all the species 
          furthest off the neutral curve
     
-    TODO
-    ----
-    - See if there is a way to eliminate the Domain vs Kingdom 
-    differences more cleanly 
-    
     '''
     
+    #Distance of every microbe off the neutral curve, one column operation
+    diff = np.abs(occurr_freqs['occurrence'].to_numpy(dtype=float) - 
+                  occurr_freqs['predicted_occurrence'].to_numpy(dtype=float))
+    hits = np.flatnonzero(diff > threshold)
+    
+    #Optionally keep the top most non-neutral microbes only
+    if top is not None and top < len(hits):
+        best = np.argpartition(-diff[hits], top - 1)[:top] if top > 0 else []
+        hits = np.sort(hits[best])
+    
+    #Taxonomy columns present, the highest rank is always reported as
+    #Kingdom: Domain for TCGA_WGS, else Kingdom, the other one only if
+    #the preferred one is missing
+    ranks = [r for r in taxonomy_ranks if r in occurr_freqs.columns]
+    preferred, other = ('Domain', 'Kingdom') if dataset_type == 'TCGA_WGS' \
+        else ('Kingdom', 'Domain')
+    if preferred in ranks and other in ranks:
+        ranks.remove(other)
+    taxonomy = occurr_freqs[ranks].iloc[hits]
+    taxonomy.columns = ['Kingdom' if r == 'Domain' else r for r in ranks]
+    
     #Create dataframe
-    standoutMicrobes = pd.DataFrame(columns = ('Difference off Neutral Model',
-                                               'Kingdom', 'Phylum', 'Class',
-                                               'Order', 'Family', 'Genus',
-                                               'Species'))
-    
-    #Loop and find most non-neutral microbes based upon threshold
-    row_count = 0
-    for i,j in occurr_freqs.iterrows():
-        diff = abs(j['occurrence'] - j['predicted_occurrence'])
-        if diff > threshold:
-            if dataset_type == 'TCGA_WGS':
-                standoutMicrobes.loc[row_count] = [diff, j['Domain'],
-                                                   j['Phylum'], j['Class'],
-                                                   j['Order'], j['Family'],
-                                                   j['Genus'], j['Species']]
-            else:
-                standoutMicrobes.loc[row_count] = [diff, j['Kingdom'],
-                                                   j['Phylum'], j['Class'],
-                                                   j['Order'], j['Family'],
-                                                   j['Genus'], j['Species']]
-            row_count +=1
+    standoutMicrobes = pd.DataFrame({'Difference off Neutral Model': diff[hits]})
+    for rank in taxonomy.columns:
+        standoutMicrobes[rank] = taxonomy[rank].to_numpy()
     standoutMicrobes = standoutMicrobes.sort_values(by =['Difference off Neutral Model'],
                                                     ascending=False)
     
@@ -266,4 +915,4 @@ def non_neutral_outliers(file_header, occurr_freqs, dataset_type, non_save, thre
     fn = file_header + '_NonNeutral_Outliers.csv'
     
     if non_save == False:
-        standoutMicrobes.to_csv(fn, sep = '\t')
\ No newline at end of file
+        standoutMicrobes.to_csv(fn, sep = '\t')
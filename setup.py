@@ -84,7 +84,7 @@ setup(name='nevo',
       packages=find_packages(),
       ext_modules=extensions,
       install_requires=[
-          'numpy >= 1.12.1',
+          'numpy >= 1.18',
           'click',
           'lmfit',
           'pandas >= 0.10.0',
@@ -92,6 +92,7 @@ setup(name='nevo',
           'nose >= 1.3.7',
           'biom-format',
           'h5py', ],
+      extras_require={'yaml': ['PyYAML'], },
       classifiers=classifiers,
       entry_points={'console_scripts': standalone},
       cmdclass={'install': CustomInstallCommand,